@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+import os
+import sys
+import argparse
+
+import numpy as np
+import pandas as pd
+
+# hacky hack to get relative import
+sys.path.append( os.path.dirname( os.path.dirname(os.path.realpath(__file__)) ) )
+from helper.storage import open_storage
+from helper.query import iter_submissions, read_range, submission_table, aggregate_daily
+from helper.checkpoint import Checkpoint, checkpoint_filename
+from helper.atomic_file import read_json, write_json
+from helper import metrics
+from analysis.text_cleaning import filter_removed
+from analysis.sentiment_analysis import add_sentiment_columns, SentimentPool, SENTIMENT_COLUMNS
+
+# columns of the submissions which are needed for the rollup
+SUBMISSION_COLUMNS = ['Date', 'Title', 'Text', 'Comments', 'Score', 'id']
+
+# columns of the submissions whose changes make a day outdated, see daily_hashes
+HASH_COLUMNS = ['id', 'Score', 'Comments']
+
+# sums which are stored per day, means are derived from them by read_rollup so days and subreddits can be combined exactly
+SUM_COLUMNS = ['Comments', 'Score'] + SENTIMENT_COLUMNS + ['compound_weighted', 'weight']
+
+def rollup_table(subreddit):
+    return 'reddit_{}_daily'.format(subreddit)
+
+def _add_rollup_columns(chunk, pool):
+    """ Drops removed/deleted submissions, scores the rest on pool and adds the score weighted compound sentiment.
+        Every submission has at least weight 1, so days with only zero or negative scores still get a weighted mean.
+    """
+    chunk = filter_removed(chunk)
+    if len(chunk) == 0:
+        return chunk
+    chunk = add_sentiment_columns(chunk, pool=pool)
+    weight = chunk['Score'].astype('float64').clip(lower=1)
+    # the weight only counts where the compound sentiment does
+    weight[chunk['compound'].isna().values] = np.nan
+    return chunk.assign(weight=weight, compound_weighted=chunk['compound'] * weight)
+
+def compute_rollup(db_filename, subreddit, start=None, end=None, n_jobs=None, chunksize=100000, pool=None):
+    """ Aggregates the stored submissions of subreddit with start <= Date < end per day: Submissions (after
+        dropping removed/deleted ones), <column>_sum of SUM_COLUMNS and compound_count (number of scored
+        submissions). Only one chunk of submissions is held in memory at a time. All chunks are scored on pool
+        (a SentimentPool) or on an own pool of n_jobs processes.
+    """
+    if pool is None:
+        with SentimentPool(n_jobs=n_jobs) as pool:
+            return compute_rollup(db_filename, subreddit, start=start, end=end, chunksize=chunksize, pool=pool)
+    chunks = iter_submissions(db_filename, subreddit, start=start, end=end, columns=SUBMISSION_COLUMNS, chunksize=chunksize)
+    daily = aggregate_daily(chunks, sums=SUM_COLUMNS, counts=['id', 'compound'], by=['Date'],
+                            transform=lambda chunk: _add_rollup_columns(chunk, pool))
+    return daily.rename(columns={'id_count': 'Submissions'})
+
+def daily_hashes(db_filename, subreddit, days=None, chunksize=100000):
+    """ Returns the number of stored submissions (Stored) and a content hash of their HASH_COLUMNS (Hash) per
+        Date, of all days or only of the sorted days. The hash is the sum of the row hashes, so it does not depend
+        on the order of the rows and changes when submissions are added, removed or refetched with new scores or
+        comment counts.
+    """
+    ranges = [(None, None)] if days is None else _day_ranges(days)
+    partials = list()
+    columns = ['Date'] + HASH_COLUMNS
+    for start, end in ranges:
+        for chunk in iter_submissions(db_filename, subreddit, start=start, end=end, columns=columns, chunksize=chunksize):
+            row_hashes = pd.util.hash_pandas_object(chunk[HASH_COLUMNS], index=False).values.view('int64')
+            partials.append(pd.DataFrame({'Stored': 1, 'Hash': row_hashes}, index=chunk['Date'].values).groupby(level=0).sum())
+    if len(partials) == 0:
+        return pd.DataFrame({'Stored': pd.Series(dtype='int64'), 'Hash': pd.Series(dtype='int64')}, index=pd.DatetimeIndex([], name='Date'))
+    # int64 sums wrap around, which keeps them order independent
+    hashes = pd.concat(partials).groupby(level=0).sum()
+    hashes.index = pd.DatetimeIndex(hashes.index, name='Date')
+    return hashes
+
+def find_outdated_days(db_filename, subreddit, hashes=None):
+    """ Returns the days whose stored submissions differ from the ones the rollup was computed from (see
+        daily_hashes), i.e. days with new, removed or updated submissions and days which were not rolled up yet.
+    """
+    hashes = daily_hashes(db_filename, subreddit) if hashes is None else hashes
+    rollup = open_storage(db_filename, table=rollup_table(subreddit)).read()
+    if len(rollup) == 0 or 'Hash' not in rollup.columns:
+        return hashes.index.sort_values()
+    rolled_up = rollup.set_index(pd.DatetimeIndex(rollup['Date']))['Hash'].reindex(hashes.index)
+    return hashes.index[(rolled_up != hashes['Hash']).values].sort_values()
+
+def find_candidate_days(db_filename, subreddit, sequence):
+    """ Returns the days which may have changed since the rollup state sequence (see update_rollup): days the
+        fetcher updated since then according to its checkpoint and days whose number of stored submissions differs
+        from the Stored count of the rollup (e.g. changed by a sync). Only these days need to be hashed.
+    """
+    updated = Checkpoint(checkpoint_filename(db_filename, submission_table(subreddit))).days_updated_since(sequence)
+    counts = open_storage(db_filename, table=submission_table(subreddit)).count_per_date()
+    counts.index = pd.DatetimeIndex(counts.index)
+    rollup = open_storage(db_filename, table=rollup_table(subreddit)).read()
+    stored = rollup.set_index(pd.DatetimeIndex(rollup['Date']))['Stored'] if 'Stored' in rollup.columns else pd.Series(dtype='float64')
+    recounted = counts.index[(stored.reindex(counts.index) != counts).values]
+    return pd.DatetimeIndex(updated).union(recounted).sort_values()
+
+def _day_ranges(days):
+    """ Splits sorted days into runs of consecutive days, returns (start, end) tuples with end exclusive.
+    """
+    ranges = list()
+    for day in days:
+        if ranges and day == ranges[-1][1]:
+            ranges[-1][1] = day + pd.Timedelta(days=1)
+        else:
+            ranges.append([day, day + pd.Timedelta(days=1)])
+    return [tuple(r) for r in ranges]
+
+def _rollup_state_filename(db_filename, subreddit):
+    return checkpoint_filename(db_filename, rollup_table(subreddit))
+
+def update_rollup(db_filename, subreddit, full=False, n_jobs=None, chunksize=100000, mp_context=None):
+    """ Recomputes the rollup of all days whose stored submissions changed since the last update (or of all days
+        with full=True) and stores it in the table rollup_table(subreddit), one row per Date. Only the candidate
+        days (see find_candidate_days) are hashed, the sequence number of the fetcher's checkpoint seen by the last
+        update is kept in checkpoints/. The sentiments are scored on n_jobs processes started with mp_context, see
+        SentimentPool.
+
+    Returns:
+        int: number of updated days.
+    """
+    state_filename = _rollup_state_filename(db_filename, subreddit)
+    state = read_json(state_filename, {'sequence': None})
+    # read before hashing, days updated while the rollup runs are picked up by the next update
+    sequence = Checkpoint(checkpoint_filename(db_filename, submission_table(subreddit))).sequence
+    if full or state['sequence'] is None:
+        hashes = daily_hashes(db_filename, subreddit, chunksize=chunksize)
+    else:
+        hashes = daily_hashes(db_filename, subreddit, days=find_candidate_days(db_filename, subreddit, state['sequence']), chunksize=chunksize)
+    days = hashes.index.sort_values() if full else find_outdated_days(db_filename, subreddit, hashes)
+    if len(days) == 0:
+        write_json(state_filename, {'sequence': sequence})
+        return 0
+
+    store = open_storage(db_filename, table=rollup_table(subreddit), key='Date')
+    with SentimentPool(n_jobs=n_jobs, mp_context=mp_context) as pool:
+        for start, end in _day_ranges(days):
+            print('Rolling up /r/{} from {} to {}...'.format(subreddit, start.date(), (end - pd.Timedelta(days=1)).date()))
+            with metrics.timer('rollup', subreddit=subreddit):
+                daily = compute_rollup(db_filename, subreddit, start=start, end=end, chunksize=chunksize, pool=pool)
+            # days with only removed submissions still need a row, otherwise they would be outdated forever
+            range_days = days[(days >= start) & (days < end)]
+            daily = daily.set_index('Date').reindex(range_days) if len(daily) > 0 else pd.DataFrame(index=range_days)
+            daily.index.name = 'Date'
+            for column in ['Submissions', 'compound_count']:
+                daily[column] = daily[column].fillna(0).astype('int64') if column in daily.columns else 0
+            for column in SUM_COLUMNS:
+                if column + '_sum' not in daily.columns:
+                    daily[column + '_sum'] = np.nan
+            daily['Stored'] = hashes['Stored'].reindex(range_days).values
+            daily['Hash'] = hashes['Hash'].reindex(range_days).values
+            store.insert(daily.reset_index()[['Date', 'Stored', 'Hash', 'Submissions', 'compound_count'] + [c + '_sum' for c in SUM_COLUMNS]])
+            metrics.count('rollup_days', len(daily), subreddit=subreddit)
+    write_json(state_filename, {'sequence': sequence})
+    return len(days)
+
+def _add_means(data):
+    """ Derives the daily means from the sums and counts of the rollup: Comments, Score (per submission), pos,
+        neu, neg, compound (per scored submission) and compound_weighted (weighted by score).
+    """
+    data = data.copy()
+    submissions = data['Submissions'].where(data['Submissions'] > 0)
+    scored = data['compound_count'].where(data['compound_count'] > 0)
+    data['Comments_mean'] = data['Comments_sum'] / submissions
+    data['Score_mean'] = data['Score_sum'] / submissions
+    for column in SENTIMENT_COLUMNS:
+        data[column] = data[column + '_sum'] / scored
+    data['compound_weighted'] = data['compound_weighted_sum'] / data['weight_sum'].where(data['weight_sum'] > 0)
+    return data
+
+def read_rollup(db_filename, subreddits, start=None, end=None, combine=False):
+    """ Returns the rollup of subreddits with start <= Date < end, with the columns of update_rollup plus the daily
+        means (see _add_means) and a column Subreddit. With combine=True the subreddits are summed up per day first,
+        so the means are exact means over all of their submissions.
+    """
+    subreddits = [subreddits] if isinstance(subreddits, str) else list(subreddits)
+    frames = [read_range(db_filename, table=rollup_table(s), start=start, end=end).assign(Subreddit=s) for s in subreddits]
+    frames = [f for f in frames if len(f) > 0]
+    if len(frames) == 0:
+        return pd.DataFrame(columns=['Date', 'Subreddit'])
+    data = pd.concat(frames, ignore_index=True)
+    if combine:
+        data = data.drop(columns=['Subreddit']).groupby('Date').sum(min_count=1).reset_index()
+        data['Subreddit'] = '+'.join(subreddits)
+    return _add_means(data).sort_values(by=['Subreddit', 'Date']).reset_index(drop=True)
+
+def join_kpis(rollup, db_filename, kpi_table='kpi', kpis=None):
+    """ Left joins the KPI snapshots (all columns or only kpis, e.g. ['SP500']) to the rollup by Date. KPIs are
+        NaN on days without snapshot (weekends, holidays).
+    """
+    if len(rollup) == 0:
+        return rollup
+    columns = None if kpis is None else ['Date'] + list(kpis)
+    kpi_data = read_range(db_filename, table=kpi_table, start=rollup['Date'].min(), end=rollup['Date'].max() + pd.Timedelta(days=1), columns=columns)
+    if len(kpi_data) == 0:
+        return rollup
+    kpi_data['Date'] = pd.to_datetime(kpi_data['Date'])
+    return rollup.merge(kpi_data, on='Date', how='left')
+
+def load_daily_sentiment(db_filename, subreddits, start=None, end=None, combine=True, kpis=('SP500',), kpi_table='kpi'):
+    """ Daily activity and sentiment of subreddits joined with kpis, e.g. for the dashboards and notebooks.
+    """
+    return join_kpis(read_rollup(db_filename, subreddits, start=start, end=end, combine=combine), db_filename, kpi_table=kpi_table, kpis=kpis)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Updates the daily activity and sentiment rollups of the stored submissions.')
+    parser.add_argument('--subreddits', nargs='+', default=['wallstreetbets'], help='e.g. wallstreetbets stocks investing stockmarket pennystocks')
+    parser.add_argument('--full', action='store_true', help='recompute all days instead of only changed ones')
+    parser.add_argument('--jobs', type=int, default=None, help='number of sentiment scoring processes, defaults to all cores')
+    metrics.add_arguments(parser)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    metrics.apply_arguments(args)
+
+    # we assume this code is in /src/analysis while data is in /data. Since we do not want to assume a cwd we switch to src and than move one up
+    path = os.path.dirname(os.path.realpath(__file__))
+    os.chdir(path)
+    os.chdir(os.path.pardir)
+    os.chdir(os.path.pardir)
+
+    with metrics.stage('rollup'):
+        for subreddit in args.subreddits:
+            days = update_rollup('data/findat.sqlite3', subreddit, full=args.full, n_jobs=args.jobs)
+            print('...done. Updated {} days of /r/{}.'.format(days, subreddit))
+    metrics.finish(args)
+
+if __name__ == "__main__":
+    main()
@@ -3,16 +3,26 @@ import sys
 import time
 import datetime
 import re
+import json
+import hashlib
+import threading
 from datetime import date, timedelta
+from concurrent.futures import ProcessPoolExecutor
 
-import pandas as pd
 import numpy as np
-import spacy
-from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
 
 # hacky hack to get relative import
 sys.path.append( os.path.dirname( os.path.dirname(os.path.realpath(__file__)) ) )
 from helper.timespan_helper import get_timestamp_from_date
+from helper.result_cache import ResultCache
+from helper import metrics
+from analysis.text_cleaning import remove_emoji_from, build_scoring_text
+
+# spaCy, its model and VADER are expensive to import and load, so they are only loaded on first use (once per
+# process). This keeps importing this module and starting pool workers cheap.
+_lock = threading.RLock()
+_analyser = None
+_nlp = None
 
 # Update lexicon for better accuracy of sentiment analysis
 positive_words = 'buy bull long support undervalued underpriced cheap upward rising trend moon rocket hold hodl breakout call beat support buying holding high profit stonks yolo'
@@ -20,36 +30,299 @@ negative_words = 'sell bear bubble bearish short overvalued overbought overprice
 pos = {i: 5 for i in positive_words.split(" ")}
 neg = {i: -5 for i in negative_words.split(" ")}
 stock_lexicons = {**pos, **neg}
-analyser = SentimentIntensityAnalyzer()
-analyser.lexicon.update(stock_lexicons)
 
-# named entity reconition
-nlp = spacy.load("en_core_web_sm") # spacy.load("en_core_web_trf")
+def make_sentiment_analyser():
+    from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
+    analyser = SentimentIntensityAnalyzer()
+    analyser.lexicon.update(stock_lexicons)
+    return analyser
+
+def get_analyser():
+    """ Returns the lexicon-augmented SentimentIntensityAnalyzer of this process.
+    """
+    global _analyser
+    with _lock:
+        if _analyser is None:
+            _analyser = make_sentiment_analyser()
+        return _analyser
+
+# named entity reconition, the model can be chosen with set_spacy_model or the environment variable FINDAT_SPACY_MODEL
+spacy_model = os.environ.get('FINDAT_SPACY_MODEL', 'en_core_web_sm') # 'en_core_web_trf'
+
+def _components_not_needed_for_ner(nlp):
+    """ Everything except ner and the shared tok2vec/transformer, if ner listens to it (e.g. en_core_web_trf).
+    """
+    needed = {'ner'}
+    for name in ['tok2vec', 'transformer']:
+        if name in nlp.pipe_names and 'ner' in getattr(nlp.get_pipe(name), 'listening_components', []):
+            needed.add(name)
+    return [name for name in nlp.pipe_names if name not in needed]
+
+def get_nlp():
+    """ Returns the spaCy pipeline of this process with everything but NER disabled.
+    """
+    global _nlp
+    with _lock:
+        if _nlp is None:
+            import spacy
+            _nlp = spacy.load(spacy_model)
+            _nlp.select_pipes(disable=_components_not_needed_for_ner(_nlp))
+        return _nlp
+
+def set_spacy_model(model):
+    """ Switches the spaCy model, e.g. to 'en_core_web_trf'. It is loaded on next use.
+    """
+    global spacy_model, _nlp, _org_cache
+    with _lock:
+        spacy_model = model
+        _nlp = None
+        _org_cache = None
+
+def __getattr__(name):
+    # keeps module.analyser and module.nlp working while loading them lazily
+    if name == 'analyser':
+        return get_analyser()
+    if name == 'nlp':
+        return get_nlp()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
 blacklist_orgs = [x.lower() for x in ["WSB", "Robinhood", "SEC", "Fed", "CNBC", "Citadel", "RH", "FDA", "Fidelity", "Reddit", 'wallstreetbets']]
 
+# results are cached by hash of the (cleaned) text plus lexicon/model version, so reruns only score new texts
+CACHE_FILENAME = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__)))), 'data', 'cache', 'analysis_cache.sqlite3')
+_cache_settings = None
+_sentiment_cache = None
+_org_cache = None
+
+def configure_cache(filename=CACHE_FILENAME, max_memory_items=100000, max_disk_bytes=512 * 1024**2):
+    """ Configures the sentiment and ORG caches, they are created on first use. With filename None only the
+        in-memory tier is used.
+    """
+    global _cache_settings, _sentiment_cache, _org_cache
+    with _lock:
+        _cache_settings = (filename, max_memory_items, max_disk_bytes)
+        _sentiment_cache = None
+        _org_cache = None
+
+def disable_cache():
+    global _cache_settings, _sentiment_cache, _org_cache
+    with _lock:
+        _cache_settings = None
+        _sentiment_cache = None
+        _org_cache = None
+
+def get_sentiment_cache():
+    global _sentiment_cache
+    with _lock:
+        if _sentiment_cache is None and _cache_settings is not None:
+            filename, max_memory_items, max_disk_bytes = _cache_settings
+            lexicon_version = hashlib.sha1(json.dumps(stock_lexicons, sort_keys=True).encode('utf-8')).hexdigest()
+            _sentiment_cache = ResultCache(filename, 'sentiment', 'vader-' + lexicon_version, max_memory_items, max_disk_bytes)
+        return _sentiment_cache
+
+def get_org_cache():
+    global _org_cache
+    with _lock:
+        if _org_cache is None and _cache_settings is not None:
+            filename, max_memory_items, max_disk_bytes = _cache_settings
+            meta = get_nlp().meta
+            model_version = '{}_{}-{}'.format(meta.get('lang'), meta.get('name'), meta.get('version'))
+            _org_cache = ResultCache(filename, 'orgs', model_version, max_memory_items, max_disk_bytes)
+        return _org_cache
+
+def print_cache_stats():
+    for name, cache in [('sentiment', _sentiment_cache), ('orgs', _org_cache)]:
+        if cache is not None:
+            print('{} cache: {}'.format(name, cache.stats()))
+
+configure_cache()
+
 def get_sentiment(input_str):
     try:
         assert(len(input_str) > 0)
-        sentiment = analyser.polarity_scores(str(input_str))
+        text = str(input_str)
     except (AttributeError, TypeError):
         raise AssertionError('Input variable either empty or not a string')
 
+    sentiment_cache = get_sentiment_cache()
+    if sentiment_cache is None:
+        return get_analyser().polarity_scores(text)
+
+    key = sentiment_cache.key(text)
+    sentiment = sentiment_cache.get(key)
+    if sentiment is None:
+        sentiment = get_analyser().polarity_scores(text)
+        sentiment_cache.put(key, sentiment)
     return sentiment
 
+# columns returned by the batch sentiment api, in this order
+SENTIMENT_COLUMNS = ['pos', 'neu', 'neg', 'compound']
+
+def _init_sentiment_worker():
+    # build the analyser once per worker before the first chunk arrives
+    get_analyser()
+
+def _score_texts(texts, scoring_analyser=None):
+    """ Scores a list of texts, returns an array of shape (len(texts), 4) with columns SENTIMENT_COLUMNS.
+        Empty or non-string texts get NaN.
+    """
+    scoring_analyser = scoring_analyser or get_analyser()
+    scores = np.full((len(texts), len(SENTIMENT_COLUMNS)), np.nan)
+    for i, text in enumerate(texts):
+        if isinstance(text, str) and len(text) > 0:
+            sentiment = scoring_analyser.polarity_scores(text)
+            scores[i] = [sentiment[c] for c in SENTIMENT_COLUMNS]
+    return scores
+
+def _split(texts, chunksize):
+    return [texts[i:i + chunksize] for i in range(0, len(texts), chunksize)]
+
+def _to_columns(scores):
+    return {c: np.ascontiguousarray(scores[:, i]) for i, c in enumerate(SENTIMENT_COLUMNS)}
+
+class SentimentPool:
+    """ Process pool for scoring texts on n_jobs processes (defaults to all cores). It is only started when the
+        first text is not found in the cache and then kept alive until shutdown, so many chunks or calls (see the
+        pool argument of iter_sentiments) share it. Can be used as context manager. Pass a spawn or forkserver
+        mp_context when scoring from a thread of a multi-threaded process.
+    """
+    def __init__(self, n_jobs=None, chunksize=2000, mp_context=None):
+        self.n_jobs = n_jobs or os.cpu_count()
+        self.chunksize = chunksize
+        self.mp_context = mp_context
+        self._executor = None
+
+    def score(self, texts):
+        if self.n_jobs == 1:
+            return _score_texts(texts)
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.n_jobs, initializer=_init_sentiment_worker, mp_context=self.mp_context)
+        return np.concatenate(list(self._executor.map(_score_texts, _split(texts, self.chunksize))))
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+def get_sentiments(texts, n_jobs=None, chunksize=2000, pool=None):
+    """ Scores many texts at once, e.g. a whole column of Title + Text, on n_jobs processes (defaults to all cores).
+        Every worker builds its SentimentIntensityAnalyzer only once.
+
+    Returns:
+        dict: column name ('pos', 'neu', 'neg', 'compound') -> float numpy array in the order of texts. Can directly
+              be assigned to the DataFrame, e.g. df.assign(**get_sentiments(texts)).
+    """
+    sentiments = iter_sentiments([texts], n_jobs=n_jobs, chunksize=chunksize, pool=pool)
+    try:
+        return next(sentiments)
+    finally:
+        sentiments.close()
+
+@metrics.timer('sentiment_batch')
+def _get_scores(texts, score):
+    """ Returns the scores of texts as array with columns SENTIMENT_COLUMNS, only texts which are not cached are
+        scored by score (a function taking a list of texts). Empty or non-string texts get NaN.
+    """
+    scores = np.full((len(texts), len(SENTIMENT_COLUMNS)), np.nan)
+    valid = [i for i, text in enumerate(texts) if isinstance(text, str) and len(text) > 0]
+    if len(valid) == 0:
+        return scores
+
+    sentiment_cache = get_sentiment_cache()
+    if sentiment_cache is None:
+        scores[valid] = score([texts[i] for i in valid])
+        return scores
+
+    keys = [sentiment_cache.key(texts[i]) for i in valid]
+    sentiments = sentiment_cache.get_many(keys)
+    missing = {key: texts[i] for i, key in zip(valid, keys) if key not in sentiments}
+    metrics.count('sentiment_texts', len(keys))
+    metrics.count('sentiment_scored', len(missing))
+    if missing:
+        computed = {key: dict(zip(SENTIMENT_COLUMNS, row.tolist())) for key, row in zip(missing, score(list(missing.values())))}
+        sentiment_cache.put_many(computed)
+        sentiments.update(computed)
+
+    scores[valid] = [[sentiments[key][c] for c in SENTIMENT_COLUMNS] for key in keys]
+    return scores
+
+def iter_sentiments(text_chunks, n_jobs=None, chunksize=2000, pool=None):
+    """ Streaming version of get_sentiments: yields one dict of score columns per chunk of texts in text_chunks
+        (e.g. the chunks of pd.read_csv(..., chunksize=...)). Texts are scored on pool (a SentimentPool which is
+        left running) or on an own one which is kept alive for all chunks.
+    """
+    own_pool = pool is None
+    pool = SentimentPool(n_jobs=n_jobs, chunksize=chunksize) if own_pool else pool
+    try:
+        for texts in text_chunks:
+            yield _to_columns(_get_scores(list(texts), pool.score))
+    finally:
+        if own_pool:
+            pool.shutdown()
+
+def add_sentiment_columns(df, n_jobs=None, chunksize=2000, pool=None):
+    """ Adds the columns pos, neu, neg and compound scored on Title + '\\n' + Text to the submissions in df.
+        Pass a SentimentPool as pool when scoring many DataFrames, so the processes are started only once.
+    """
+    texts = build_scoring_text(df, remove_emoji=False)
+    return df.assign(**get_sentiments(texts, n_jobs=n_jobs, chunksize=chunksize, pool=pool))
+
+def normalize_entity(text):
+    """ Lowercase entity text without surrounding whitespace, punctuation and possessive 's, e.g. "Robinhood's" -> "robinhood".
+    """
+    text = text.strip().lower()
+    if text.endswith("'s") or text.endswith("’s"):
+        text = text[:-2]
+    return text.strip(' \t\n.,;:!?"\'$()[]{}')
+
+def _org_entities(doc):
+    return [normalize_entity(entity.text) for entity in doc.ents if entity.label_ == "ORG"]
+
+@metrics.timer('ner_batch')
+def _get_org_lists(texts, batch_size, n_process):
+    """ Returns the normalized ORG entities of every text. Texts which are not cached are processed in batches
+        by nlp.pipe.
+    """
+    cleaned_texts = [remove_emoji_from(text) if isinstance(text, str) else '' for text in texts]
+    nlp = get_nlp()
+    org_cache = get_org_cache()
+    if org_cache is None:
+        return [_org_entities(doc) for doc in nlp.pipe(cleaned_texts, batch_size=batch_size, n_process=n_process)]
+
+    keys = [org_cache.key(text) for text in cleaned_texts]
+    orgs = org_cache.get_many(keys)
+    missing = {key: text for key, text in zip(keys, cleaned_texts) if key not in orgs}
+    metrics.count('ner_texts', len(keys))
+    metrics.count('ner_processed', len(missing))
+    if missing:
+        docs = nlp.pipe(missing.values(), batch_size=batch_size, n_process=n_process)
+        computed = {key: _org_entities(doc) for key, doc in zip(missing, docs)}
+        org_cache.put_many(computed)
+        orgs.update(computed)
+    return [orgs[key] for key in keys]
+
+def get_orgs(texts, blacklist=blacklist_orgs, batch_size=256, n_process=1):
+    """ Returns a list with the normalized ORG entities of every text which are not on the blacklist.
+    """
+    blacklist = set(normalize_entity(x) for x in blacklist)
+    return [[org for org in orgs if org not in blacklist] for orgs in _get_org_lists(texts, batch_size, n_process)]
+
+def check_for_orgs(texts, blacklist=[], batch_size=256, n_process=1):
+    """ Batch version of check_for_org, returns a boolean numpy array in the order of texts.
+    """
+    blacklist = set(normalize_entity(x) for x in blacklist)
+    return np.array([bool(orgs) and not (set(orgs) & blacklist) for orgs in _get_org_lists(texts, batch_size, n_process)], dtype=bool)
+
 def check_for_org(input_str, blacklist=[]):
-    doc = nlp( remove_emoji_from(input_str) )
-    org_list = [entity for entity in doc.ents if entity.label_ == "ORG"]
-    blacklist_check = list(set(org_list) & set(blacklist))
-    return True if org_list and not blacklist_check else False
-
-def remove_emoji_from(text):
-    regrex_pattern = re.compile(pattern = "["
-        u"\U0001F600-\U0001F64F"  # emoticons
-        u"\U0001F300-\U0001F5FF"  # symbols & pictographs
-        u"\U0001F680-\U0001F6FF"  # transport & map symbols
-        u"\U0001F1E0-\U0001F1FF"  # flags (iOS)
-                           "]+", flags = re.UNICODE)
-    return regrex_pattern.sub(r'',text)
+    """ True if input_str mentions an organisation and none of them is on the blacklist.
+    """
+    return bool(check_for_orgs([input_str], blacklist=blacklist)[0])
 
 if __name__ == "__main__":
     pass
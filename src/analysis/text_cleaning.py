@@ -0,0 +1,55 @@
+import re
+
+# compiled once at import, this runs before every sentiment and NER pass. Only the emoji blocks are removed,
+# other symbols (enclosed alphanumerics, mahjong tiles, cards, ...) stay part of the text
+EMOJI_PATTERN = re.compile(pattern = "["
+    u"\U0001F600-\U0001F64F"  # emoticons
+    u"\U0001F300-\U0001F5FF"  # symbols & pictographs
+    u"\U0001F680-\U0001F6FF"  # transport & map symbols
+    u"\U0001F1E0-\U0001F1FF"  # flags (iOS)
+    u"\U0001F900-\U0001F9FF"  # supplemental symbols & pictographs
+    u"\U0001FA70-\U0001FAFF"  # symbols & pictographs extended-A
+    u"\u2600-\u26FF"          # miscellaneous symbols
+    u"\u2700-\u27BF"          # dingbats
+    u"\uFE0F"                  # variation selector-16 (emoji presentation)
+    u"\u200D"                  # zero width joiner of emoji sequences
+                       "]+", flags = re.UNICODE)
+
+# texts of submissions which were removed or deleted, posts with these texts carry no information
+REMOVED_TEXTS = ['', '[removed]', '[deleted]', 'deleted']
+
+def remove_emoji_from(text):
+    return EMOJI_PATTERN.sub(r'', text)
+
+def remove_emoji_from_column(texts):
+    """ Removes emoji from a whole pandas string column.
+    """
+    return texts.str.replace(EMOJI_PATTERN, '', regex=True)
+
+def filter_removed(df, column='Text'):
+    """ Drops submissions whose column is NaN, empty, whitespace only, removed or deleted.
+    """
+    texts = df[column]
+    keep = texts.notna() & ~texts.fillna('').astype(str).str.strip().isin(REMOVED_TEXTS)
+    return df[keep.values]
+
+def build_scoring_text(df, remove_emoji=True):
+    """ Returns Title + '\\n' + Text of all submissions as one string column, optionally without emoji.
+    """
+    texts = df['Title'].fillna('').astype(str) + '\n' + df['Text'].fillna('').astype(str)
+    if remove_emoji:
+        texts = remove_emoji_from_column(texts)
+    return texts
+
+def clean_submissions(df, remove_emoji=True):
+    """ Text normalization stage: drops removed/deleted/empty submissions and adds the column ScoringText used by
+        the sentiment and NER passes.
+    """
+    df = filter_removed(df)
+    return df.assign(ScoringText=build_scoring_text(df, remove_emoji=remove_emoji))
+
+def iter_clean_submissions(chunks, remove_emoji=True):
+    """ Streaming version of clean_submissions for chunks of submissions, e.g. from pd.read_csv(..., chunksize=...).
+    """
+    for chunk in chunks:
+        yield clean_submissions(chunk, remove_emoji=remove_emoji)
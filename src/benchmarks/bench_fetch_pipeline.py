@@ -0,0 +1,89 @@
+import os
+import sys
+import time
+import shutil
+import datetime
+import tempfile
+import contextlib
+import io
+
+# hacky hack to get relative import
+sys.path.append( os.path.dirname( os.path.dirname(os.path.realpath(__file__)) ) )
+from helper.replay_server import ReplayServer
+from helper import http_client
+from media import fetch_from_reddit
+from kpi import fetch_new_data
+
+def run_reddit_fetch(server, days, subreddits, workers, comments=None):
+    """ Backfills days x subreddits from the replay server into a fresh database and returns
+        (seconds, stored submissions, stored comments).
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        db_filename = os.path.join(directory, 'findat.sqlite3')
+        dates = [datetime.datetime(2021, 8, 1) + datetime.timedelta(days=i) for i in range(days)]
+        jobs = [(subreddit, date) for date in dates for subreddit in subreddits]
+
+        start = time.perf_counter()
+        # the fetchers log every page, keep the report readable
+        with contextlib.redirect_stdout(io.StringIO()):
+            failed = fetch_from_reddit.get_missing_submissions(jobs, db_filename, max_workers=workers)
+            if comments:
+                failed += fetch_from_reddit.get_comments_concurrently(jobs, db_filename, mode=comments, top_n=10, max_workers=workers)
+        seconds = time.perf_counter() - start
+
+        submissions = sum(len(fetch_from_reddit.open_storage(db_filename, table='reddit_{}_submissions'.format(s)).read()) for s in subreddits)
+        stored_comments = 0
+        if comments:
+            stored_comments = sum(len(fetch_from_reddit.open_storage(db_filename, table='reddit_{}_comments'.format(s)).read()) for s in subreddits)
+        if failed:
+            print('    {} jobs failed'.format(len(failed)))
+        return seconds, submissions, stored_comments
+    finally:
+        shutil.rmtree(directory)
+
+def report(name, server, seconds, records):
+    stats = server.stats()
+    statuses = ', '.join('{}: {}'.format(status, count) for status, count in sorted(stats['statuses'].items()))
+    print('{:<44} {:8.2f}s {:10.0f} records/s {:6d} requests ({})'.format(name, seconds, records / seconds, sum(stats['requests'].values()), statuses))
+
+def run_benchmark(days=3, subreddits=('wallstreetbets', 'stocks'), posts_per_day=500, latency=0.05):
+    # the replay server enforces pushshift's limits itself, the client should only be limited by it in the rate limit runs
+    fetch_from_reddit.set_rate_limit(1000, 1000)
+    http_client.configure(pool_maxsize=64)
+
+    print('{} days x {} subreddits, {} posts per day, {}s latency'.format(days, len(subreddits), posts_per_day, latency))
+    for workers in [1, 4, 16]:
+        with ReplayServer(posts_per_day=posts_per_day, latency=latency) as server:
+            fetch_from_reddit.PUSHSHIFT_URL = server.base_url
+            seconds, submissions, _ = run_reddit_fetch(server, days, subreddits, workers)
+            report('submissions, {} workers'.format(workers), server, seconds, submissions)
+
+    with ReplayServer(posts_per_day=posts_per_day, latency=latency, comments_per_submission=20) as server:
+        fetch_from_reddit.PUSHSHIFT_URL = server.base_url
+        seconds, submissions, comments = run_reddit_fetch(server, days, subreddits, 8, comments='top')
+        report('submissions + top 10 threads, 8 workers', server, seconds, submissions + comments)
+
+    # client side token bucket against a server which answers everything above 10 requests/s with 429
+    with ReplayServer(posts_per_day=posts_per_day, latency=latency, max_requests_per_second=10) as server:
+        fetch_from_reddit.PUSHSHIFT_URL = server.base_url
+        fetch_from_reddit.set_rate_limit(9, 1)
+        seconds, submissions, _ = run_reddit_fetch(server, 1, subreddits, 8)
+        report('rate limited to 9 req/s, 8 workers', server, seconds, submissions)
+        fetch_from_reddit.set_rate_limit(1000, 1000)
+
+    # retries of http_client.get, every retry waits for the rate limiter again
+    with ReplayServer(posts_per_day=posts_per_day, latency=latency, error_rate=0.02, throttle_rate=0.02) as server:
+        fetch_from_reddit.PUSHSHIFT_URL = server.base_url
+        seconds, submissions, _ = run_reddit_fetch(server, 1, subreddits, 8)
+        report('2% 5xx + 2% 429, 8 workers', server, seconds, submissions)
+
+    with ReplayServer(latency=latency) as server:
+        fetch_new_data.YAHOO_URL = fetch_new_data.CBOE_URL = fetch_new_data.CNN_URL = server.base_url
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            data = fetch_new_data.get_new_data()
+        report('KPI snapshot', server, time.perf_counter() - start, int(data.notna().sum(axis=1).iloc[0]) - 1)
+
+if __name__ == "__main__":
+    run_benchmark()
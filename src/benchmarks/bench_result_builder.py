@@ -0,0 +1,70 @@
+import os
+import sys
+import time
+import datetime
+import random
+
+import pandas as pd
+
+# hacky hack to get relative import
+sys.path.append( os.path.dirname( os.path.dirname(os.path.realpath(__file__)) ) )
+from helper.result_builder import ResultBuilder, SUBMISSION_COLUMNS
+
+def make_synthetic_pages(number_of_entries, page_size=100, seed=42):
+    """ Creates pushshift-like submission pages with page_size entries each.
+    """
+    rng = random.Random(seed)
+    start_timestamp = int(time.mktime(datetime.date(2021, 1, 27).timetuple()))
+    entries = [{
+                'id': format(i, 'x'),
+                'title': 'GME to the moon {} 🚀'.format(i),
+                'selftext': 'Diamond hands ' * rng.randint(0, 20),
+                'num_comments': rng.randint(0, 5000),
+                'score': rng.randint(0, 100000),
+                'created_utc': start_timestamp + i,
+            } for i in range(number_of_entries)]
+    return [entries[i:i + page_size] for i in range(0, number_of_entries, page_size)]
+
+def build_row_by_row(pages, date):
+    """ The previous approach: one single-row DataFrame per entry appended to the result.
+    """
+    df = ResultBuilder(SUBMISSION_COLUMNS).to_df()
+    for page in pages:
+        for entry in page:
+            df = pd.concat([df, pd.DataFrame({
+                        'Date': pd.to_datetime(date),
+                        'Title': str(entry['title']),
+                        'Text': str(entry.get('selftext', '')),
+                        'Comments': pd.to_numeric(entry['num_comments']),
+                        'Score': pd.to_numeric(entry['score']),
+                        'id': str(entry['id']),
+                    }, index=[len(df)] )])
+    return df
+
+def build_columnar(pages, date):
+    builder = ResultBuilder(SUBMISSION_COLUMNS, Date=date)
+    for page in pages:
+        builder.add_page(page)
+    return builder.to_df()
+
+def run_benchmark(sizes=(1000, 5000, 20000), max_row_by_row_size=5000):
+    date = datetime.date(2021, 1, 27)
+    for size in sizes:
+        pages = make_synthetic_pages(size)
+
+        start = time.perf_counter()
+        columnar = build_columnar(pages, date)
+        columnar_time = time.perf_counter() - start
+
+        # the row by row approach is quadratic, so we skip it for large sizes
+        if size <= max_row_by_row_size:
+            start = time.perf_counter()
+            row_by_row = build_row_by_row(pages, date)
+            row_by_row_time = time.perf_counter() - start
+            assert len(row_by_row) == len(columnar)
+            print('{:>7} entries: row by row {:8.3f}s, columnar {:8.4f}s, speedup {:8.1f}x'.format(size, row_by_row_time, columnar_time, row_by_row_time / columnar_time))
+        else:
+            print('{:>7} entries: row by row  skipped, columnar {:8.4f}s'.format(size, columnar_time))
+
+if __name__ == "__main__":
+    run_benchmark()
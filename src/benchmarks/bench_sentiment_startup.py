@@ -0,0 +1,35 @@
+import os
+import sys
+import time
+import subprocess
+
+ANALYSIS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'analysis')
+
+# every snippet runs in a fresh interpreter, like a script, notebook kernel or spawned pool worker would
+SNIPPETS = {
+    'python startup': 'pass',
+    'import sentiment_analysis': 'import sentiment_analysis',
+    'import + first get_sentiment': 'import sentiment_analysis as s; s.disable_cache(); s.get_sentiment("Apple stocks are really awesome!")',
+    'import + first check_for_org': 'import sentiment_analysis as s; s.disable_cache(); s.check_for_org("Apple stocks are really awesome!")',
+}
+
+def time_snippet(code, repeat):
+    timings = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-c', code], cwd=ANALYSIS_DIR, capture_output=True, text=True)
+        timings.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            return None, result.stderr.strip().splitlines()[-1]
+    return min(timings), None
+
+def run_benchmark(repeat=5):
+    for name, code in SNIPPETS.items():
+        seconds, error = time_snippet(code, repeat)
+        if error:
+            print('{:<32} failed: {}'.format(name, error))
+        else:
+            print('{:<32} {:8.3f}s (best of {})'.format(name, seconds, repeat))
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,59 @@
+import os
+import re
+import sys
+import time
+import random
+
+import numpy as np
+import pandas as pd
+
+# hacky hack to get relative import
+sys.path.append( os.path.dirname( os.path.dirname(os.path.realpath(__file__)) ) )
+from analysis.text_cleaning import clean_submissions, iter_clean_submissions
+
+def make_synthetic_submissions(number_of_rows, seed=42):
+    rng = random.Random(seed)
+    texts = ['', '[removed]', 'deleted', np.nan, 'Diamond hands 💎🙌 to the moon 🚀🚀🚀 ' * 5, 'YOLO on $GME calls, wife is not happy 😅', 'Plain text ' * 30]
+    return pd.DataFrame({
+        'Title': ['GME {} 🚀 buy the dip'.format(i) for i in range(number_of_rows)],
+        'Text': [rng.choice(texts) for _ in range(number_of_rows)],
+    })
+
+def clean_row_by_row(df):
+    """ The previous approach: isin filter, row wise concatenation and a regex compiled for every text.
+    """
+    def remove_emoji_from(text):
+        regrex_pattern = re.compile(pattern = "["
+            u"\U0001F600-\U0001F64F"
+            u"\U0001F300-\U0001F5FF"
+            u"\U0001F680-\U0001F6FF"
+            u"\U0001F1E0-\U0001F1FF"
+                               "]+", flags = re.UNICODE)
+        return regrex_pattern.sub(r'',text)
+
+    df = df[df.Text.isin([np.nan, '', '[removed]', 'deleted']) == False]
+    return df.assign(ScoringText=df.apply(lambda row: remove_emoji_from(row['Title'] + '\n' + row['Text']), axis=1))
+
+def run_benchmark(number_of_rows=200000, chunksize=50000):
+    df = make_synthetic_submissions(number_of_rows)
+
+    start = time.perf_counter()
+    row_by_row = clean_row_by_row(df)
+    row_by_row_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    vectorized = clean_submissions(df)
+    vectorized_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    streamed_rows = sum(len(chunk) for chunk in iter_clean_submissions(df[i:i + chunksize] for i in range(0, len(df), chunksize)))
+    streamed_time = time.perf_counter() - start
+
+    assert row_by_row.index.equals(vectorized.index), 'row by row and vectorized cleaning keep different submissions'
+    print('{} submissions, {} kept after filtering'.format(number_of_rows, len(vectorized)))
+    print('row by row: {:8.3f}s {:12.0f} rows/s'.format(row_by_row_time, number_of_rows / row_by_row_time))
+    print('vectorized: {:8.3f}s {:12.0f} rows/s'.format(vectorized_time, number_of_rows / vectorized_time))
+    print('streamed:   {:8.3f}s {:12.0f} rows/s ({} rows kept)'.format(streamed_time, number_of_rows / streamed_time, streamed_rows))
+
+if __name__ == "__main__":
+    run_benchmark()
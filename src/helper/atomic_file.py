@@ -0,0 +1,32 @@
+import os
+import json
+import uuid
+
+def write_atomic(filename, text):
+    """ Writes text to filename via a temporary file next to it, so a crash never leaves a broken file behind and
+        readers see either the old or the new content. Missing directories are created.
+    """
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_filename = filename + '.' + uuid.uuid4().hex + '.tmp'
+    try:
+        with open(tmp_filename, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_filename, filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+def write_json(filename, data, indent=None):
+    """ Writes data as JSON (sorted keys) atomically to filename, see write_atomic.
+    """
+    write_atomic(filename, json.dumps(data, sort_keys=True, indent=indent))
+
+def read_json(filename, default=None):
+    """ Returns the JSON content of filename or default if it does not exist.
+    """
+    if not os.path.exists(filename):
+        return default
+    with open(filename, 'r', encoding='utf-8') as f:
+        return json.load(f)
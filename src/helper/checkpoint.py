@@ -0,0 +1,78 @@
+import os
+import datetime
+import threading
+
+from helper.atomic_file import read_json, write_json
+
+def checkpoint_filename(db_filename, name):
+    """ Checkpoints of the tables of db_filename are stored next to it as checkpoints/<name>.json.
+    """
+    return os.path.join(os.path.dirname(db_filename), 'checkpoints', name + '.json')
+
+class Checkpoint:
+    """ Progress of a backfill, persisted as JSON after every update so that a crashed run can resume where it
+        stopped. Per day it keeps the last created_utc stored ('after'), the number of stored entries and whether
+        the day is complete. Additionally the high water mark, i.e. the newest created_utc ever stored, is kept.
+        Every update of a day also stamps it with an increasing sequence number, so consumers of the data (e.g.
+        the rollup) can ask for the days updated since they last looked, see days_updated_since.
+        Thread-safe, all threads working on the same dataset should share one instance.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._state = {'high_water_mark': None, 'sequence': 0, 'days': dict()}
+        self._state.update(read_json(filename, dict()))
+
+    @property
+    def high_water_mark(self):
+        with self._lock:
+            return self._state['high_water_mark']
+
+    def get_day(self, day):
+        """ Returns the progress of day (a 'YYYY-MM-DD' string) as dict with keys after, retrieved and complete.
+        """
+        with self._lock:
+            return dict(self._state['days'].get(day, {'after': None, 'retrieved': 0, 'complete': False}))
+
+    def first_incomplete_day(self, last_day):
+        """ Returns the first day (a 'YYYY-MM-DD' string) from the first checkpointed day up to last_day which is not
+            complete or was never started, None if there is none.
+        """
+        with self._lock:
+            days = self._state['days']
+            if not days:
+                return None
+            day = datetime.date.fromisoformat(min(days))
+            while day.isoformat() <= last_day:
+                if not days.get(day.isoformat(), {}).get('complete', False):
+                    return day.isoformat()
+                day += datetime.timedelta(days=1)
+            return None
+
+    @property
+    def sequence(self):
+        with self._lock:
+            return self._state['sequence']
+
+    def days_updated_since(self, sequence):
+        """ Returns the days (sorted 'YYYY-MM-DD' strings) which were updated after the sequence number sequence.
+        """
+        with self._lock:
+            return sorted(day for day, progress in self._state['days'].items() if progress.get('sequence', 0) > sequence)
+
+    def touch_day(self, day):
+        """ Marks day as updated without changing its progress, e.g. after its entries were stored again.
+        """
+        progress = self.get_day(day)
+        self.update_day(day, after=progress['after'], retrieved=progress['retrieved'], complete=progress['complete'])
+
+    def update_day(self, day, after=None, retrieved=0, complete=False):
+        with self._lock:
+            self._state['sequence'] += 1
+            self._state['days'][day] = {'after': after, 'retrieved': retrieved, 'complete': complete, 'sequence': self._state['sequence']}
+            if after is not None and (self._state['high_water_mark'] is None or after > self._state['high_water_mark']):
+                self._state['high_water_mark'] = after
+            self._save()
+
+    def _save(self):
+        write_json(self.filename, self._state)
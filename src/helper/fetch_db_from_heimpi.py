@@ -1,29 +1,453 @@
+#!/usr/bin/env python3
 import os
-import paramiko
-from scp import SCPClient
-import yaml
+import sys
+import json
+import stat
+import uuid
+import shlex
+import inspect
+import shutil
+import sqlite3
+import hashlib
+import subprocess
+import argparse
+import contextlib
 
-def createSSHClient(server, port, user, password):
+# hacky hack to get relative import
+sys.path.append( os.path.dirname( os.path.dirname(os.path.realpath(__file__)) ) )
+from helper import metrics
+from helper.atomic_file import read_json, write_json
+from helper.storage import quote_identifier
+
+# relative to the home directory of the remote user, that is where SFTP starts
+REMOTE_DATA_DIR = 'Scripts/FinDat/data'
+DATASETS = ['findat.sqlite3']
+MANIFEST_FILENAME = 'data/checkpoints/sync_manifest.json'
+
+# appended bytes are only trusted if the last TAIL_BYTES before the old end of file did not change
+TAIL_BYTES = 64 * 1024
+BLOCK_SIZE = 1024 * 1024
+
+SQLITE_EXTENSIONS = ('.sqlite3', '.sqlite', '.db')
+REMOTE_PYTHON = 'python3'
+
+def table_checksum(con, table, columns, since):
+    """ Order independent checksum of columns of all rows of table with Date < since: the sum of a 64 bit hash of
+        every row. Runs locally and (as part of EXPORT_SCRIPT) on the Pi, so it only uses the standard library.
+    """
+    import hashlib
+    quote = lambda name: '"' + name.replace('"', '""') + '"'
+    sql = 'SELECT {} FROM main.{} WHERE "Date" < ?'.format(', '.join(quote(c) for c in columns), quote(table))
+    checksum = 0
+    for row in con.execute(sql, (since,)):
+        checksum += int.from_bytes(hashlib.blake2b(repr(row).encode('utf-8'), digest_size=8).digest(), 'little')
+    return checksum % 2**64
+
+# runs on the Pi: copies the rows of every table with Date >= since (all rows if since is None or rows before it
+# were added, removed or updated since the last sync, see table_checksum) into a new SQLite file within one read
+# transaction, so the export is consistent even while the nightly jobs write. Prints schema, range and high water
+# mark of every table as JSON.
+EXPORT_SCRIPT = inspect.getsource(table_checksum) + """
+import sys, json, sqlite3
+source, target, marks = sys.argv[1], sys.argv[2], json.loads(sys.argv[3])
+con = sqlite3.connect(source, timeout=60, isolation_level=None)
+con.execute('ATTACH DATABASE ? AS delta', (target,))
+quote = lambda name: '"' + name.replace('"', '""') + '"'
+result = dict()
+con.execute('BEGIN')
+for table, sql in con.execute("SELECT name, sql FROM main.sqlite_master WHERE type = 'table'").fetchall():
+    columns = [row[1] for row in con.execute('PRAGMA main.table_info({})'.format(quote(table)))]
+    indexes = [row[0] for row in con.execute("SELECT sql FROM main.sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", (table,))]
+    mark = marks.get(table) if 'Date' in columns else None
+    since = None
+    if mark is not None and set(mark['columns']) <= set(columns):
+        since = mark['since'] if table_checksum(con, table, mark['columns'], mark['since']) == mark['checksum'] else None
+    where = '' if since is None else ' WHERE "Date" >= ?'
+    con.execute('CREATE TABLE delta.{0} AS SELECT * FROM main.{0}{1}'.format(quote(table), where), () if since is None else (since,))
+    high_water_mark = con.execute('SELECT MAX("Date") FROM main.{}'.format(quote(table))).fetchone()[0] if 'Date' in columns else None
+    result[table] = {'sql': sql, 'indexes': indexes, 'columns': columns, 'since': since, 'high_water_mark': high_water_mark}
+con.execute('COMMIT')
+print(json.dumps(result))
+"""
+
+def createSSHClient(server, port, user, password, compress=True):
+    import paramiko
     client = paramiko.SSHClient()
     client.load_system_host_keys()
     client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    client.connect(server, port, user, password)
+    client.connect(server, port, user, password, compress=compress)
     return client
 
+@contextlib.contextmanager
+def open_session(server_config, credentials):
+    """ One compressed SSH session with one SFTP channel, shared by all datasets of a sync. Yields (ssh, sftp).
+    """
+    ssh = createSSHClient(server_config['ip'], server_config['port'], credentials['user'], credentials['password'])
+    try:
+        sftp = ssh.open_sftp()
+        try:
+            yield ssh, sftp
+        finally:
+            sftp.close()
+    finally:
+        ssh.close()
+
+def _exec(ssh, command):
+    """ Runs command on the remote host, returns its output. Raises RuntimeError if it fails.
+    """
+    stdin, stdout, stderr = ssh.exec_command(command)
+    output = stdout.read()
+    errors = stderr.read()
+    if stdout.channel.recv_exit_status() != 0:
+        raise RuntimeError('Remote command failed: {}'.format(errors.decode('utf-8', 'replace').strip()))
+    return output.decode('utf-8')
+
+class LocalSftp:
+    """ Stand-in for paramiko's SFTPClient which serves a local directory, e.g. to test the sync without a Pi.
+        Only implements what the sync uses.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, path):
+        return os.path.join(self.root, path)
+
+    def stat(self, path):
+        return os.stat(self._path(path))
+
+    def listdir_attr(self, path):
+        result = list()
+        for name in sorted(os.listdir(self._path(path))):
+            attributes = os.stat(os.path.join(self._path(path), name))
+            result.append(_Attributes(name, attributes))
+        return result
+
+    def open(self, path, mode='rb'):
+        return _LocalFile(self._path(path), mode)
+
+    def remove(self, path):
+        os.remove(self._path(path))
+
+    def close(self):
+        pass
+
+class LocalSsh:
+    """ Stand-in for paramiko's SSHClient which runs commands locally in root, see LocalSftp.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def exec_command(self, command):
+        process = subprocess.run(command, shell=True, cwd=self.root, capture_output=True)
+        return None, _LocalOutput(process.stdout, process.returncode), _LocalOutput(process.stderr, process.returncode)
+
+class _LocalOutput:
+    def __init__(self, data, returncode):
+        self._data = data
+        self.channel = self
+        self._returncode = returncode
+
+    def read(self):
+        return self._data
+
+    def recv_exit_status(self):
+        return self._returncode
+
+class _Attributes:
+    def __init__(self, filename, attributes):
+        self.filename = filename
+        self.st_mode = attributes.st_mode
+        self.st_size = attributes.st_size
+        self.st_mtime = attributes.st_mtime
+
+class _LocalFile:
+    def __init__(self, filename, mode):
+        self._file = open(filename, mode)
+
+    def prefetch(self, file_size=None):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._file.close()
+
+class Manifest:
+    """ State of the last sync per dataset, persisted as JSON:
+            append files (CSV):     size (the high water mark in bytes) and sha1 of the TAIL_BYTES before it
+            partitioned (parquet):  size and mtime of every partition file
+            SQLite databases:       high water mark (last Date) and columns of every table
+            other files:            size and mtime
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._state = read_json(filename, dict())
+
+    def get(self, dataset):
+        return self._state.get(dataset)
+
+    def set(self, dataset, entry):
+        self._state[dataset] = entry
+        self._save()
+
+    def _save(self):
+        write_json(self.filename, self._state, indent=1)
+
+def _copy(source, target, length=None):
+    """ Copies length bytes (None = all) from source to target in blocks, returns the number of bytes copied.
+    """
+    copied = 0
+    while length is None or copied < length:
+        block = source.read(BLOCK_SIZE if length is None else min(BLOCK_SIZE, length - copied))
+        if not block:
+            break
+        target.write(block)
+        copied += len(block)
+    return copied
+
+def _download(sftp, remote_path, local_path, size=None):
+    """ Downloads the whole file via a temporary file, so an interrupted download never replaces the local copy.
+    """
+    directory = os.path.dirname(local_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_filename = local_path + '.' + uuid.uuid4().hex + '.tmp'
+    try:
+        with sftp.open(remote_path, 'rb') as remote, open(tmp_filename, 'wb') as local:
+            remote.prefetch(size)
+            copied = _copy(remote, local)
+        os.replace(tmp_filename, local_path)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+    return copied
+
+def _tail_sha1(f, end):
+    f.seek(max(0, end - TAIL_BYTES))
+    return hashlib.sha1(f.read(end - max(0, end - TAIL_BYTES))).hexdigest()
+
+def sync_append_file(sftp, remote_path, local_path, manifest_entry):
+    """ Syncs a file which only grows at its end (CSV): if the local copy is the one of the last sync and the
+        remote file still has the same bytes before the old end, only the new bytes are downloaded. Otherwise
+        the whole file is copied.
+
+    Returns:
+        (dict, int, str): new manifest entry, transferred bytes and 'unchanged', 'append' or 'full'.
+    """
+    remote_size = sftp.stat(remote_path).st_size
+    old_size = manifest_entry['size'] if manifest_entry else None
+    local_ok = old_size is not None and os.path.exists(local_path) and os.path.getsize(local_path) == old_size
+
+    with sftp.open(remote_path, 'rb') as remote:
+        if local_ok and remote_size >= old_size and _tail_sha1(remote, old_size) == manifest_entry['tail_sha1']:
+            if remote_size == old_size:
+                return manifest_entry, 0, 'unchanged'
+            remote.seek(old_size)
+            remote.prefetch(remote_size)
+            with open(local_path, 'ab') as local:
+                transferred = _copy(remote, local, remote_size - old_size)
+            mode = 'append'
+        else:
+            transferred = None
+            mode = 'full'
+
+    if transferred is None:
+        transferred = _download(sftp, remote_path, local_path, remote_size)
+    size = os.path.getsize(local_path)
+    with open(local_path, 'rb') as local:
+        tail_sha1 = _tail_sha1(local, size)
+    return {'type': 'append', 'size': size, 'tail_sha1': tail_sha1}, transferred, mode
+
+def sync_file(sftp, remote_path, local_path, manifest_entry):
+    """ Syncs a file which may change anywhere: it is copied completely if its size or mtime changed.
+    """
+    attributes = sftp.stat(remote_path)
+    entry = {'type': 'file', 'size': attributes.st_size, 'mtime': attributes.st_mtime}
+    if manifest_entry == entry and os.path.exists(local_path):
+        return entry, 0, 'unchanged'
+    return entry, _download(sftp, remote_path, local_path, attributes.st_size), 'full'
+
+def _local_marks(local_path, manifest_entry):
+    """ Per table the high water mark of the last sync and the checksum of the local rows before it, which the
+        export compares with the remote rows to notice rows which were added, removed or updated before the mark
+        (e.g. by the history backfill or a recomputation of the indicators).
+    """
+    if not manifest_entry or not os.path.exists(local_path):
+        return dict()
+    marks = dict()
+    with contextlib.closing(sqlite3.connect(local_path, timeout=60)) as con:
+        tables = set(row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+        for table, mark in manifest_entry['tables'].items():
+            # marks of older versions were only the high water mark, these tables are exported completely once
+            if table in tables and isinstance(mark, dict) and mark['since'] is not None:
+                checksum = table_checksum(con, table, mark['columns'], mark['since'])
+                marks[table] = {'since': mark['since'], 'columns': mark['columns'], 'checksum': checksum}
+    return marks
+
+def merge_sqlite(delta_filename, local_path, tables):
+    """ Merges the exported tables (see EXPORT_SCRIPT) into the local database in one transaction: missing tables
+        are created with the remote schema and indexes, new columns added and the exported range of every table
+        (all rows if since is None) is replaced by the exported rows.
+    """
+    directory = os.path.dirname(local_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with contextlib.closing(sqlite3.connect(local_path, timeout=60)) as con:
+        con.execute('ATTACH DATABASE ? AS delta', (delta_filename,))
+        with con:
+            for table, info in tables.items():
+                local_columns = [row[1] for row in con.execute('PRAGMA main.table_info({})'.format(quote_identifier(table)))]
+                if not local_columns:
+                    con.execute(info['sql'])
+                    for index in info['indexes']:
+                        con.execute(index)
+                else:
+                    for column in info['columns']:
+                        if column not in local_columns:
+                            con.execute('ALTER TABLE main.{} ADD COLUMN {}'.format(quote_identifier(table), quote_identifier(column)))
+                if info['since'] is None:
+                    con.execute('DELETE FROM main.{}'.format(quote_identifier(table)))
+                else:
+                    con.execute('DELETE FROM main.{} WHERE "Date" >= ?'.format(quote_identifier(table)), (info['since'],))
+                columns = ', '.join(quote_identifier(c) for c in info['columns'])
+                con.execute('INSERT INTO main.{0} ({1}) SELECT {1} FROM delta.{0}'.format(quote_identifier(table), columns))
+        con.execute('DETACH DATABASE delta')
+
+def sync_sqlite(ssh, sftp, remote_path, local_path, manifest_entry, python=REMOTE_PYTHON):
+    """ Syncs a SQLite database without copying it: the Pi exports the rows from the high water mark of every
+        table on into a temporary database (see EXPORT_SCRIPT), which is downloaded and merged locally. Tables
+        without Date and tables with changed rows before the mark are exported completely.
+    """
+    remote_delta = remote_path + '.' + uuid.uuid4().hex + '.tmp'
+    marks = _local_marks(local_path, manifest_entry)
+    command = ' '.join(shlex.quote(arg) for arg in [python, '-c', EXPORT_SCRIPT, remote_path, remote_delta, json.dumps(marks)])
+    local_delta = local_path + '.' + uuid.uuid4().hex + '.delta.tmp'
+    try:
+        tables = json.loads(_exec(ssh, command))
+        transferred = _download(sftp, remote_delta, local_delta)
+        merge_sqlite(local_delta, local_path, tables)
+    finally:
+        try:
+            sftp.remove(remote_delta)
+        except (IOError, OSError):
+            pass
+        if os.path.exists(local_delta):
+            os.remove(local_delta)
+    entry = {'type': 'sqlite', 'tables': {table: {'since': info['high_water_mark'], 'columns': info['columns']} for table, info in tables.items()}}
+    complete = sorted(table for table, info in tables.items() if info['since'] is None)
+    if len(complete) == len(tables):
+        mode = 'full'
+    else:
+        mode = 'delta' if not complete else 'delta, complete: ' + ', '.join(complete)
+    return entry, transferred, mode
+
+def _list_files(sftp, remote_path, prefix=''):
+    files = dict()
+    for attributes in sftp.listdir_attr(remote_path):
+        name = prefix + attributes.filename
+        if stat.S_ISDIR(attributes.st_mode):
+            files.update(_list_files(sftp, remote_path + '/' + attributes.filename, name + '/'))
+        elif not attributes.filename.endswith('.tmp'):
+            files[name] = [attributes.st_size, attributes.st_mtime]
+    return files
+
+def sync_partitions(sftp, remote_path, local_path, manifest_entry):
+    """ Syncs a partitioned directory (parquet): only new partition files and those whose size or mtime changed
+        are downloaded, local partitions which were removed remotely are deleted.
+    """
+    remote_files = _list_files(sftp, remote_path)
+    old_files = manifest_entry['files'] if manifest_entry else dict()
+    transferred = 0
+    changed = 0
+    for name, attributes in sorted(remote_files.items()):
+        local_filename = os.path.join(local_path, *name.split('/'))
+        if old_files.get(name) == attributes and os.path.exists(local_filename):
+            continue
+        transferred += _download(sftp, remote_path + '/' + name, local_filename, attributes[0])
+        changed += 1
+    for name in set(old_files) - set(remote_files):
+        local_filename = os.path.join(local_path, *name.split('/'))
+        if os.path.exists(local_filename):
+            os.remove(local_filename)
+            changed += 1
+    mode = 'unchanged' if changed == 0 else '{} partitions'.format(changed)
+    high_water_mark = max(remote_files) if remote_files else None
+    return {'type': 'partitions', 'files': remote_files, 'high_water_mark': high_water_mark}, transferred, mode
+
+def sync_dataset(sftp, dataset, manifest, remote_dir=REMOTE_DATA_DIR, local_dir='data', full=False, ssh=None, python=REMOTE_PYTHON):
+    """ Syncs one dataset (a file or directory name in remote_dir) into local_dir with the matching strategy.
+        SQLite databases need the ssh session to export their changes on the Pi.
+
+    Returns:
+        int: number of transferred bytes.
+    """
+    remote_path = remote_dir + '/' + dataset
+    local_path = os.path.join(local_dir, dataset)
+    entry = None if full else manifest.get(dataset)
+    if full and os.path.isdir(local_path):
+        shutil.rmtree(local_path)
+
+    with metrics.timer('sync', dataset=dataset):
+        if stat.S_ISDIR(sftp.stat(remote_path).st_mode):
+            entry, transferred, mode = sync_partitions(sftp, remote_path, local_path, entry)
+        elif dataset.endswith('.csv'):
+            entry, transferred, mode = sync_append_file(sftp, remote_path, local_path, entry)
+        elif dataset.endswith(SQLITE_EXTENSIONS):
+            if ssh is None:
+                raise ValueError('Syncing the SQLite database {} needs an SSH session'.format(dataset))
+            entry, transferred, mode = sync_sqlite(ssh, sftp, remote_path, local_path, entry, python=python)
+        else:
+            entry, transferred, mode = sync_file(sftp, remote_path, local_path, entry)
+    manifest.set(dataset, entry)
+    metrics.count('sync_bytes', transferred, dataset=dataset)
+    print('{}: {} ({:.1f} kB transferred)'.format(dataset, mode, transferred / 1024))
+    return transferred
+
+def sync(sftp, datasets=DATASETS, remote_dir=REMOTE_DATA_DIR, local_dir='data', manifest_filename=MANIFEST_FILENAME, full=False, ssh=None, python=REMOTE_PYTHON):
+    """ Syncs all datasets over the same SSH session. Returns the total number of transferred bytes.
+    """
+    manifest = Manifest(manifest_filename)
+    return sum(sync_dataset(sftp, dataset, manifest, remote_dir=remote_dir, local_dir=local_dir, full=full, ssh=ssh, python=python) for dataset in datasets)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Fetches new rows and partitions of the datasets on the Pi.')
+    parser.add_argument('--datasets', nargs='+', default=None, help='files or directories in the remote data dir, defaults to datasets in conf/server.yaml or {}'.format(' '.join(DATASETS)))
+    parser.add_argument('--full', action='store_true', help='copy everything again instead of only the changes')
+    parser.add_argument('--local-remote', default=None, metavar='DIR', help='sync from this local directory instead of the Pi (for testing)')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.local_remote:
+        args.local_remote = os.path.abspath(args.local_remote)
 
-# we assume this code is in /src/helper while data is in /data. Sincepip  we do not want to assume a cwd we switch to src and than move one up
-path = os.path.dirname(os.path.realpath(__file__))
-os.chdir(path)
-os.chdir(os.path.pardir)
-os.chdir(os.path.pardir)
+    # we assume this code is in /src/helper while data is in /data. Since we do not want to assume a cwd we switch to src and than move one up
+    path = os.path.dirname(os.path.realpath(__file__))
+    os.chdir(path)
+    os.chdir(os.path.pardir)
+    os.chdir(os.path.pardir)
 
-server_config = yaml.safe_load(open('conf/server.yaml', 'r'))
-credentials = yaml.safe_load(open('conf/credentials.yaml', 'r'))
+    import yaml
+    server_config = dict()
+    if os.path.exists('conf/server.yaml'):
+        with open('conf/server.yaml', 'r') as f:
+            server_config = yaml.safe_load(f)
+    datasets = args.datasets or server_config.get('datasets', DATASETS)
+    remote_dir = server_config.get('data_dir', REMOTE_DATA_DIR)
+    python = server_config.get('python', REMOTE_PYTHON)
 
-ssh = createSSHClient(server_config['ip'], 
-                        server_config['port'], 
-                        credentials['user'], 
-                        credentials['password'])
-scp = SCPClient(ssh.get_transport())
+    if args.local_remote:
+        transferred = sync(LocalSftp(args.local_remote), datasets, remote_dir='.', full=args.full, ssh=LocalSsh(args.local_remote), python=sys.executable)
+    else:
+        with open('conf/credentials.yaml', 'r') as f:
+            credentials = yaml.safe_load(f)
+        with open_session(server_config, credentials) as (ssh, sftp):
+            transferred = sync(sftp, datasets, remote_dir=remote_dir, full=args.full, ssh=ssh, python=python)
+    print('...done. Transferred {:.1f} kB.'.format(transferred / 1024))
 
-scp.get(remote_path='~/Scripts/FinDat/data/database.csv', local_path='data/database.csv')
\ No newline at end of file
+if __name__ == "__main__":
+    main()
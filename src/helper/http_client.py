@@ -0,0 +1,115 @@
+import time
+import threading
+import email.utils
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from helper import metrics
+
+# (connect, read) timeout in seconds for every request
+DEFAULT_TIMEOUT = (10, 60)
+
+# one connection pool per host is kept, each pool keeps up to POOL_MAXSIZE connections alive. This should be at
+# least the number of threads fetching concurrently from the same host
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = 32
+
+# answers which are retried by get, every attempt waits for the limiter again. Retry-After is honored, otherwise
+# attempt n waits BACKOFF_FACTOR * 2**n seconds
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+MAX_ATTEMPTS = 6
+BACKOFF_FACTOR = 1
+MAX_RETRY_AFTER = 120
+
+_adapter = None
+_adapter_lock = threading.Lock()
+_local = threading.local()
+
+def _make_adapter(pool_connections, pool_maxsize):
+    # the adapter only retries failed connects, which never reach the server. Everything else is retried by get so
+    # the retries pass through the rate limiter
+    retries = Retry(total=3, connect=3, read=0, status=0, other=0, backoff_factor=1, raise_on_status=False)
+    return HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retries)
+
+def _get_adapter():
+    global _adapter
+    with _adapter_lock:
+        if _adapter is None:
+            _adapter = _make_adapter(POOL_CONNECTIONS, POOL_MAXSIZE)
+        return _adapter
+
+def configure(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE):
+    """ Replaces the shared connection pools, e.g. to size them for more fetch threads. Has to be called
+        before the first request.
+    """
+    global _adapter
+    with _adapter_lock:
+        _adapter = _make_adapter(pool_connections, pool_maxsize)
+    _local.__dict__.clear()
+
+def get_session():
+    """ Returns the session of the current thread. requests.Session is not thread-safe, so every thread has its
+        own session, but all sessions share one adapter and therefore one set of keep-alive connection pools for
+        http and https.
+    """
+    adapter = _get_adapter()
+    session = getattr(_local, 'session', None)
+    if session is None or getattr(_local, 'adapter', None) is not adapter:
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _local.session = session
+        _local.adapter = adapter
+    return session
+
+def get(url, timeout=DEFAULT_TIMEOUT, limiter=None, **kwargs):
+    """ GET request through the shared connection pools. If a limiter (helper.rate_limiter.TokenBucket) is given
+        every attempt waits for a token first. Answers with a status in RETRY_STATUSES are retried up to
+        MAX_ATTEMPTS times, the last answer is returned.
+    """
+    host = urlsplit(url).netloc
+    for attempt in range(MAX_ATTEMPTS):
+        if limiter is not None:
+            limiter.acquire()
+
+        start = time.perf_counter()
+        try:
+            r = get_session().get(url, timeout=timeout, **kwargs)
+        except requests.RequestException:
+            metrics.observe('http_request', time.perf_counter() - start, failed=True, host=host)
+            raise
+        metrics.observe('http_request', time.perf_counter() - start, failed=r.status_code >= 400, host=host)
+
+        if r.status_code not in RETRY_STATUSES or attempt == MAX_ATTEMPTS - 1:
+            return r
+        metrics.count('http_retries', host=host, status=r.status_code)
+        time.sleep(_retry_delay(r, attempt))
+
+def _retry_delay(r, attempt):
+    """ Seconds to wait before the next attempt: Retry-After (seconds or HTTP date) if given, otherwise backoff.
+    """
+    retry_after = r.headers.get('Retry-After')
+    if retry_after:
+        try:
+            return min(MAX_RETRY_AFTER, max(0.0, float(retry_after)))
+        except ValueError:
+            retry_date = email.utils.parsedate_to_datetime(retry_after)
+            if retry_date is not None:
+                return min(MAX_RETRY_AFTER, max(0.0, retry_date.timestamp() - time.time()))
+    return BACKOFF_FACTOR * 2**attempt
+
+def count_connections():
+    """ Counts the connections opened so far per host (i.e. TCP/TLS handshakes) as metric http_connections, call
+        once at the end of a run. With working keep-alive, they stay far below the http_request count.
+    """
+    if _adapter is None:
+        return
+    pools = _adapter.poolmanager.pools
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is not None:
+            host = pool.host if pool.port in (None, 80, 443) else '{}:{}'.format(pool.host, pool.port)
+            metrics.count('http_connections', pool.num_connections, host=host)
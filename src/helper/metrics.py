@@ -0,0 +1,266 @@
+import os
+import json
+import time
+import logging
+import pstats
+import cProfile
+import threading
+import contextlib
+
+from helper.atomic_file import write_atomic
+
+# timers: (name, labels) -> {'count', 'errors', 'total_seconds', 'max_seconds'}, counters: (name, labels) -> value
+# labels are stored as sorted tuples of (label, value) pairs
+_timers = dict()
+_counters = dict()
+_lock = threading.Lock()
+
+# stages are profiled with cProfile into this directory if set, see enable_profiling
+_profile_directory = os.environ.get('FINDAT_PROFILE_DIR')
+# profilers of the running profiled stage, one per thread, see _Profile
+_profile = None
+_profile_lock = threading.Lock()
+
+logger = logging.getLogger('findat')
+
+def _key(name, labels):
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+def observe(name, seconds, failed=False, **labels):
+    """ Records one timed operation, e.g. a request which took seconds.
+    """
+    with _lock:
+        t = _timers.setdefault(_key(name, labels), {'count': 0, 'errors': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+        t['count'] += 1
+        t['errors'] += int(failed)
+        t['total_seconds'] += seconds
+        t['max_seconds'] = max(t['max_seconds'], seconds)
+
+def count(name, value=1, **labels):
+    """ Increases the counter name, e.g. count('records', 100, endpoint='submission').
+    """
+    with _lock:
+        key = _key(name, labels)
+        _counters[key] = _counters.get(key, 0) + value
+
+class timer(contextlib.ContextDecorator):
+    """ Times a block or, used as decorator, every call of a function. Exceptions are counted as errors and
+        passed on.
+
+            with metrics.timer('storage_insert', backend='sqlite'):
+                ...
+
+            @metrics.timer('sentiment_batch')
+            def score(texts): ...
+    """
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+        self._local = threading.local()
+
+    def __enter__(self):
+        # the same decorator instance may be entered by several threads or recursively
+        starts = getattr(self._local, 'starts', None)
+        if starts is None:
+            starts = self._local.starts = list()
+        starts.append(time.perf_counter())
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self._local.starts.pop()
+        observe(self.name, seconds, failed=exc_type is not None, **self.labels)
+        return False
+
+def log_event(event, **fields):
+    """ Writes one structured (JSON) log line with the event name and fields, see configure_logging.
+    """
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps(dict(event=event, time=time.time(), **fields), default=str))
+
+def configure_logging(filename=None, level=logging.INFO):
+    """ Sends the structured logs of log_event as JSON lines to filename (or stderr).
+    """
+    handler = logging.FileHandler(filename, encoding='utf-8') if filename else logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    return handler
+
+def enable_profiling(directory):
+    """ Profiles every outermost stage with cProfile, the stats are written to <directory>/<stage>.prof
+        (e.g. for python -m pstats or snakeviz). None disables profiling.
+    """
+    global _profile_directory
+    _profile_directory = directory
+
+class _Profile:
+    """ cProfile only sees the thread which enabled it, so every thread started while the stage runs (e.g. the
+        fetch workers) gets its own profiler via threading.setprofile. The stats of all of them are merged.
+    """
+    def __init__(self):
+        self._profilers = list()
+        self._lock = threading.Lock()
+
+    def _add_profiler(self):
+        profiler = cProfile.Profile()
+        with self._lock:
+            self._profilers.append(profiler)
+        profiler.enable()
+
+    def _start_thread(self, frame, event, arg):
+        # called by the first profiling event of a new thread, the profiler replaces this function
+        self._add_profiler()
+
+    def start(self):
+        threading.setprofile(self._start_thread)
+        self._add_profiler()
+
+    def dump(self, filename):
+        threading.setprofile(None)
+        with self._lock:
+            profilers = list(self._profilers)
+        # the own profiler last, the others stop it while collecting their stats
+        profilers[0].disable()
+        stats = None
+        for profiler in profilers[1:] + profilers[:1]:
+            profiler.create_stats()
+            if not profiler.stats:
+                continue
+            if stats is None:
+                stats = pstats.Stats(profiler)
+            else:
+                stats.add(profiler)
+        if stats is not None:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            stats.dump_stats(filename)
+
+@contextlib.contextmanager
+def stage(name):
+    """ Times a whole stage of a run (e.g. fetching all submissions), logs its start and end and profiles it if
+        profiling is enabled. Stages started while a profiled stage runs (nested ones or those on other threads)
+        are part of its profile.
+    """
+    global _profile
+    log_event('stage_started', stage=name)
+    profile = None
+    if _profile_directory:
+        with _profile_lock:
+            if _profile is None:
+                profile = _profile = _Profile()
+        if profile is not None:
+            profile.start()
+    start = time.perf_counter()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        seconds = time.perf_counter() - start
+        if profile is not None:
+            try:
+                profile.dump(os.path.join(_profile_directory, name + '.prof'))
+            finally:
+                with _profile_lock:
+                    _profile = None
+        observe('stage', seconds, failed=failed, stage=name)
+        log_event('stage_finished', stage=name, seconds=seconds, failed=failed)
+
+def snapshot():
+    """ Returns a copy of all timers and counters as {'timers': {...}, 'counters': {...}} keyed by
+        'name{label=value,...}'.
+    """
+    with _lock:
+        return {'timers': {_format_key(key): dict(t) for key, t in _timers.items()},
+                'counters': {_format_key(key): value for key, value in _counters.items()}}
+
+def reset():
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+
+def print_summary():
+    with _lock:
+        timers = sorted(_timers.items())
+        counters = sorted(_counters.items())
+    for key, t in timers:
+        print('{:<60} {:8d} calls {:5d} errors {:10.3f}s total {:8.4f}s mean {:8.3f}s max'.format(
+            _format_key(key), t['count'], t['errors'], t['total_seconds'], t['total_seconds'] / t['count'], t['max_seconds']))
+    for key, value in counters:
+        print('{:<60} {:8d}'.format(_format_key(key), value))
+
+def _format_key(key, quote=False):
+    name, labels = key
+    if not labels:
+        return name
+    return name + '{' + ','.join('{}={}'.format(k, '"{}"'.format(v.replace('\\', '\\\\').replace('"', '\\"')) if quote else v) for k, v in labels) + '}'
+
+def to_prometheus_text(prefix='findat_'):
+    """ Returns all metrics in the Prometheus text exposition format, timers as summaries <name>_seconds plus
+        <name>_errors_total and <name>_seconds_max, counters as <name>_total.
+    """
+    with _lock:
+        timers = sorted(_timers.items())
+        counters = sorted(_counters.items())
+
+    lines = list()
+    for name in sorted(set(key[0] for key, _ in timers)):
+        metric = prefix + name
+        lines.append('# TYPE {}_seconds summary'.format(metric))
+        for key, t in timers:
+            if key[0] == name:
+                lines.append('{} {}'.format(_format_key((metric + '_seconds_count', key[1]), quote=True), t['count']))
+                lines.append('{} {}'.format(_format_key((metric + '_seconds_sum', key[1]), quote=True), t['total_seconds']))
+        lines.append('# TYPE {}_seconds_max gauge'.format(metric))
+        lines += ['{} {}'.format(_format_key((metric + '_seconds_max', key[1]), quote=True), t['max_seconds']) for key, t in timers if key[0] == name]
+        lines.append('# TYPE {}_errors_total counter'.format(metric))
+        lines += ['{} {}'.format(_format_key((metric + '_errors_total', key[1]), quote=True), t['errors']) for key, t in timers if key[0] == name]
+    for name in sorted(set(key[0] for key, _ in counters)):
+        metric = prefix + name + '_total'
+        lines.append('# TYPE {} counter'.format(metric))
+        lines += ['{} {}'.format(_format_key((metric, key[1]), quote=True), value) for key, value in counters if key[0] == name]
+    return '\n'.join(lines) + '\n'
+
+def write_prometheus_file(filename):
+    """ Writes to_prometheus_text() atomically to filename, e.g. for the textfile collector of node_exporter.
+    """
+    write_atomic(filename, to_prometheus_text())
+
+def start_prometheus_server(port=8000):
+    """ Serves the metrics on http://localhost:<port>/metrics, needs the optional prometheus_client package.
+    """
+    from prometheus_client import start_http_server
+    from prometheus_client.core import REGISTRY
+    from prometheus_client.parser import text_string_to_metric_families
+
+    class Collector:
+        def collect(self):
+            return text_string_to_metric_families(to_prometheus_text())
+
+    REGISTRY.register(Collector())
+    start_http_server(port)
+
+def add_arguments(parser):
+    """ Adds --metrics-file, --log-file and --profile-dir to an argparse parser, see apply_arguments.
+    """
+    parser.add_argument('--metrics-file', default=None, help='write run metrics in Prometheus text format to this file')
+    parser.add_argument('--log-file', default=None, help='write structured (JSON lines) logs to this file')
+    parser.add_argument('--profile-dir', default=None, help='profile every stage with cProfile into this directory')
+
+def apply_arguments(args):
+    """ Applies the arguments of add_arguments. Call before changing the working directory, relative paths are
+        resolved against the current one.
+    """
+    for name in ['metrics_file', 'log_file', 'profile_dir']:
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+    if args.log_file:
+        configure_logging(args.log_file)
+    if args.profile_dir:
+        enable_profiling(args.profile_dir)
+
+def finish(args):
+    """ Prints the summary of the run and writes the metrics file if requested.
+    """
+    print_summary()
+    if args.metrics_file:
+        write_prometheus_file(args.metrics_file)
@@ -0,0 +1,39 @@
+import os
+import sys
+import argparse
+
+import pandas as pd
+
+# hacky hack to get relative import
+sys.path.append( os.path.dirname( os.path.dirname(os.path.realpath(__file__)) ) )
+from helper.storage import open_storage
+
+def migrate_csv(csv_filename, target_filename, table=None, key=None, chunksize=100000):
+    """ Copies an existing semicolon separated CSV file into another storage, chunk by chunk so that even
+        multi-GB submission files do not need to fit into memory.
+
+    Returns:
+        int: number of migrated rows.
+    """
+    storage = open_storage(target_filename, table=table, key=key)
+    number_of_rows = 0
+    for chunk in pd.read_csv(csv_filename, sep=';', decimal='.', encoding='utf-8', parse_dates=['Date'], chunksize=chunksize):
+        storage.insert(chunk)
+        number_of_rows += len(chunk)
+        print('...migrated {} rows...'.format(number_of_rows))
+    return number_of_rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='One-off migration of a CSV database into SQLite or Parquet.')
+    parser.add_argument('csv_filename', help='e.g. data/reddit_wallstreetbets_submissions_2018-2021.csv')
+    parser.add_argument('target_filename', help='e.g. data/findat.sqlite3 or data/findat.parquet')
+    parser.add_argument('--table', default=None, help='e.g. reddit_wallstreetbets_submissions or kpi')
+    parser.add_argument('--key', default=None, help='unique key column, e.g. id or Date')
+    parser.add_argument('--chunksize', type=int, default=100000)
+    args = parser.parse_args(argv)
+
+    number_of_rows = migrate_csv(args.csv_filename, args.target_filename, table=args.table, key=args.key, chunksize=args.chunksize)
+    print('...done. Migrated {} rows from {} to {}.'.format(number_of_rows, args.csv_filename, args.target_filename))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import pandas as pd
+
+from helper import metrics
+from helper.storage import open_storage
+from helper.atomic_file import read_json, write_json
+
+class Stage:
+    """ One step of a Pipeline. func is called without arguments. inputs and outputs are names of datasets
+        (see Pipeline.dataset): a stage runs after all stages producing its inputs. Stages without inputs (the
+        fetchers) always run, the others are skipped if their inputs did not change since their last successful run.
+    """
+    def __init__(self, name, func, inputs=(), outputs=()):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+
+class Pipeline:
+    """ Runs stages in dependency order in one process, independent stages at the same time on threads (the
+        stages themselves are I/O bound or start their own process pools). The input fingerprints of every
+        successful stage are kept in state_filename.
+    """
+    def __init__(self, state_filename=None, max_workers=4):
+        self.state_filename = state_filename
+        self.max_workers = max_workers
+        self.stages = list()
+        self.datasets = dict()
+        self._state = dict()
+        self._lock = threading.Lock()
+        if state_filename:
+            self._state = read_json(state_filename, dict())
+
+    def dataset(self, name, fingerprint):
+        """ Declares the dataset name, fingerprint is a function returning a JSON serializable value which changes
+            whenever the data changes, e.g. table_fingerprint.
+        """
+        self.datasets[name] = fingerprint
+
+    def stage(self, name, func, inputs=(), outputs=()):
+        for dataset in list(inputs) + list(outputs):
+            if dataset not in self.datasets:
+                raise ValueError('Stage {} uses the undeclared dataset {}'.format(name, dataset))
+        stage = Stage(name, func, inputs, outputs)
+        self.stages.append(stage)
+        return stage
+
+    def dependencies(self, stage):
+        """ Names of the stages which produce the inputs of stage.
+        """
+        return [s.name for s in self.stages if s is not stage and set(s.outputs) & set(stage.inputs)]
+
+    def _fingerprints(self, stage):
+        return {dataset: self.datasets[dataset]() for dataset in stage.inputs}
+
+    def _save_state(self):
+        write_json(self.state_filename, self._state, indent=1)
+
+    def _run_stage(self, stage, force):
+        """ Returns (status, seconds) with status 'done' or 'skipped', exceptions are passed on.
+        """
+        fingerprints = self._fingerprints(stage) if stage.inputs else None
+        with self._lock:
+            last = self._state.get(stage.name)
+        if not force and stage.inputs and last == fingerprints:
+            metrics.log_event('stage_skipped', stage=stage.name)
+            return 'skipped', 0.0
+
+        start = time.perf_counter()
+        with metrics.stage(stage.name):
+            stage.func()
+        seconds = time.perf_counter() - start
+
+        if stage.inputs and self.state_filename:
+            with self._lock:
+                self._state[stage.name] = fingerprints
+                self._save_state()
+        return 'done', seconds
+
+    def run(self, force=False, skip=()):
+        """ Runs all stages except those in skip (their outputs are taken as they are). A failed stage does not
+            stop independent stages, but the ones depending on it are not run.
+
+        Returns:
+            dict: stage name -> (status, seconds), status is 'done', 'skipped', 'failed', 'upstream failed' or
+                  'not run'.
+        """
+        results = {name: ('not run', 0.0) for name in skip}
+        pending = [s for s in self.stages if s.name not in skip]
+        running = dict()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for stage in self._ready(pending, running):
+                    pending.remove(stage)
+                    if any(results[d][0] in ['failed', 'upstream failed'] for d in self.dependencies(stage)):
+                        results[stage.name] = ('upstream failed', 0.0)
+                        continue
+                    print('Starting stage {}...'.format(stage.name))
+                    running[stage.name] = executor.submit(self._run_stage, stage, force)
+                if not running:
+                    if pending:
+                        raise ValueError('Cyclic dependencies between the stages {}'.format(', '.join(s.name for s in pending)))
+                    break
+
+                done, _ = wait(running.values(), return_when=FIRST_COMPLETED)
+                for name, future in list(running.items()):
+                    if future in done:
+                        del running[name]
+                        try:
+                            results[name] = future.result()
+                        except Exception as e:
+                            metrics.log_event('stage_failed', stage=name, error=type(e).__name__, message=str(e))
+                            print('ERROR: stage {} failed with {}: {}'.format(name, type(e).__name__, e))
+                            results[name] = ('failed', 0.0)
+                        print('...stage {} {} after {:.1f}s.'.format(name, results[name][0], results[name][1]))
+        return results
+
+    def _ready(self, pending, running):
+        """ Yields the pending stages whose dependencies are finished, re-checking after every stage since it may
+            be finished right away (upstream failed).
+        """
+        found = True
+        while found:
+            found = False
+            for stage in list(pending):
+                if stage in pending and not any(d in running or d in [s.name for s in pending] for d in self.dependencies(stage)):
+                    found = True
+                    yield stage
+
+    def critical_path(self, results):
+        """ Returns (seconds, stage names) of the longest chain of dependent stages, i.e. the least time a run
+            with results could take.
+        """
+        longest = dict()
+        for stage in self._topological_order():
+            seconds, path = max([longest[d] for d in self.dependencies(stage)], default=(0.0, []), key=lambda x: x[0])
+            longest[stage.name] = (seconds + results.get(stage.name, ('', 0.0))[1], path + [stage.name])
+        return max(longest.values(), default=(0.0, []), key=lambda x: x[0])
+
+    def _topological_order(self):
+        order, names = list(), set()
+        while len(order) < len(self.stages):
+            ready = [s for s in self.stages if s.name not in names and all(d in names for d in self.dependencies(s))]
+            if not ready:
+                raise ValueError('Cyclic dependencies between the stages')
+            order += ready
+            names.update(s.name for s in ready)
+        return order
+
+    def print_report(self, results, seconds):
+        for stage in self._topological_order():
+            status, stage_seconds = results.get(stage.name, ('not run', 0.0))
+            print('{:<24} {:<16} {:8.1f}s   after {}'.format(stage.name, status, stage_seconds, ', '.join(self.dependencies(stage)) or '-'))
+        critical_seconds, path = self.critical_path(results)
+        print('Finished in {:.1f}s, sum of all stages {:.1f}s, critical path {:.1f}s ({}).'.format(
+            seconds, sum(s for _, s in results.values()), critical_seconds, ' -> '.join(path)))
+
+def table_fingerprint(filename, table, content=False):
+    """ Fingerprint of a stored table for Pipeline.dataset: a hash of the number of rows per Date (cheap, but misses
+        updated rows) or with content=True of all rows (for small tables like the KPIs).
+    """
+    storage = open_storage(filename, table=table)
+    data = storage.read() if content else storage.count_per_date().reset_index()
+    if len(data) == 0:
+        return None
+    return hashlib.sha1(pd.util.hash_pandas_object(data, index=False).values.tobytes()).hexdigest()
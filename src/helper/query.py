@@ -0,0 +1,112 @@
+import pandas as pd
+
+from helper.storage import open_storage
+
+# pyarrow backed strings need a fraction of the memory of python string objects
+try:
+    import pyarrow
+    STRING_DTYPE = pd.StringDtype('pyarrow')
+except ImportError:
+    STRING_DTYPE = pd.StringDtype()
+
+# compact dtypes of the submission and comment columns, other columns keep their dtype
+COMPACT_DTYPES = {
+    'Score': 'int32',
+    'Comments': 'int32',
+    'Created': 'int64',
+    'Title': STRING_DTYPE,
+    'Text': STRING_DTYPE,
+    'Body': STRING_DTYPE,
+    'Author': STRING_DTYPE,
+    'id': STRING_DTYPE,
+    'link_id': STRING_DTYPE,
+}
+
+def submission_table(subreddit, kind='submissions'):
+    return 'reddit_{}_{}'.format(subreddit, kind)
+
+def compact_dtypes(data, subreddits=None):
+    """ Converts the columns of data to COMPACT_DTYPES, Date to datetime64 and Subreddit to a categorical with the
+        categories subreddits (so chunks of different subreddits can be concatenated without object columns).
+    """
+    data = data.copy()
+    for column, dtype in COMPACT_DTYPES.items():
+        if column in data.columns:
+            if pd.api.types.is_integer_dtype(dtype):
+                data[column] = data[column].fillna(0)
+            data[column] = data[column].astype(dtype)
+    if 'Date' in data.columns:
+        data['Date'] = pd.to_datetime(data['Date'])
+    if 'Subreddit' in data.columns:
+        data['Subreddit'] = pd.Categorical(data['Subreddit'], categories=subreddits)
+    return data
+
+def iter_submissions(db_filename, subreddits, start=None, end=None, columns=None, chunksize=100000, kind='submissions'):
+    """ Yields the stored submissions (or comments with kind='comments') of all subreddits with start <= Date < end
+        in chunks of at most chunksize rows with compact dtypes and a categorical column Subreddit. Only columns
+        are read (None = all), date filters are pushed down to the store (see Storage.iter_chunks).
+    """
+    subreddits = [subreddits] if isinstance(subreddits, str) else list(subreddits)
+    if columns is not None:
+        columns = [c for c in columns if c != 'Subreddit']
+    for subreddit in subreddits:
+        storage = open_storage(db_filename, table=submission_table(subreddit, kind))
+        for chunk in storage.iter_chunks(start=start, end=end, columns=columns, chunksize=chunksize):
+            yield compact_dtypes(chunk.assign(Subreddit=subreddit), subreddits)
+
+def read_range(filename, table=None, start=None, end=None, columns=None):
+    """ Returns the rows of table with start <= Date < end (both optional), see Storage.iter_chunks.
+    """
+    chunks = list(open_storage(filename, table=table).iter_chunks(start=start, end=end, columns=columns))
+    if len(chunks) == 0:
+        return pd.DataFrame(columns=columns or [])
+    return pd.concat(chunks, ignore_index=True)
+
+def read_submissions(db_filename, subreddits, start=None, end=None, columns=None, kind='submissions'):
+    """ Like iter_submissions, but returns one DataFrame. Only use for ranges which fit into memory.
+    """
+    chunks = list(iter_submissions(db_filename, subreddits, start=start, end=end, columns=columns, kind=kind))
+    if len(chunks) == 0:
+        return pd.DataFrame(columns=(columns or []) + ['Subreddit'])
+    return pd.concat(chunks, ignore_index=True)
+
+def aggregate_daily(chunks, sums=(), counts=('id',), means=(), by=('Subreddit', 'Date'), transform=None):
+    """ Aggregates chunks (e.g. of iter_submissions) per by-group in constant memory: only one chunk and one row
+        per group are held at a time. sums are summed up, counts counted (non-null values) and means computed
+        exactly from sums and counts of every chunk. transform (e.g. text_cleaning.filter_removed) is applied to
+        every chunk first.
+
+        Result columns are <column>_sum, <column>_count and <column>_mean.
+    """
+    by = list(by)
+    partials = list()
+    for chunk in chunks:
+        if transform is not None:
+            chunk = transform(chunk)
+        if len(chunk) == 0:
+            continue
+        groups = chunk.groupby(by, observed=True)
+        partial = pd.DataFrame(index=groups.size().index)
+        for column in list(sums) + list(means):
+            partial[column + '_sum'] = groups[column].sum(min_count=1).astype('float64')
+        for column in list(counts) + list(means):
+            partial[column + '_count'] = groups[column].count()
+        # keep the partial results small by folding them together regularly
+        partials.append(partial)
+        if len(partials) >= 16:
+            partials = [_combine(partials, by)]
+
+    if len(partials) == 0:
+        return pd.DataFrame(columns=by)
+    result = _combine(partials, by)
+    for column in means:
+        result[column + '_mean'] = result[column + '_sum'] / result[column + '_count']
+        if column not in sums:
+            result = result.drop(columns=column + '_sum')
+    for column in means:
+        if column not in counts:
+            result = result.drop(columns=column + '_count')
+    return result.reset_index()
+
+def _combine(partials, by):
+    return pd.concat(partials).groupby(level=list(range(len(by))), observed=True).sum(min_count=1)
@@ -0,0 +1,37 @@
+import time
+import threading
+
+class TokenBucket:
+    """ Thread-safe token bucket. Every HTTP request takes one token, tokens are refilled with rate per second
+        up to capacity (the allowed burst). Callers which find the bucket empty reserve their token and sleep
+        until it is available, so concurrent callers are served in order.
+    """
+    def __init__(self, rate, capacity=1):
+        if rate <= 0 or capacity <= 0:
+            raise ValueError('rate and capacity need to be positive!')
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """ Blocks until tokens are available. Returns the time waited in seconds.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+            self._tokens -= tokens
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def set_rate(self, rate, capacity=None):
+        with self._lock:
+            self.rate = float(rate)
+            if capacity is not None:
+                self.capacity = float(capacity)
+                self._tokens = min(self._tokens, self.capacity)
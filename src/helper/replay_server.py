@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import collections
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# hacky hack to get relative import
+sys.path.append( os.path.dirname( os.path.dirname(os.path.realpath(__file__)) ) )
+
+class ReplayServer:
+    """ Local stand-in for pushshift, the yahoo quote api and the CBOE and CNN pages, so the fetchers can be run
+        and measured offline. Point them to base_url via FINDAT_PUSHSHIFT_URL, FINDAT_YAHOO_URL, FINDAT_CBOE_URL
+        and FINDAT_CNN_URL (or the module constants).
+
+        Submissions are synthetic: posts_per_day per subreddit, evenly spread over the day, each with
+        comments_per_submission comments. They are computed from the requested time range, so any volume can be
+        served without holding it in memory. recordings maps a path (e.g. '/data/fear-and-greed/') to a file
+        whose content is served instead, e.g. a recorded page.
+
+        Faults: every response is delayed by latency plus up to jitter seconds, error_rate of the requests fail
+        with a 5xx, throttle_rate of them with a 429 and more than max_requests_per_second requests per second
+        (0 = unlimited) are answered with 429 as well, like pushshift does.
+    """
+    def __init__(self, host='127.0.0.1', port=0, posts_per_day=1000, comments_per_submission=20, latency=0.0,
+                 jitter=0.0, error_rate=0.0, throttle_rate=0.0, max_requests_per_second=0, recordings=None, seed=42):
+        self.posts_per_day = posts_per_day
+        self.comments_per_submission = comments_per_submission
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.max_requests_per_second = max_requests_per_second
+        self.recordings = {path.rstrip('/'): filename for path, filename in (recordings or dict()).items()}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._recent_requests = collections.deque()
+        self.requests = collections.Counter()
+        self.statuses = collections.Counter()
+        self.records = 0
+        self._server = ThreadingHTTPServer((host, port), _make_handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stats(self):
+        with self._lock:
+            return {'requests': dict(self.requests), 'statuses': dict(self.statuses), 'records': self.records}
+
+    def reset_stats(self):
+        with self._lock:
+            self.requests.clear()
+            self.statuses.clear()
+            self.records = 0
+
+    def handle(self, path, query):
+        """ Returns (status, content type, body, number of records) of the response to path with the parsed query string.
+        """
+        if path in self.recordings:
+            with open(self.recordings[path], 'rb') as f:
+                return 200, _content_type(self.recordings[path]), f.read(), 0
+
+        routes = {
+            '/reddit/search/submission': self._submissions,
+            '/reddit/submission/search': self._submissions,
+            '/reddit/search/comment': self._comments,
+            '/reddit/comment/search': self._comments,
+            '/v7/finance/quote': self._quotes,
+            '/us/options/market_statistics/daily': self._cboe_page,
+            '/data/fear-and-greed': self._cnn_page,
+        }
+        route = routes.get(path.rstrip('/'))
+        if route is None:
+            return 404, 'text/plain', b'not found', 0
+        return route(query)
+
+    def _fault(self):
+        """ Returns the status code of an injected fault or None.
+        """
+        with self._lock:
+            if self.max_requests_per_second:
+                now = time.monotonic()
+                while self._recent_requests and self._recent_requests[0] <= now - 1:
+                    self._recent_requests.popleft()
+                if len(self._recent_requests) >= self.max_requests_per_second:
+                    return 429
+                self._recent_requests.append(now)
+            draw = self._random.random()
+        if draw < self.error_rate:
+            return self._random.choice([500, 502, 503, 504])
+        if draw < self.error_rate + self.throttle_rate:
+            return 429
+        return None
+
+    def _record(self, path, status, records=0):
+        with self._lock:
+            self.requests[path] += 1
+            self.statuses[status] += 1
+            self.records += records
+
+    # synthetic pushshift data: submission k is created at _time(k), comment j of submission k at _comment_time(k, j)
+
+    def _time(self, k):
+        return k * 86400 // self.posts_per_day
+
+    def _first_after(self, timestamp):
+        """ Index of the first submission created after timestamp.
+        """
+        k = max(0, (timestamp * self.posts_per_day) // 86400 - 1)
+        while self._time(k) <= timestamp:
+            k += 1
+        return k
+
+    def _comment_time(self, k, j):
+        return self._time(k) + j * (self._time(k + 1) - self._time(k)) // self.comments_per_submission
+
+    def _submission(self, subreddit, k):
+        return {'id': '{:x}'.format(k), 'subreddit': subreddit, 'created_utc': self._time(k), 'author': 'user{}'.format(k % 97),
+                'title': 'Synthetic submission {} about $GME and Apple'.format(k),
+                'selftext': 'Diamond hands, to the moon! Post {} of /r/{}.'.format(k, subreddit),
+                'num_comments': self.comments_per_submission, 'score': k % 1000}
+
+    def _comment(self, subreddit, k, j):
+        return {'id': '{:x}c{}'.format(k, j), 'link_id': 't3_{:x}'.format(k), 'subreddit': subreddit, 'created_utc': self._comment_time(k, j),
+                'author': 'user{}'.format((k + j) % 97), 'body': 'Comment {} on {}, buy the dip.'.format(j, k), 'score': j}
+
+    def _submissions(self, query):
+        subreddit = query.get('subreddit', 'all')
+        after, before, size = _range(query)
+        first, end = self._first_after(after), self._first_after(before - 1)
+        if query.get('metadata') == 'true':
+            return _json({'data': [], 'metadata': {'total_results': end - first}})
+        entries = [self._submission(subreddit, k) for k in range(first, min(end, first + size))]
+        return _json({'data': entries}, records=len(entries))
+
+    def _comments(self, query):
+        subreddit = query.get('subreddit', 'all')
+        after, before, size = _range(query)
+        if 'link_id' in query:
+            k = int(query['link_id'].replace('t3_', ''), 16)
+            candidates = ((k, j) for j in range(self.comments_per_submission))
+        else:
+            if query.get('metadata') == 'true':
+                first, end = self._first_after(after), self._first_after(before - 1)
+                return _json({'data': [], 'metadata': {'total_results': (end - first) * self.comments_per_submission}})
+            # comments of the submission before after may still be younger than after
+            candidates = ((k, j) for k in range(max(0, self._first_after(after) - 1), self._first_after(before - 1)) for j in range(self.comments_per_submission))
+        entries = list()
+        for k, j in candidates:
+            created = self._comment_time(k, j)
+            if created <= after:
+                continue
+            if created >= before or len(entries) >= size:
+                break
+            entries.append(self._comment(subreddit, k, j))
+        return _json({'data': entries}, records=len(entries))
+
+    def _quotes(self, query):
+        symbols = query.get('symbols', '').split(',')
+        result = [{'symbol': symbol, 'regularMarketPreviousClose': 100.0 + i} for i, symbol in enumerate(symbols) if symbol]
+        return _json({'quoteResponse': {'result': result}}, records=len(result))
+
+    def _cboe_page(self, query):
+        from kpi.fetch_new_data import PUT_CALL_RATIOS
+        rows = ''.join('<tr><td>{}</td><td>{:.2f}</td></tr>'.format(name, 0.5 + 0.1 * i) for i, name in enumerate(PUT_CALL_RATIOS.values()))
+        return 200, 'text/html', '<html><body><table><tr><th>Name</th><th>Ratio</th></tr>{}</table></body></html>'.format(rows).encode('utf-8'), len(PUT_CALL_RATIOS)
+
+    def _cnn_page(self, query):
+        return 200, 'text/html', b'<html><body><ul><li>Greed Now: 55 (Greed)</li></ul></body></html>', 1
+
+def _range(query):
+    after = int(query.get('after', 0))
+    before = int(query.get('before', 2**40))
+    size = min(int(query.get('size', query.get('limit', 25))), 100)
+    return after, before, size
+
+def _json(data, records=0):
+    return 200, 'application/json', json.dumps(data).encode('utf-8'), records
+
+def _content_type(filename):
+    return 'application/json' if filename.endswith('.json') else 'text/html'
+
+def _make_handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            path = url.path.rstrip('/') or '/'
+            query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+            delay = server.latency + (server._random.random() * server.jitter if server.jitter else 0)
+            if delay > 0:
+                time.sleep(delay)
+
+            fault = server._fault()
+            if fault is not None:
+                status, content_type, body, records = fault, 'text/plain', b'injected fault', 0
+            else:
+                status, content_type, body, records = server.handle(path, query)
+            server._record(path, status, records)
+
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            if status == 429:
+                self.send_header('Retry-After', '1')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Serves synthetic pushshift, yahoo, CBOE and CNN responses for offline runs.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--posts-per-day', type=int, default=1000)
+    parser.add_argument('--comments-per-submission', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds every response is delayed')
+    parser.add_argument('--jitter', type=float, default=0.0, help='additional random delay of up to this many seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with a 5xx')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of requests answered with a 429')
+    parser.add_argument('--max-rps', type=int, default=0, help='requests per second above which 429 is returned (0 = unlimited)')
+    parser.add_argument('--record', nargs='*', default=[], metavar='PATH=FILE', help='serve the content of FILE for PATH, e.g. /data/fear-and-greed=cnn.html')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    recordings = dict(item.split('=', 1) for item in args.record)
+    server = ReplayServer(args.host, args.port, posts_per_day=args.posts_per_day, comments_per_submission=args.comments_per_submission,
+                          latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                          max_requests_per_second=args.max_rps, recordings=recordings)
+    print('Serving on {}, e.g. FINDAT_PUSHSHIFT_URL={}'.format(server.base_url, server.base_url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+
+from helper import metrics
+
+# column layouts of the result DataFrames: column name -> (pushshift key, dtype, default value)
+# a key of None means the column is constant for the whole result and is passed to the builder
+SUBMISSION_COLUMNS = {
+    'Date': (None, 'datetime64[ns]', None),
+    'Title': ('title', str, ''),
+    'Text': ('selftext', str, ''),
+    'Comments': ('num_comments', 'int64', 0),
+    'Score': ('score', 'int64', 0),
+    'id': ('id', str, ''),
+}
+
+COMMENT_COLUMNS = {
+    'Body': ('body', str, ''),
+}
+
+# full comment records as stored by the comment stream, Created is the unix timestamp of the comment
+COMMENT_RECORD_COLUMNS = {
+    'Date': (None, 'datetime64[ns]', None),
+    'Body': ('body', str, ''),
+    'Score': ('score', 'int64', 0),
+    'Created': ('created_utc', 'int64', 0),
+    'Author': ('author', str, ''),
+    'id': ('id', str, ''),
+    'link_id': ('link_id', str, ''),
+}
+
+class ResultBuilder:
+    """ Collects pushshift entries page by page into typed column arrays and builds a single DataFrame
+        at the end. This avoids copying the whole frame for every appended row.
+    """
+    def __init__(self, columns=SUBMISSION_COLUMNS, **constants):
+        self.columns = columns
+        self.constants = constants
+        self._chunks = {name: [] for name in columns}
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def add_page(self, entries):
+        """ Converts one page (list of dicts as returned by pushshift) into column arrays.
+        """
+        if len(entries) == 0:
+            return
+
+        for name, (key, dtype, default) in self.columns.items():
+            if key is None:
+                values = np.full(len(entries), self._constant(name, dtype), dtype=dtype)
+            elif dtype is str:
+                values = np.array([str(default if entry.get(key) is None else entry[key]) for entry in entries], dtype=object)
+            else:
+                values = np.array([default if entry.get(key) is None else entry[key] for entry in entries], dtype=dtype)
+            self._chunks[name].append(values)
+        self._length += len(entries)
+
+    @metrics.timer('build_dataframe')
+    def to_df(self):
+        """ Returns all collected entries as one DataFrame.
+        """
+        metrics.count('built_rows', self._length)
+        return pd.DataFrame({name: self._column(name) for name in self.columns})
+
+    def _column(self, name):
+        chunks = self._chunks[name]
+        if len(chunks) == 0:
+            dtype = self.columns[name][1]
+            return np.array([], dtype=object if dtype is str else dtype)
+        return np.concatenate(chunks)
+
+    def _constant(self, name, dtype):
+        value = self.constants[name]
+        if np.dtype(dtype).kind == 'M':
+            return pd.to_datetime(value).to_datetime64()
+        return value
@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+class ResultCache:
+    """ Two tier cache for analysis results keyed by a hash of the input text and a version string (e.g. of the
+        lexicon or model), so results are recomputed automatically whenever the version changes.
+        The first tier is an in-memory LRU with at most max_memory_items entries, the second tier a table in a
+        SQLite file which is kept below max_disk_bytes by evicting the least recently used entries.
+        Values need to be JSON serializable. Thread-safe.
+    """
+    def __init__(self, filename, table, version, max_memory_items=100000, max_disk_bytes=512 * 1024**2):
+        self.filename = filename
+        self.table = table
+        self.version = version
+        self.max_memory_items = max_memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._con = None
+        self._disk_bytes = 0
+
+    def key(self, text):
+        return hashlib.sha1((self.version + '\0' + text).encode('utf-8')).hexdigest()
+
+    def get_many(self, keys):
+        """ Returns a dict key -> value for all keys found in the cache.
+        """
+        result = dict()
+        with self._lock:
+            missing = list()
+            for key in dict.fromkeys(keys):
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    result[key] = self._memory[key]
+                    self.hits_memory += 1
+                else:
+                    missing.append(key)
+
+            if missing and self.filename:
+                found = self._read_disk(missing)
+                for key, value in found.items():
+                    result[key] = value
+                    self._remember(key, value)
+                self.hits_disk += len(found)
+                self.misses += len(missing) - len(found)
+            else:
+                self.misses += len(missing)
+        return result
+
+    def put_many(self, items):
+        """ Stores the (key, value) pairs of the dict items in both tiers.
+        """
+        if len(items) == 0:
+            return
+        with self._lock:
+            for key, value in items.items():
+                self._remember(key, value)
+            if self.filename:
+                self._write_disk(items)
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def put(self, key, value):
+        self.put_many({key: value})
+
+    def stats(self):
+        with self._lock:
+            return {'hits_memory': self.hits_memory, 'hits_disk': self.hits_disk, 'misses': self.misses,
+                    'memory_items': len(self._memory), 'disk_bytes': self._disk_bytes}
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self.filename:
+                self._connection().execute('DELETE FROM "{}"'.format(self.table))
+                self._connection().commit()
+                self._disk_bytes = 0
+
+    def _remember(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def _connection(self):
+        if self._con is None:
+            directory = os.path.dirname(self.filename)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._con = sqlite3.connect(self.filename, timeout=60, check_same_thread=False)
+            self._con.execute('CREATE TABLE IF NOT EXISTS "{}" (key TEXT PRIMARY KEY, value TEXT, size INTEGER, last_used REAL)'.format(self.table))
+            self._con.execute('CREATE INDEX IF NOT EXISTS "{0}_last_used" ON "{0}" (last_used)'.format(self.table))
+            self._con.commit()
+            self._disk_bytes = self._con.execute('SELECT COALESCE(SUM(size), 0) FROM "{}"'.format(self.table)).fetchone()[0]
+        return self._con
+
+    def _read_disk(self, keys):
+        con = self._connection()
+        found = dict()
+        # stay below SQLite's limit of host parameters per statement
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            rows = con.execute('SELECT key, value FROM "{}" WHERE key IN ({})'.format(self.table, ', '.join('?' * len(batch))), batch).fetchall()
+            found.update((key, json.loads(value)) for key, value in rows)
+        if found:
+            now = time.time()
+            con.executemany('UPDATE "{}" SET last_used = ? WHERE key = ?'.format(self.table), [(now, key) for key in found])
+            con.commit()
+        return found
+
+    def _write_disk(self, items):
+        con = self._connection()
+        existing = set()
+        keys = list(items)
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            existing.update(row[0] for row in con.execute('SELECT key FROM "{}" WHERE key IN ({})'.format(self.table, ', '.join('?' * len(batch))), batch))
+
+        # results for the same key never change, so only new keys need to be written
+        now = time.time()
+        rows = list()
+        for key in keys:
+            if key not in existing:
+                value = json.dumps(items[key])
+                rows.append((key, value, len(key) + len(value), now))
+        con.executemany('INSERT INTO "{}" (key, value, size, last_used) VALUES (?, ?, ?, ?)'.format(self.table), rows)
+        con.commit()
+        self._disk_bytes += sum(row[2] for row in rows)
+        if self._disk_bytes > self.max_disk_bytes:
+            self._evict()
+
+    def _evict(self):
+        """ Removes the least recently used entries until the disk tier uses at most 90% of max_disk_bytes.
+        """
+        con = self._connection()
+        target = 0.9 * self.max_disk_bytes
+        freed = 0
+        keys = list()
+        for key, size in con.execute('SELECT key, size FROM "{}" ORDER BY last_used'.format(self.table)):
+            if self._disk_bytes - freed <= target:
+                break
+            keys.append((key,))
+            freed += size
+        con.executemany('DELETE FROM "{}" WHERE key = ?'.format(self.table), keys)
+        con.commit()
+        self._disk_bytes -= freed
@@ -0,0 +1,332 @@
+import os
+import glob
+import sqlite3
+import uuid
+from contextlib import closing
+
+import pandas as pd
+
+from helper import metrics
+
+class Storage:
+    """ Common interface of all storage backends. Data is stored as DataFrames, rows are identified by an
+        optional key column (e.g. 'id' for submissions or 'Date' for KPIs). Inserting a row with an existing
+        key updates the columns given in data (NaN included), all other columns keep their stored values.
+    """
+    def insert(self, data):
+        raise NotImplementedError()
+
+    def read(self):
+        raise NotImplementedError()
+
+    def count_per_date(self):
+        """ Returns a Series with the number of stored rows per Date.
+        """
+        data = self.read()
+        if len(data) == 0:
+            return pd.Series(dtype='int64')
+        return data.groupby('Date').size()
+
+    def read_since(self, start, column='Date'):
+        """ Returns all rows with column >= start, ordered by column.
+        """
+        data = self.read()
+        if len(data) == 0:
+            return data
+        return data[data[column] >= pd.Timestamp(start)].sort_values(by=column).reset_index(drop=True)
+
+    def tail(self, n, column='Date'):
+        """ Returns the last n rows ordered by column.
+        """
+        data = self.read()
+        if len(data) == 0:
+            return data
+        return data.sort_values(by=column).tail(n).reset_index(drop=True)
+
+    def iter_chunks(self, start=None, end=None, columns=None, chunksize=100000, column='Date'):
+        """ Yields the rows with start <= column < end (both optional) as DataFrames of at most chunksize rows,
+            restricted to columns (None = all). Backends push the filters down as far as they can, so memory
+            is bounded by the chunk size instead of the size of the store.
+        """
+        data = self.read()
+        if len(data) == 0:
+            return
+        yield from _chunks(_filter(data, start, end, columns, column), chunksize)
+
+class CsvStorage(Storage):
+    """ Semicolon separated CSV file. Every insert rewrites the whole file, only kept for compatibility.
+    """
+    def __init__(self, filename, key=None):
+        self.filename = filename
+        self.key = key
+
+    @metrics.timer('storage_insert', backend='csv')
+    def insert(self, data):
+        metrics.count('stored_rows', len(data), backend='csv')
+        # create empty file with correct headers if necessary
+        if os.path.exists(self.filename) is not True:
+            data.iloc[:0].to_csv(self.filename, sep=';', decimal='.', encoding='utf-8', index=False)
+
+        # add new entries, existing keys are updated
+        df = _upsert(self.read(), data, self.key)
+
+        # save to file
+        df.to_csv(self.filename, sep=';', decimal='.', encoding='utf-8', index=False)
+
+    def read(self):
+        if os.path.exists(self.filename) is not True:
+            return pd.DataFrame()
+        return pd.read_csv(self.filename, sep=';', decimal='.', encoding='utf-8', parse_dates=['Date'])
+
+    def iter_chunks(self, start=None, end=None, columns=None, chunksize=100000, column='Date'):
+        if os.path.exists(self.filename) is not True:
+            return
+        usecols = None if columns is None else list(dict.fromkeys(list(columns) + [column]))
+        for chunk in pd.read_csv(self.filename, sep=';', decimal='.', encoding='utf-8', parse_dates=['Date'], usecols=usecols, chunksize=chunksize):
+            chunk = _filter(chunk, start, end, columns, column)
+            if len(chunk) > 0:
+                yield chunk
+
+class SqliteStorage(Storage):
+    """ Table in a SQLite database. The key column gets a UNIQUE index, inserts are UPSERTs and therefore
+        only cost in proportion to the new rows.
+    """
+    def __init__(self, filename, table, key=None):
+        self.filename = filename
+        self.table = table
+        self.key = key
+
+    @metrics.timer('storage_insert', backend='sqlite')
+    def insert(self, data):
+        metrics.count('stored_rows', len(data), backend='sqlite')
+        if len(data) == 0:
+            return
+
+        with closing(self._connect()) as con, con:
+            self._ensure_table(con, data)
+
+            columns = ', '.join(quote_identifier(c) for c in data.columns)
+            placeholders = ', '.join('?' for _ in data.columns)
+            sql = 'INSERT INTO {} ({}) VALUES ({})'.format(quote_identifier(self.table), columns, placeholders)
+            if self.key:
+                updates = ', '.join('{0} = excluded.{0}'.format(quote_identifier(c)) for c in data.columns if c != self.key)
+                sql += ' ON CONFLICT({}) DO '.format(quote_identifier(self.key)) + ('UPDATE SET ' + updates if updates else 'NOTHING')
+
+            con.executemany(sql, _to_sql_rows(data))
+
+    def read(self):
+        with closing(self._connect()) as con:
+            if not self._table_exists(con):
+                return pd.DataFrame()
+            return pd.read_sql('SELECT * FROM {} ORDER BY rowid'.format(quote_identifier(self.table)), con, parse_dates=['Date'])
+
+    def count_per_date(self):
+        with closing(self._connect()) as con:
+            if not self._table_exists(con):
+                return pd.Series(dtype='int64')
+            counts = pd.read_sql('SELECT Date, COUNT(*) AS count FROM {} GROUP BY Date'.format(quote_identifier(self.table)), con, parse_dates=['Date'])
+            return counts.set_index('Date')['count']
+
+    def read_since(self, start, column='Date'):
+        with closing(self._connect()) as con:
+            if not self._table_exists(con):
+                return pd.DataFrame()
+            sql = 'SELECT * FROM {0} WHERE {1} >= ? ORDER BY {1}'.format(quote_identifier(self.table), quote_identifier(column))
+            return pd.read_sql(sql, con, params=_to_sql_rows(pd.DataFrame({column: [start]}))[0], parse_dates=['Date'])
+
+    def tail(self, n, column='Date'):
+        with closing(self._connect()) as con:
+            if not self._table_exists(con):
+                return pd.DataFrame()
+            sql = 'SELECT * FROM (SELECT * FROM {0} ORDER BY {1} DESC LIMIT ?) ORDER BY {1}'.format(quote_identifier(self.table), quote_identifier(column))
+            return pd.read_sql(sql, con, params=(int(n),), parse_dates=['Date'])
+
+    def iter_chunks(self, start=None, end=None, columns=None, chunksize=100000, column='Date'):
+        with closing(self._connect()) as con:
+            if not self._table_exists(con):
+                return
+            conditions, params = list(), list()
+            for value, operator in [(start, '>='), (end, '<')]:
+                if value is not None:
+                    conditions.append('{} {} ?'.format(quote_identifier(column), operator))
+                    params.append(_to_sql_rows(pd.DataFrame({column: [pd.Timestamp(value)]}))[0][0])
+            sql = 'SELECT {} FROM {}'.format('*' if columns is None else ', '.join(quote_identifier(c) for c in columns), quote_identifier(self.table))
+            if conditions:
+                sql += ' WHERE ' + ' AND '.join(conditions)
+            sql += ' ORDER BY {}'.format(quote_identifier(column))
+            parse_dates = ['Date'] if columns is None or 'Date' in columns else None
+            yield from pd.read_sql(sql, con, params=params, parse_dates=parse_dates, chunksize=chunksize)
+
+    def _connect(self):
+        # several fetch threads may write at the same time, so wait for locks instead of failing immediately
+        return sqlite3.connect(self.filename, timeout=60)
+
+    def _table_exists(self, con):
+        return con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (self.table,)).fetchone() is not None
+
+    def _ensure_table(self, con, data):
+        """ Creates the table and its key index if necessary and adds columns which are new in data.
+        """
+        # other threads or processes may create the table or add a column at the same time
+        if not self._table_exists(con):
+            columns = ', '.join('{} {}'.format(quote_identifier(c), _sql_type(data[c])) for c in data.columns)
+            con.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format(quote_identifier(self.table), columns))
+        # DDL is committed right away, so the table may already exist without its index
+        if self.key:
+            con.execute('CREATE UNIQUE INDEX IF NOT EXISTS {} ON {} ({})'.format(quote_identifier(self.table + '_' + self.key), quote_identifier(self.table), quote_identifier(self.key)))
+        # date ranges are the most common query, see iter_chunks and count_per_date
+        if 'Date' in data.columns and self.key != 'Date':
+            con.execute('CREATE INDEX IF NOT EXISTS {} ON {} ("Date")'.format(quote_identifier(self.table + '_Date'), quote_identifier(self.table)))
+
+        existing_columns = [row[1] for row in con.execute('PRAGMA table_info({})'.format(quote_identifier(self.table)))]
+        for c in data.columns:
+            if c not in existing_columns:
+                try:
+                    con.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(quote_identifier(self.table), quote_identifier(c), _sql_type(data[c])))
+                except sqlite3.OperationalError as e:
+                    if 'duplicate column' not in str(e):
+                        raise
+
+class ParquetStorage(Storage):
+    """ Parquet dataset partitioned by date, i.e. one directory 'partition=<date>' per day (or month, see
+        partition_format). An insert only rewrites the partitions which receive new rows.
+    """
+    def __init__(self, directory, key=None, partition_column='Date', partition_format='%Y-%m-%d'):
+        self.directory = directory
+        self.key = key
+        self.partition_column = partition_column
+        self.partition_format = partition_format
+
+    @metrics.timer('storage_insert', backend='parquet')
+    def insert(self, data):
+        metrics.count('stored_rows', len(data), backend='parquet')
+        if len(data) == 0:
+            return
+
+        partitions = pd.to_datetime(data[self.partition_column]).dt.strftime(self.partition_format)
+        for partition, new_rows in data.groupby(partitions.values):
+            path = self._partition_path(partition)
+            if os.path.exists(path):
+                new_rows = _upsert(pd.read_parquet(path), new_rows, self.key)
+            elif self.key:
+                new_rows = new_rows.drop_duplicates(subset=[self.key], keep='last')
+
+            # write to a temporary file first so a crash never leaves a broken partition behind
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + '.' + uuid.uuid4().hex + '.tmp'
+            new_rows.reset_index(drop=True).to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, path)
+
+    def read(self):
+        files = self.partition_files()
+        if len(files) == 0:
+            return pd.DataFrame()
+        return pd.concat([pd.read_parquet(f) for f in files]).reset_index(drop=True)
+
+    def count_per_date(self):
+        files = self.partition_files()
+        if len(files) == 0:
+            return pd.Series(dtype='int64')
+        dates = pd.concat([pd.read_parquet(f, columns=[self.partition_column]) for f in files])
+        return dates.groupby(self.partition_column).size()
+
+    def read_since(self, start, column='Date'):
+        files = self.partition_files()
+        if column == self.partition_column:
+            # partitions before the one containing start can be skipped without reading them
+            first = pd.Timestamp(start).strftime(self.partition_format)
+            files = [f for f in files if self._partition_of(f) >= first]
+        if len(files) == 0:
+            return pd.DataFrame()
+        data = pd.concat([pd.read_parquet(f) for f in files])
+        return data[data[column] >= pd.Timestamp(start)].sort_values(by=column).reset_index(drop=True)
+
+    def iter_chunks(self, start=None, end=None, columns=None, chunksize=100000, column='Date'):
+        files = self.partition_files()
+        if column == self.partition_column:
+            # only partitions which may contain rows of the range are read
+            if start is not None:
+                files = [f for f in files if self._partition_of(f) >= pd.Timestamp(start).strftime(self.partition_format)]
+            if end is not None:
+                files = [f for f in files if self._partition_of(f) <= pd.Timestamp(end).strftime(self.partition_format)]
+        read_columns = None if columns is None else list(dict.fromkeys(list(columns) + [column]))
+        for f in files:
+            chunk = _filter(pd.read_parquet(f, columns=read_columns), start, end, columns, column)
+            yield from _chunks(chunk, chunksize)
+
+    def partition_files(self):
+        return sorted(glob.glob(os.path.join(self.directory, 'partition=*', 'data.parquet')))
+
+    def _partition_path(self, partition):
+        return os.path.join(self.directory, 'partition=' + partition, 'data.parquet')
+
+    def _partition_of(self, path):
+        return os.path.basename(os.path.dirname(path))[len('partition='):]
+
+def open_storage(filename, table=None, key=None):
+    """ Returns the storage backend matching the file extension of filename:
+            .csv                        -> CsvStorage (table is ignored)
+            .sqlite3, .sqlite, .db      -> SqliteStorage, table defaults to the file name
+            .parquet                    -> ParquetStorage, one sub directory per table
+    """
+    name, extension = os.path.splitext(filename)
+    if extension == '.csv':
+        return CsvStorage(filename, key=key)
+    if extension in ['.sqlite3', '.sqlite', '.db']:
+        return SqliteStorage(filename, table or os.path.basename(name), key=key)
+    if extension == '.parquet':
+        return ParquetStorage(os.path.join(filename, table) if table else filename, key=key)
+    raise ValueError('Unknown storage type for file: {}'.format(filename))
+
+def _upsert(stored, data, key):
+    """ Returns stored with the rows of data added. Rows whose key is already stored get the columns of data,
+        their other columns are kept (like the UPSERT of SqliteStorage). Stored rows keep their order.
+    """
+    if not key:
+        return pd.concat([stored, data]).reset_index(drop=True)
+    data = data.drop_duplicates(subset=[key], keep='last')
+    if len(stored) == 0:
+        return data.reset_index(drop=True)
+
+    columns = list(stored.columns) + [c for c in data.columns if c not in stored.columns]
+    stored = stored.set_index(key)
+    data = data.set_index(key)
+    kept_columns = [c for c in stored.columns if c not in data.columns]
+    updated = data.join(stored[kept_columns], how='left')
+    merged = pd.concat([stored[~stored.index.isin(data.index)], updated])
+
+    order = stored.index.append(data.index[~data.index.isin(stored.index)])
+    return merged.reindex(order).rename_axis(key).reset_index()[columns]
+
+def _filter(data, start, end, columns, column):
+    if start is not None:
+        data = data[data[column] >= pd.Timestamp(start)]
+    if end is not None:
+        data = data[data[column] < pd.Timestamp(end)]
+    if columns is not None:
+        data = data[list(columns)]
+    return data.reset_index(drop=True)
+
+def _chunks(data, chunksize):
+    for i in range(0, len(data), chunksize):
+        yield data.iloc[i:i + chunksize]
+
+def quote_identifier(identifier):
+    return '"' + str(identifier).replace('"', '""') + '"'
+
+def _sql_type(column):
+    if pd.api.types.is_bool_dtype(column) or pd.api.types.is_integer_dtype(column):
+        return 'INTEGER'
+    if pd.api.types.is_float_dtype(column):
+        return 'REAL'
+    return 'TEXT'
+
+def _to_sql_rows(data):
+    """ Converts data into a list of tuples of python types, dates become ISO strings and NaN becomes NULL.
+    """
+    data = data.copy()
+    for c in data.columns:
+        if pd.api.types.is_datetime64_any_dtype(data[c]):
+            data[c] = data[c].dt.strftime('%Y-%m-%d %H:%M:%S')
+    values = data.astype(object).where(data.notna(), None)
+    return [tuple(row) for row in values.itertuples(index=False, name=None)]
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+import os
+import sys
+import argparse
+import datetime as dt
+
+import yfinance as yf
+import pandas as pd
+
+# hacky hack to get relative import
+sys.path.append( os.path.dirname( os.path.dirname(os.path.realpath(__file__)) ) )
+from helper.storage import open_storage
+from helper.atomic_file import read_json, write_json
+from kpi.fetch_new_data import TICKERS, load_config, save_data_to_database
+
+def download_history(tickers=None, start=None, end=None):
+    """ Downloads the daily closes of all tickers (column -> yahoo symbol, defaults to TICKERS) with one batched
+        call and aligns them on a shared date index.
+
+        The snapshots of fetch_new_data store the previous close under the date they were taken, so the close of
+        a trading day is stored under the following business day here as well.
+    """
+    tickers = tickers or TICKERS
+    symbols = list(dict.fromkeys(tickers.values()))
+    if start is None:
+        data = yf.download(symbols, period='max', interval='1d', progress=False, threads=True, auto_adjust=False)
+    else:
+        data = yf.download(symbols, start=start, end=end, interval='1d', progress=False, threads=True, auto_adjust=False)
+
+    closes = data['Close']
+    if isinstance(closes, pd.Series):
+        closes = closes.to_frame(symbols[0])
+    closes.index = pd.to_datetime(closes.index).tz_localize(None).normalize() + pd.offsets.BDay(1)
+
+    result = pd.DataFrame({column: closes[symbol] for column, symbol in tickers.items() if symbol in closes}, index=closes.index)
+    result = result.dropna(how='all')
+    result.index.name = 'Date'
+    return result.reset_index()
+
+def find_missing_ranges(stored, start, end, columns, starts=None, unavailable=None):
+    """ Returns the (first, last) date of every run of consecutive business days between start and end for which
+        stored has no row or any of columns is missing. Days before the first day of a column (starts, column ->
+        date) and days yahoo has no value for (unavailable, column -> list of dates) do not count as missing.
+    """
+    missing = missing_dates(stored, start, end, columns, starts=starts, unavailable=unavailable)
+    expected = pd.DatetimeIndex(sorted(set().union(*missing.values()))) if missing else pd.DatetimeIndex([])
+    if len(expected) == 0:
+        return []
+
+    # business days are at most three calendar days apart (friday -> monday), everything else starts a new range
+    breaks = (expected[1:] - expected[:-1]) > pd.Timedelta(days=3)
+    ranges = list()
+    first = expected[0]
+    for previous, current, is_break in zip(expected[:-1], expected[1:], breaks):
+        if is_break:
+            ranges.append((first, previous))
+            first = current
+    ranges.append((first, expected[-1]))
+    return ranges
+
+def missing_dates(stored, start, end, columns, starts=None, unavailable=None):
+    """ Returns column -> DatetimeIndex of the business days between start and end without a value in stored,
+        see find_missing_ranges.
+    """
+    starts = starts or dict()
+    unavailable = unavailable or dict()
+    if len(stored) > 0:
+        stored = stored.assign(Date=pd.to_datetime(stored['Date']).dt.normalize())
+    missing = dict()
+    for c in columns:
+        expected = pd.bdate_range(max(pd.Timestamp(start), pd.Timestamp(starts.get(c, start))), end)
+        if len(stored) > 0 and c in stored.columns:
+            expected = expected.difference(pd.DatetimeIndex(stored.loc[stored[c].notna(), 'Date']))
+        missing[c] = expected.difference(pd.DatetimeIndex(pd.to_datetime(unavailable.get(c, []))))
+    return missing
+
+# missing ranges closer than this are downloaded together, fewer requests for a few days of unneeded rows
+MERGE_GAP_DAYS = 31
+
+def download_ranges(ranges, missing):
+    """ Downloads the missing closes (missing: column -> DatetimeIndex, see missing_dates) of all ranges (see
+        find_missing_ranges), one batched call per range (ranges closer than MERGE_GAP_DAYS are merged) for the
+        tickers missing in it. Only rows of missing dates are returned.
+    """
+    merged = list()
+    for first, last in ranges:
+        if merged and first - merged[-1][1] <= pd.Timedelta(days=MERGE_GAP_DAYS):
+            merged[-1][1] = last
+        else:
+            merged.append([first, last])
+
+    parts = list()
+    for first, last in merged:
+        tickers = {c: TICKERS[c] for c, dates in missing.items() if ((dates >= first) & (dates <= last)).any()}
+        if len(tickers) == 0:
+            continue
+        # shifted by one business day as in download_history
+        part = download_history(tickers, start=first - pd.offsets.BDay(1), end=last)
+        parts.append(part[(part['Date'] >= first) & (part['Date'] <= last)])
+    if len(parts) == 0:
+        return pd.DataFrame(columns=['Date'])
+    history = pd.concat(parts, ignore_index=True)
+    dates = pd.DatetimeIndex(sorted(set().union(*missing.values())))
+    return history[history['Date'].isin(dates)].reset_index(drop=True)
+
+def _load_state(filename):
+    state = read_json(filename, {'starts': None, 'unavailable': dict()})
+    # states of older versions only knew the last checked day, they start over with a full download
+    state.setdefault('starts', None)
+    state.setdefault('unavailable', dict())
+    return state
+
+# days without a value which are older than this are taken as not available at yahoo (holidays, delisted data),
+# younger ones are asked for again on the next run
+SETTLE_DAYS = 7
+
+def backfill(db_filename, table='kpi', state_filename=None, full=False):
+    """ Fills the ticker columns of the KPI store with their daily history. The first run (or full=True) loads the
+        whole history, later runs scan the whole history for missing ticker values (e.g. snapshots whose ticker
+        source failed) and only download the ranges containing them. Existing rows only get missing ticker
+        values, snapshot values and the other KPI columns are never overwritten.
+
+    Returns:
+        int: number of stored rows.
+    """
+    state_filename = state_filename or os.path.join(os.path.dirname(db_filename), 'checkpoints', table + '_history.json')
+    state = _load_state(state_filename)
+    stored = open_storage(db_filename, table=table).read()
+    columns = list(TICKERS)
+    end = pd.Timestamp(dt.date.today())
+
+    if full or state['starts'] is None or any(c not in state['starts'] for c in columns):
+        history = download_history()
+        state['starts'] = {c: history.loc[history[c].notna(), 'Date'].min().strftime('%Y-%m-%d') for c in columns if history[c].notna().any()}
+        state['unavailable'] = dict()
+        start = history['Date'].min()
+    else:
+        start = min(pd.Timestamp(d) for d in state['starts'].values())
+        ranges = find_missing_ranges(stored, start, end, columns, starts=state['starts'], unavailable=state['unavailable'])
+        if len(ranges) == 0:
+            print('KPI history is complete.')
+            return 0
+        print('Missing KPI history: {}'.format(', '.join('{:%Y-%m-%d} - {:%Y-%m-%d}'.format(first, last) for first, last in ranges)))
+        missing = missing_dates(stored, start, end, columns, starts=state['starts'], unavailable=state['unavailable'])
+        history = download_ranges(ranges, missing)
+
+    # remember which of the still missing days yahoo does not know, so they are not downloaded again every run
+    settled = end - pd.Timedelta(days=SETTLE_DAYS)
+    merged = pd.concat([stored, history]) if len(stored) > 0 else history
+    for c, dates in missing_dates(merged, start, settled, columns, starts=state['starts'], unavailable=state['unavailable']).items():
+        if len(dates) > 0:
+            state['unavailable'][c] = sorted(set(state['unavailable'].get(c, [])) | set(dates.strftime('%Y-%m-%d')))
+
+    history = _only_missing_values(history, stored, columns)
+    if len(history) > 0:
+        save_data_to_database(history, db_filename, table=table)
+    write_json(state_filename, state)
+    print('...done. Stored {} rows of KPI history.'.format(len(history)))
+    return len(history)
+
+def _only_missing_values(history, stored, columns):
+    """ Drops rows of history which add no value missing in stored. In the remaining rows ticker values already
+        stored are kept, since an upsert writes every column given (the other columns are not touched).
+    """
+    if len(stored) == 0:
+        return history
+    stored = stored.assign(Date=pd.to_datetime(stored['Date']).dt.normalize()).drop_duplicates(subset=['Date'], keep='last').set_index('Date')
+    history = history.set_index('Date')
+    adds_value = pd.Series(False, index=history.index)
+    for c in columns:
+        if c in history.columns:
+            known = stored[c].reindex(history.index) if c in stored.columns else pd.Series(float('nan'), index=history.index)
+            adds_value |= known.isna() & history[c].notna()
+            history[c] = known.where(known.notna(), history[c])
+    return history[adds_value.values].reset_index()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Backfills the daily history of all tracked tickers into the KPI store.')
+    parser.add_argument('--full', action='store_true', help='download the whole history again')
+    args = parser.parse_args(argv)
+
+    load_config()
+    backfill('data/findat.sqlite3', full=args.full)
+
+if __name__ == "__main__":
+    # we assume this code is in /src/kpi while data is in /data. Since we do not want to assume a cwd we switch to src and than move one up
+    path = os.path.dirname(os.path.realpath(__file__))
+    os.chdir(path)
+    os.chdir(os.path.pardir)
+    os.chdir(os.path.pardir)
+
+    main()
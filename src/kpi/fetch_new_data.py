@@ -1,94 +1,181 @@
 #!/usr/bin/env python3
 import os
+import sys
+import io
 import ssl
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 ssl._create_default_https_context = ssl._create_unverified_context
 
-import requests
 import yfinance as yf
 import pandas as pd
 import datetime as dt
 import numpy as np
+import yaml
 
-def get_fear_and_great_indicator():
+# hacky hack to get relative import
+sys.path.append( os.path.dirname( os.path.dirname(os.path.realpath(__file__)) ) )
+from helper.storage import open_storage
+from helper import http_client
+from helper import metrics
+
+# base urls of the sources, can be pointed to a local stand-in such as helper/replay_server.py
+YAHOO_URL = os.environ.get('FINDAT_YAHOO_URL', 'https://query1.finance.yahoo.com')
+CBOE_URL = os.environ.get('FINDAT_CBOE_URL', 'https://markets.cboe.com')
+CNN_URL = os.environ.get('FINDAT_CNN_URL', 'https://money.cnn.com')
+
+# column -> yahoo symbol of all tickers whose previous close is collected, extend with register_ticker or conf/kpi.yaml
+TICKERS = {
+    'SP500': '^GSPC',
+    'ACWI': 'ACWI',
+    'VIX': '^VIX',
+    'VIX3M': '^VIX3M',
+}
+
+# column -> name of the put/call ratio on the CBOE daily market statistics page
+PUT_CALL_RATIOS = {
+    'TOTAL_PCR': 'TOTAL PUT/CALL RATIO',
+    'INDEX_PCR': 'INDEX PUT/CALL RATIO',
+    'EQUITY_PCR': 'EQUITY PUT/CALL RATIO',
+    'VIX_PCR': 'CBOE VOLATILITY INDEX (VIX) PUT/CALL RATIO',
+}
+
+# all sources are fetched at the same time, a source which fails or takes longer than its timeout (seconds) only
+# leaves its columns empty. Every source is a function taking the timeout and returning a dict column -> value
+SOURCES = dict()
+
+def register_source(name, func, columns, timeout=30):
+    """ Adds a source to the KPI snapshot. columns lists the columns func returns, they are NaN if func fails.
+    """
+    SOURCES[name] = {'func': func, 'columns': columns, 'timeout': timeout}
+
+def register_ticker(column, symbol):
+    """ Adds the previous close of the yahoo symbol as column. All tickers are fetched in one batched request.
+    """
+    TICKERS[column] = symbol
+    SOURCES['tickers']['columns'] = list(TICKERS)
+
+def load_config(filename='conf/kpi.yaml'):
+    """ Registers additional tickers from the optional config file, e.g.
+
+        tickers:
+            NASDAQ: ^IXIC
+            GOLD: GC=F
+    """
+    if not os.path.exists(filename):
+        return
+    with open(filename, 'r') as f:
+        config = yaml.safe_load(f) or dict()
+    for column, symbol in (config.get('tickers') or dict()).items():
+        register_ticker(column, symbol)
+
+def get_previous_closes(timeout=30):
+    """ Previous close of all TICKERS with a single request to the yahoo quote api instead of one large .info
+        request per ticker. Symbols missing in the response are taken from the daily history, symbols found in
+        neither are NaN.
+    """
+    symbols = list(TICKERS.values())
+    quotes = dict()
+    try:
+        r = http_client.get(YAHOO_URL + '/v7/finance/quote', params={'symbols': ','.join(symbols)}, timeout=timeout)
+        if r.status_code == 200:
+            quotes = {q['symbol']: q.get('regularMarketPreviousClose') for q in r.json()['quoteResponse']['result']}
+        else:
+            print('ERROR: yahoo quote api failed with code {}, falling back to history!'.format(r.status_code))
+    except Exception as e:
+        print('ERROR: yahoo quote api failed with {}, falling back to history!'.format(type(e).__name__))
+
+    missing = [symbol for symbol in symbols if quotes.get(symbol) is None]
+    if missing:
+        try:
+            quotes.update(_get_previous_closes_from_history(missing))
+        except Exception as e:
+            print('ERROR: yahoo history failed with {}: {}'.format(type(e).__name__, e))
+    return {column: np.nan if quotes.get(symbol) is None else float(quotes[symbol]) for column, symbol in TICKERS.items()}
+
+def _get_previous_closes_from_history(symbols):
+    closes = yf.download(symbols, period='5d', interval='1d', progress=False, threads=True)['Close']
+    if isinstance(closes, pd.Series):
+        closes = closes.to_frame(symbols[0])
+    closes = closes[closes.index < pd.Timestamp(dt.date.today())]
+    return {symbol: closes[symbol].dropna().iloc[-1] for symbol in symbols if symbol in closes and closes[symbol].notna().any()}
+
+def get_put_call_ratios(timeout=30):
+    r = http_client.get(CBOE_URL + '/us/options/market_statistics/daily/', timeout=timeout)
+    cboe_data = pd.read_html(io.StringIO(r.text))[0]
+    cboe_data.columns = ['NAME', 'RATIO']
+    return {column: float(cboe_data[cboe_data.NAME == name]['RATIO'].values[0]) for column, name in PUT_CALL_RATIOS.items()}
+
+def get_fear_and_great_indicator(timeout=30):
     try:
-        r = requests.get('https://money.cnn.com/data/fear-and-greed/')
-    except:
+        r = http_client.get(CNN_URL + '/data/fear-and-greed/', timeout=timeout)
+    except Exception:
         print('ERROR: HTML GET not successfull!')
+        return np.nan
     
     if r.status_code != 200:
         print('ERROR: getting Fear & Greed CNN Website failed!')
         return np.nan
     
-    p_indicator = re.compile('Greed Now: (\d{1,2})')
+    p_indicator = re.compile(r'Greed Now: (\d{1,2})')
     m_indicator = p_indicator.search(r.text)
 
-    if len(m_indicator.groups()) != 1:
+    if m_indicator is None or len(m_indicator.groups()) != 1:
         print('ERROR: Fear & Greed CNN Website seems to be broken!')
         return np.nan 
 
     indicator = int(m_indicator.groups()[0])
     return indicator
 
+register_source('tickers', get_previous_closes, list(TICKERS))
+register_source('cboe', get_put_call_ratios, list(PUT_CALL_RATIOS))
+register_source('fear_and_greed', lambda timeout: {'FEAR_AND_GREED': get_fear_and_great_indicator(timeout)}, ['FEAR_AND_GREED'])
+
 def get_new_data():
+    """ Collects a snapshot of all SOURCES concurrently. Sources which fail or time out leave their columns NaN.
+    """
     date_string = dt.datetime.now().strftime("%Y-%m-%d")
+    values = {'Date': pd.to_datetime(date_string)}
     
-    # global finance data
-    sp500 = yf.Ticker('^GSPC')
-    vix = yf.Ticker('^VIX')
-    vix3m = yf.Ticker('^VIX3M')
-    acwi = yf.Ticker('ACWI')
-
-    # Put/Call Ratios
-    cboe_data = pd.read_html('https://markets.cboe.com/us/options/market_statistics/daily/')[0]
-    cboe_data.columns = ['NAME', 'RATIO']
+    executor = ThreadPoolExecutor(max_workers=len(SOURCES))
+    futures = {name: executor.submit(metrics.timer('kpi_source', source=name)(source['func']), source['timeout']) for name, source in SOURCES.items()}
+    start = time.monotonic()
+    for name, future in futures.items():
+        source = SOURCES[name]
+        try:
+            values.update(future.result(timeout=max(0, source['timeout'] - (time.monotonic() - start))))
+        except FuturesTimeoutError:
+            metrics.log_event('source_failed', source=name, error='timeout', seconds=source['timeout'])
+            print('ERROR: source {} timed out after {}s!'.format(name, source['timeout']))
+        except Exception as e:
+            metrics.log_event('source_failed', source=name, error=type(e).__name__, message=str(e))
+            print('ERROR: source {} failed with error {}'.format(name, sys.exc_info()))
+    # do not wait for sources which timed out, their requests time out on their own
+    executor.shutdown(wait=False)
 
-    # result DataFrame
-    result = pd.DataFrame( {
-                        'Date': pd.to_datetime(date_string),
-                        'SP500':float( sp500.info['previousClose'] ), 
-                        'ACWI':float( acwi.info['previousClose'] ), 
-                        'VIX': float( vix.info['previousClose'] ),
-                        'VIX3M': float( vix3m.info['previousClose'] ),
-                        'TOTAL_PCR': float( cboe_data[ cboe_data.NAME == 'TOTAL PUT/CALL RATIO']['RATIO'].values[0] ), 
-                        'INDEX_PCR': float( cboe_data[ cboe_data.NAME == 'INDEX PUT/CALL RATIO']['RATIO'].values[0] ),
-                        'EQUITY_PCR': float( cboe_data[ cboe_data.NAME == 'EQUITY PUT/CALL RATIO']['RATIO'].values[0] ),
-                        'VIX_PCR':float( cboe_data[ cboe_data.NAME == 'CBOE VOLATILITY INDEX (VIX) PUT/CALL RATIO']['RATIO'].values[0] ),
-                        'FEAR_AND_GREED': get_fear_and_great_indicator(),
-                    }, index=[0])
+    columns = ['Date'] + [c for source in SOURCES.values() for c in source['columns']]
+    result = pd.DataFrame({c: values.get(c, np.nan) for c in columns}, index=[0])
     print(result)
 
     return result
 
-def save_data_to_database(data, filename):
-    # create empty file with correct headers if necessary
-    if os.path.exists(filename) is not True:
-        pd.DataFrame( {
-                        'Date': np.datetime64(),
-                        'SP500':float(), 
-                        'ACWI':float(),
-                        'VIX': float( ),
-                        'VIX3M': float( ),
-                        'TOTAL_PCR': float(), 
-                        'INDEX_PCR': float(),
-                        'EQUITY_PCR': float(),
-                        'VIX_PCR':float(),
-                        'FEAR_AND_GREED': int()
-                    }, index=[]).to_csv(filename, sep=';', decimal='.', encoding='utf-8', index=False)
-    
-    # add new entry
-    df = pd.read_csv(filename, sep=';', decimal='.', encoding='utf-8', parse_dates=['Date'])
-    df = df.append(data).reset_index(drop=True)
-    
-    # check/remove duplicates in date column
-    df = df.drop_duplicates(subset=['Date'], keep='last')
+def save_data_to_database(data, filename, table='kpi'):
+    """ Stores the KPIs in data (CSV, SQLite or Parquet, see helper.storage.open_storage), one row per date.
+    """
+    open_storage(filename, table=table, key='Date').insert(data)
 
-    # save to file
-    df.to_csv(filename, sep=';', decimal='.', encoding='utf-8', index=False)
+def update_snapshot(filename, table='kpi'):
+    """ Fetches today's snapshot and stores it. Columns of failed sources are left out of the insert, so a partial
+        rerun keeps the values of the day stored earlier (inserts only update the given columns, see Storage.insert).
+    """
+    data = get_new_data()
+    save_data_to_database(data.dropna(axis=1, how='all'), filename, table=table)
+    return data
 
 def main():
-    data = get_new_data()
-    save_data_to_database(data, 'data/database.csv')
+    load_config()
+    update_snapshot('data/findat.sqlite3')
 
 if __name__ == "__main__":
     # we assume this code is in /src while data is in /data. Since we do not want to assume a cwd we switch to src and than move one up
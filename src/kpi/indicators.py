@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+import os
+import sys
+import argparse
+
+import numpy as np
+import pandas as pd
+
+# hacky hack to get relative import
+sys.path.append( os.path.dirname( os.path.dirname(os.path.realpath(__file__)) ) )
+from helper.storage import open_storage
+from kpi.fetch_new_data import TICKERS, PUT_CALL_RATIOS, load_config
+
+class Indicator:
+    """ A derived KPI column. update() gets the history (raw and already materialized columns of at least the
+        last window rows) and the new rows and returns the values for the new rows only, so a daily update
+        costs O(window). Indicators which carry state from row to row can materialize it in state_columns, then
+        update() returns a dict column -> values for name and every state column.
+
+        Indicators with full = True depend on the whole series. They are not materialized but computed by
+        compute() when the data is read, see compute_full_indicators.
+    """
+    window = 1
+    full = False
+    state_columns = []
+
+    def __init__(self, name, inputs):
+        self.name = name
+        self.inputs = inputs
+
+    def update(self, history, new):
+        raise NotImplementedError()
+
+    def compute(self, data):
+        return self.update(data.iloc[:0], data)
+
+class Ratio(Indicator):
+    def __init__(self, name, numerator, denominator):
+        super().__init__(name, [numerator, denominator])
+
+    def update(self, history, new):
+        return (new[self.inputs[0]] / new[self.inputs[1]]).values
+
+class Spread(Indicator):
+    def __init__(self, name, minuend, subtrahend):
+        super().__init__(name, [minuend, subtrahend])
+
+    def update(self, history, new):
+        return (new[self.inputs[0]] - new[self.inputs[1]]).values
+
+class Rolling(Indicator):
+    """ Rolling mean (or std) of column over the last window rows.
+    """
+    def __init__(self, name, column, window, stat='mean'):
+        super().__init__(name, [column])
+        self.window = window
+        self.stat = stat
+
+    def update(self, history, new):
+        values = _window_values(history, new, self.inputs[0], self.window)
+        return getattr(values.rolling(self.window), self.stat)().values[-len(new):]
+
+class ZScore(Indicator):
+    """ Distance of column to its rolling mean in rolling standard deviations.
+    """
+    def __init__(self, name, column, window):
+        super().__init__(name, [column])
+        self.window = window
+
+    def update(self, history, new):
+        values = _window_values(history, new, self.inputs[0], self.window)
+        rolling = values.rolling(self.window)
+        return ((values - rolling.mean()) / rolling.std()).values[-len(new):]
+
+class Ewm(Indicator):
+    """ Exponentially weighted mean like pandas' ewm(alpha).mean() (adjust=True): the weighted sum of all values
+        divided by the sum of their weights, the weight of a value decays by (1 - alpha) per row. Both sums are
+        materialized as state, so every new row costs O(1).
+    """
+    def __init__(self, name, column, alpha):
+        super().__init__(name, [column])
+        self.alpha = alpha
+        self.state_columns = [name + '__num', name + '__den']
+
+    def update(self, history, new):
+        numerator, denominator = 0.0, 0.0
+        if all(c in history.columns for c in self.state_columns) and len(history) > 0:
+            last = history[self.state_columns].iloc[-1].astype(float)
+            if last.notna().all():
+                numerator, denominator = last.values
+
+        decay = 1 - self.alpha
+        numerators, denominators = np.empty(len(new)), np.empty(len(new))
+        for i, x in enumerate(new[self.inputs[0]].values.astype(float)):
+            valid = not np.isnan(x)
+            numerator = decay * numerator + (x if valid else 0.0)
+            denominator = decay * denominator + (1.0 if valid else 0.0)
+            numerators[i], denominators[i] = numerator, denominator
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(denominators > 0, numerators / denominators, np.nan)
+        return {self.name: mean, self.state_columns[0]: numerators, self.state_columns[1]: denominators}
+
+class FftLowPass(Indicator):
+    """ Fourier smoothing as in the sentiment notebook: all frequencies with a period shorter than min_period rows
+        are removed. Every value depends on the whole series, so it is computed when the data is read.
+    """
+    full = True
+
+    def __init__(self, name, column, min_period):
+        super().__init__(name, [column])
+        self.min_period = min_period
+
+    def compute(self, data):
+        values = data[self.inputs[0]].astype(float).interpolate(limit_direction='both')
+        result = np.full(len(values), np.nan)
+        if values.notna().sum() < 2:
+            return result
+        N = len(values)
+        y_hat = np.fft.rfft(values.values, N)
+        y_hat[int(N / self.min_period) + 1:] = 0
+        result[:] = np.fft.irfft(y_hat, N)
+        # no smoothing where no data was given
+        result[data[self.inputs[0]].isna().values] = np.nan
+        return result
+
+def _window_values(history, new, column, window):
+    """ Returns the last window - 1 values of column in history followed by the values of the new rows.
+    """
+    old = history[column].iloc[max(0, len(history) - window + 1):] if column in history.columns else pd.Series(dtype='float64')
+    return pd.concat([old, new[column]]).astype(float).reset_index(drop=True)
+
+INDICATORS = list()
+
+def register_indicator(indicator):
+    """ Adds indicator to the registry. Indicators are computed in order, so one may use earlier ones as input.
+    """
+    INDICATORS[:] = [i for i in INDICATORS if i.name != indicator.name] + [indicator]
+    return indicator
+
+def register_smoothing(column):
+    """ Registers the 7 and 21 day rolling means and the EMA of column which are shown in the plots.
+    """
+    register_indicator(Rolling(column + '_7D', column, 7))
+    register_indicator(Rolling(column + '_21D', column, 21))
+    register_indicator(Ewm(column + '_EMA', column, alpha=0.001))
+
+def register_default_indicators():
+    """ Registers the indicators of all known KPI columns, call after load_config() so configured tickers are included.
+    """
+    register_indicator(Ratio('VIX3M_VIX', 'VIX3M', 'VIX'))
+    register_indicator(Spread('VIX3M-VIX', 'VIX3M', 'VIX'))
+    register_indicator(FftLowPass('VIX3M_VIX_FFT', 'VIX3M_VIX', min_period=21))
+    for column in list(TICKERS) + list(PUT_CALL_RATIOS) + ['FEAR_AND_GREED', 'VIX3M_VIX', 'VIX3M-VIX']:
+        register_smoothing(column)
+    for column in PUT_CALL_RATIOS:
+        register_indicator(ZScore(column + '_Z63', column, 63))
+
+# hash of the raw KPI row every indicator row was computed from, see update_indicators
+RAW_HASH_COLUMN = 'raw__hash'
+
+def state_columns(indicators=None):
+    """ Names of the materialized state columns of indicators (and RAW_HASH_COLUMN), these are no KPIs and should
+        not be plotted.
+    """
+    indicators = INDICATORS if indicators is None else indicators
+    return [c for i in indicators for c in i.state_columns] + [RAW_HASH_COLUMN]
+
+def _update(indicators, history, new):
+    """ Adds the columns of the incremental indicators whose inputs are known to new.
+    """
+    for indicator in indicators:
+        if all(c in new.columns for c in indicator.inputs):
+            values = indicator.update(history, new)
+            for column, column_values in (values.items() if isinstance(values, dict) else [(indicator.name, values)]):
+                new[column] = column_values
+    return new
+
+def _materialized_columns(indicators, data):
+    return ['Date'] + [c for i in indicators for c in [i.name] + i.state_columns if c in data.columns]
+
+def raw_hashes(raw):
+    """ Hex hash of every row of the (Date sorted) raw KPIs, stored as RAW_HASH_COLUMN to notice changed rows.
+    """
+    return pd.util.hash_pandas_object(raw, index=False).map('{:016x}'.format).values
+
+def update_indicators(filename, table='kpi', indicator_table='kpi_indicators', indicators=None, full=False):
+    """ Materializes all incremental indicators of the KPIs in table into indicator_table (same database, one row
+        per Date). Every raw row is stored with its hash, the indicators are recomputed from the first date whose
+        raw row is new or changed (e.g. a completed snapshot or cells filled by the history backfill) on, using the
+        last window rows before it as history. Indicators with full = True are left to compute_full_indicators.
+
+    Returns:
+        int: number of computed dates.
+    """
+    indicators = INDICATORS if indicators is None else indicators
+    raw_store = open_storage(filename, table=table)
+    store = open_storage(filename, table=indicator_table, key='Date')
+    incremental = [i for i in indicators if not i.full]
+    lookback = max([i.window for i in incremental], default=1)
+
+    # the daily KPI tables are small, hashing all rows costs far less than recomputing them
+    raw = raw_store.read()
+    if len(raw) == 0:
+        return 0
+    raw = raw.sort_values(by='Date').reset_index(drop=True)
+    hashes = raw_hashes(raw)
+
+    stored = pd.DataFrame() if full else store.read()
+    expected, available = list(), set(raw.columns)
+    for indicator in incremental:
+        if all(c in available for c in indicator.inputs):
+            expected += [indicator.name] + indicator.state_columns
+            available.add(indicator.name)
+    changed = np.ones(len(raw), dtype=bool)
+    # stores without hashes or without some indicator (e.g. a new one) are recomputed completely
+    if len(stored) > 0 and all(c in stored.columns for c in expected + [RAW_HASH_COLUMN]):
+        known = stored.set_index(pd.DatetimeIndex(stored['Date']))[RAW_HASH_COLUMN].reindex(pd.DatetimeIndex(raw['Date']))
+        changed = known.values != hashes
+    if not changed.any():
+        return 0
+
+    first = int(np.argmax(changed))
+    history = raw.iloc[max(0, first - lookback):first]
+    if len(stored) > 0:
+        history = history.merge(stored, on='Date', how='left', suffixes=('', '_stored'))
+    new = raw.iloc[first:].reset_index(drop=True)
+    new = _update(incremental, history.reset_index(drop=True), new.assign(**{RAW_HASH_COLUMN: hashes[first:]}))
+    store.insert(new[_materialized_columns(incremental, new) + [RAW_HASH_COLUMN]])
+    return len(new)
+
+def compute_full_indicators(data, indicators=None):
+    """ Adds the indicators with full = True (e.g. FftLowPass) to data, which needs to contain their inputs.
+        They are cheap for the few thousand daily rows but would have to be rewritten completely on every update
+        if they were materialized.
+    """
+    indicators = INDICATORS if indicators is None else indicators
+    data = data.sort_values(by='Date').reset_index(drop=True)
+    for indicator in indicators:
+        if indicator.full and all(c in data.columns for c in indicator.inputs):
+            data[indicator.name] = indicator.compute(data)
+    return data
+
+def check_indicators(filename, table='kpi', indicator_table='kpi_indicators', indicators=None, rtol=1e-9):
+    """ Compares the materialized indicators with a full recomputation over the same raw data.
+
+    Returns:
+        dict: column -> number of dates whose materialized value differs, only columns with differences.
+    """
+    indicators = INDICATORS if indicators is None else indicators
+    incremental = [i for i in indicators if not i.full]
+    raw = open_storage(filename, table=table).read().sort_values(by='Date').reset_index(drop=True)
+    expected = _update(incremental, pd.DataFrame(columns=['Date']), raw)
+    stored = open_storage(filename, table=indicator_table).read()
+
+    differences = dict()
+    merged = expected.merge(stored, on='Date', how='left', suffixes=('', '_stored'))
+    for column in _materialized_columns(incremental, expected)[1:]:
+        values = merged[column].astype(float).values
+        materialized = merged[column + '_stored' if column + '_stored' in merged.columns else column].astype(float).values
+        different = ~np.isclose(values, materialized, rtol=rtol, atol=1e-12, equal_nan=True)
+        if different.any():
+            differences[column] = int(different.sum())
+    return differences
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Materializes the KPI indicators incrementally.')
+    parser.add_argument('--full', action='store_true', help='recompute all dates')
+    parser.add_argument('--check', action='store_true', help='compare the materialized indicators with a full recomputation')
+    args = parser.parse_args(argv)
+
+    load_config()
+    register_default_indicators()
+    print('...done. Updated indicators of {} dates.'.format(update_indicators('data/findat.sqlite3', full=args.full)))
+    if args.check:
+        differences = check_indicators('data/findat.sqlite3')
+        for column, count in sorted(differences.items()):
+            print('ERROR: {} differs from a full recomputation on {} dates.'.format(column, count))
+        if differences:
+            sys.exit(1)
+        print('Materialized indicators match a full recomputation.')
+
+if __name__ == "__main__":
+    # we assume this code is in /src/kpi while data is in /data. Since we do not want to assume a cwd we switch to src and than move one up
+    path = os.path.dirname(os.path.realpath(__file__))
+    os.chdir(path)
+    os.chdir(os.path.pardir)
+    os.chdir(os.path.pardir)
+
+    main()
@@ -1,43 +1,108 @@
 import json
 import os
+import argparse
+import itertools
 from posixpath import join
 import sys
 import time
 import datetime
 from datetime import date, timedelta
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pandas.core.indexes.base import maybe_extract_name
-import requests
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
 import pandas as pd
 import numpy as np
 
-# from: https://stackoverflow.com/questions/667508/whats-a-good-rate-limiting-algorithm
-def RateLimited(maxPerSecond):
-    minInterval = 1.0 / float(maxPerSecond)
-    def decorate(func):
-        lastTimeCalled = [0.0]
-        def rateLimitedFunction(*args,**kargs):
-            elapsed = time.time() - lastTimeCalled[0]
-            leftToWait = minInterval - elapsed
-            if leftToWait>0:
-                time.sleep(leftToWait)
-            ret = func(*args,**kargs)
-            lastTimeCalled[0] = time.time()
-            return ret
-        return rateLimitedFunction
-    return decorate
+# hacky hack to get relative import
+sys.path.append( os.path.dirname( os.path.dirname(os.path.realpath(__file__)) ) )
+from helper.result_builder import ResultBuilder, SUBMISSION_COLUMNS, COMMENT_COLUMNS, COMMENT_RECORD_COLUMNS
+from helper.storage import open_storage
+from helper.query import read_range
+from helper.rate_limiter import TokenBucket
+from helper import http_client
+from helper.checkpoint import Checkpoint, checkpoint_filename
+from helper import metrics
+
+# base url of the pushshift api, can be pointed to a local stand-in such as helper/replay_server.py
+PUSHSHIFT_URL = os.environ.get('FINDAT_PUSHSHIFT_URL', 'https://api.pushshift.io')
+
+# pushshift allows about one request per second. All requests of all threads go through this bucket, see set_rate_limit
+pushshift_rate_limiter = TokenBucket(rate=1, capacity=1)
+
+def set_rate_limit(requests_per_second, burst=1):
+    pushshift_rate_limiter.set_rate(requests_per_second, burst)
+
+def _rate_limited_get(url):
+    """ Every request to pushshift needs to go through here so that it counts against the shared rate limit.
+    """
+    return http_client.get(url, limiter=pushshift_rate_limiter)
 
 def get_comments_from_entry(entry_id):
-    url = 'https://api.pushshift.io/reddit/comment/search/?link_id={}&limit=2000&sort_type=score&sort=desc'.format(str(entry_id))
-    
-    s = requests.Session()
-    retries = Retry(total=5, backoff_factor=1, status=5, status_forcelist=[502, 503, 504, 429])
-    s.mount('http://', HTTPAdapter(max_retries=retries))
-    r = s.get(url)
-    
-    comments = [x['body'] for x in r.json()['data']]
-    return comments
+    """ Returns the bodies of all comments of the submission with id entry_id.
+    """
+    builder = ResultBuilder(COMMENT_COLUMNS)
+    for entries in iter_comment_pages(link_id=entry_id):
+        builder.add_page(entries)
+    return builder.to_df()['Body'].tolist()
+
+def iter_comment_pages(link_id=None, subreddit=None, date=None, after=None):
+    """ Yields comments page by page (lists of at most 100 pushshift entries) in ascending order of created_utc,
+        either all comments of the submission link_id or all comments in subreddit on date. If after (a created_utc
+        timestamp) is given, only newer comments are returned.
+    """
+    if link_id is not None:
+        query = 'link_id={}'.format(link_id)
+        start_timestamp = 0
+        end_timestamp = None
+    elif subreddit is not None and date is not None:
+        query = 'subreddit={}'.format(subreddit)
+        start_timestamp = int(time.mktime(date.timetuple()))
+        end_timestamp = int(time.mktime((date + datetime.timedelta(days=1)).timetuple()))
+    else:
+        raise ValueError('Either link_id or subreddit and date need to be given!')
+    if after is not None:
+        start_timestamp = max(start_timestamp, after)
+
+    # busy threads get many comments per second, so pages overlap by one second and the comments of that second
+    # which were already returned are skipped
+    seen_ids = set()
+    while True:
+        url = PUSHSHIFT_URL + '/reddit/comment/search/?{}&size={}&after={}&sort=asc&sort_type=created_utc'.format(query, 100, start_timestamp - 1 if seen_ids else start_timestamp)
+        if end_timestamp is not None:
+            url += '&before={}'.format(end_timestamp)
+        r = _rate_limited_get(url)
+
+        if r.status_code != 200:
+            raise ValueError('Failed to get Reddit Comments with code: {}'.format(r.status_code))
+
+        page = r.json()['data']
+        entries = [entry for entry in page if entry['id'] not in seen_ids]
+        metrics.count('pages', endpoint='comment')
+        metrics.count('records', len(entries), endpoint='comment')
+        if len(entries) == 0:
+            if len(page) == 0 or not seen_ids:
+                return
+            # more than a page of comments in one second, continue with the next second
+            seen_ids = set()
+            continue
+        last_timestamp = max(entry['created_utc'] for entry in entries)
+        if last_timestamp != start_timestamp:
+            seen_ids = set()
+        start_timestamp = max(start_timestamp, last_timestamp)
+        seen_ids.update(entry['id'] for entry in entries if entry['created_utc'] == start_timestamp)
+        yield entries
+
+def iter_comment_chunks(pages, date, chunksize=5000):
+    """ Turns pages of comments into DataFrames (see COMMENT_RECORD_COLUMNS) of about chunksize rows, so only one
+        chunk is held in memory at a time no matter how large the thread is.
+    """
+    builder = ResultBuilder(COMMENT_RECORD_COLUMNS, Date=date)
+    for entries in pages:
+        builder.add_page(entries)
+        if len(builder) >= chunksize:
+            yield builder.to_df()
+            builder = ResultBuilder(COMMENT_RECORD_COLUMNS, Date=date)
+    if len(builder) > 0:
+        yield builder.to_df()
 
 def get_expected_number_of_entries(start_date, end_date, subreddit, type_of_entry):
     if type_of_entry not in ['submission', 'comment']:
@@ -45,100 +110,63 @@ def get_expected_number_of_entries(start_date, end_date, subreddit, type_of_entr
     
     start_timestamp = int(time.mktime(start_date.timetuple()))
     end_timestamp = int(time.mktime(end_date.timetuple()))
-    url = 'https://api.pushshift.io/reddit/search/{}/?subreddit={}&after={}&before={}&metadata=true&size=0'.format(type_of_entry, subreddit, start_timestamp, end_timestamp)
-    
-    s = requests.Session()
-    retries = Retry(total=5, backoff_factor=1, status=5, status_forcelist=[502, 503, 504, 429])
-    s.mount('http://', HTTPAdapter(max_retries=retries))
+    url = PUSHSHIFT_URL + '/reddit/search/{}/?subreddit={}&after={}&before={}&metadata=true&size=0'.format(type_of_entry, subreddit, start_timestamp, end_timestamp)
     
-    r = s.get(url)
+    r = _rate_limited_get(url)
     return int(r.json()['metadata']['total_results'])
 
-@RateLimited(1)
-def get_reddit_submissions(subreddit, date):
-    """ Gets all submission within the specified timeframe. Result is a dataframe with every entry in its own row.
+def iter_submission_pages(subreddit, date, after=None):
+    """ Yields all submissions of the specified day page by page (lists of at most 100 pushshift entries) in
+        ascending order of created_utc. If after (a created_utc timestamp) is given, only newer entries are returned.
     """
-    start_date = date
-    end_date = (date + datetime.timedelta(days=1))
-    start_timestamp = int(time.mktime(start_date.timetuple()))
-    end_timestamp = int(time.mktime(end_date.timetuple()))
-
-    # prepare retries
-    s = requests.Session()
-    retries = Retry(total=5, backoff_factor=1, status=5, status_forcelist=[502, 503, 504, 429])
-    s.mount('http://', HTTPAdapter(max_retries=retries))
+    start_timestamp = int(time.mktime(date.timetuple()))
+    end_timestamp = int(time.mktime((date + datetime.timedelta(days=1)).timetuple()))
+    if after is not None:
+        start_timestamp = max(start_timestamp, after)
 
-    # for logging purposes check how many entries we expect
-    expected_entries = get_expected_number_of_entries(start_date, end_date, subreddit, 'submission')
-    number_of_retrieved_entries = 0
-    print("Retrieving {} submissions for {}...".format(expected_entries, date.strftime("%Y-%m-%d")))
-    
-    # the resulting dataframe holding all entries
-    df = make_empty_result_df()
-    
     # main loop: we only get 100 entries per request so we need dynamically adapt the start_timestamp to get all entries
-    running = True
-    while running:
-        url = 'https://api.pushshift.io/reddit/search/submission/?subreddit={}&size={}&after={}&before={}&sort=asc&sort_type=created_utc'.format(subreddit, 100, start_timestamp, end_timestamp)
-        r = s.get(url)
+    while True:
+        url = PUSHSHIFT_URL + '/reddit/search/submission/?subreddit={}&size={}&after={}&before={}&sort=asc&sort_type=created_utc'.format(subreddit, 100, start_timestamp, end_timestamp)
+        r = _rate_limited_get(url)
         
         if r.status_code != 200:
             raise ValueError('Failed to get Reddit Submission with code: {}'.format(r.status_code))
         
-        number_of_entries_found = len( r.json()['data'] )
-        if number_of_entries_found > 0:
-            number_of_retrieved_entries += number_of_entries_found
-            
-            for entry in r.json()['data']:
-                if entry['created_utc'] > start_timestamp:
-                    start_timestamp = entry['created_utc']
-                
-                if 'selftext' not in entry:
-                    entry['selftext'] = ''
-
-                df = df.append(
-                    pd.DataFrame({
-                        'Date': pd.to_datetime(date),
-                        'Title': str(entry['title']),
-                        'Text': str(entry['selftext']),
-                        'Comments': pd.to_numeric(entry['num_comments']),
-                        'Score': pd.to_numeric(entry['score']),
-                        'id': str(entry['id']),
-                    }, index=[len(df)] ) )
-            print('...retrieved {} of {} entries...'.format(number_of_retrieved_entries, expected_entries))
-        else:
-            running = False
-
-    print('...done. Found {} submissions for {}.'.format(len(df), date.strftime("%Y-%m-%d")))
+        entries = r.json()['data']
+        metrics.count('pages', endpoint='submission')
+        metrics.count('records', len(entries), endpoint='submission')
+        if len(entries) == 0:
+            return
+        start_timestamp = max(start_timestamp, max(entry['created_utc'] for entry in entries))
+        yield entries
+
+def get_reddit_submissions(subreddit, date):
+    """ Gets all submission within the specified timeframe. Result is a dataframe with every entry in its own row.
+    """
+    # for logging purposes check how many entries we expect
+    expected_entries = get_expected_number_of_entries(date, date + datetime.timedelta(days=1), subreddit, 'submission')
+    number_of_retrieved_entries = 0
+    print("Retrieving {} submissions for /r/{} on {}...".format(expected_entries, subreddit, date.strftime("%Y-%m-%d")))
+    
+    # the resulting entries are collected page by page and turned into one dataframe at the end
+    builder = ResultBuilder(SUBMISSION_COLUMNS, Date=date)
+    for entries in iter_submission_pages(subreddit, date):
+        number_of_retrieved_entries += len(entries)
+        builder.add_page(entries)
+        print('...retrieved {} of {} entries for /r/{} on {}...'.format(number_of_retrieved_entries, expected_entries, subreddit, date.strftime("%Y-%m-%d")))
+
+    df = builder.to_df()
+    print('...done. Found {} submissions for /r/{} on {}.'.format(len(df), subreddit, date.strftime("%Y-%m-%d")))
     return df
 
 def make_empty_result_df():
-    return pd.DataFrame({
-                    'Date': np.datetime64(),
-                    'Title': str(),
-                    'Text': str(),
-                    'Comments': int(),
-                    'Score': int(),
-                    'id': str(),
-                    }, index=[])
-
-def store_in_database(data, filename, dupilcate_column=None):
-    """ Stores the DataFrame data in file with filename. Duplicates can be identified by a column name.
-    """
-    # create empty file with correct headers if necessary
-    if os.path.exists(filename) is not True:
-        make_empty_result_df().to_csv(filename, sep=';', decimal='.', encoding='utf-8', index=False)
-    
-    # add new entry
-    df = pd.read_csv(filename, sep=';', decimal='.', encoding='utf-8', parse_dates=['Date'])
-    df = df.append(data).reset_index(drop=True)
-    
-    # check/remove duplicates in date column
-    if dupilcate_column:
-        df = df.drop_duplicates(subset=[dupilcate_column], keep='last')
+    return ResultBuilder(SUBMISSION_COLUMNS).to_df()
 
-    # save to file
-    df.to_csv(filename, sep=';', decimal='.', encoding='utf-8', index=False)
+def store_in_database(data, filename, dupilcate_column=None, table=None):
+    """ Stores the DataFrame data in file with filename (CSV, SQLite or Parquet, see helper.storage.open_storage).
+        Duplicates can be identified by a column name.
+    """
+    open_storage(filename, table=table, key=dupilcate_column).insert(data)
 
 def _fix_cwd():
     """ Makes sure we are in project root, we assume we are two levels deep
@@ -149,42 +177,375 @@ def _fix_cwd():
     os.chdir(os.path.pardir)
     print('Working dir: ', os.getcwd())
 
-def get_all_submissions(dates, subreddit, db_filename):
-    """ Gets submissions for all dates of the specified subreddit.
+def _submission_table(subreddit):
+    return 'reddit_' + subreddit + '_submissions'
+
+def _run_jobs_concurrently(jobs, fetch, store=None, max_workers=8):
+    """ Runs fetch(subreddit, date) for all jobs, i.e. (subreddit, date) tuples, with max_workers threads and hands
+        the results to store(subreddit, date, result) in the calling thread. Only a few results are kept in flight so
+        memory stays bounded even for multi-year backfills.
 
     Returns:
-        list of dates: List of dates which could not be retreived.
+        list of jobs: List of (subreddit, date) tuples which failed.
     """
     retry_list = list()
-    for running_date in dates:
-        try:
-            data = get_reddit_submissions(date=running_date, subreddit=subreddit)
-            store_in_database(data, db_filename, dupilcate_column='id')
-        except:
-            retry_list.append(running_date)
-            print('ERROR: failed to get submissions for {} with error {}'.format(running_date.strftime("%Y-%m-%d"), sys.exc_info()))
+    pending_jobs = iter(jobs)
+    running = dict()
+    timed_fetch = metrics.timer('job')(fetch)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            # keep the pool busy, but do not hold more results than necessary in memory
+            for subreddit, running_date in itertools.islice(pending_jobs, 2 * max_workers - len(running)):
+                future = executor.submit(timed_fetch, subreddit, running_date)
+                running[future] = (subreddit, running_date, time.perf_counter())
+            
+            if len(running) == 0:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                subreddit, running_date, submitted = running.pop(future)
+                day = running_date.strftime("%Y-%m-%d")
+                try:
+                    result = future.result()
+                    if store is not None:
+                        store(subreddit, running_date, result)
+                except Exception as e:
+                    seconds = time.perf_counter() - submitted
+                    retry_list.append((subreddit, running_date))
+                    metrics.count('failed_jobs', error=type(e).__name__)
+                    metrics.log_event('job_failed', subreddit=subreddit, day=day, error=type(e).__name__, message=str(e), seconds=seconds)
+                    print('ERROR: failed to fetch /r/{} on {} after {:.1f}s with {}: {}'.format(subreddit, day, seconds, type(e).__name__, e))
+                else:
+                    metrics.log_event('job_finished', subreddit=subreddit, day=day, seconds=time.perf_counter() - submitted)
     return retry_list
+
+def get_submissions_concurrently(jobs, db_filename, max_workers=8):
+    """ Gets the submissions for all jobs, i.e. (subreddit, date) tuples, with max_workers threads and stores them in
+        table reddit_<subreddit>_submissions. Throughput is bounded by the shared pushshift_rate_limiter, the threads
+        only make sure that the limiter is never idle while waiting for slow responses. Stored days are touched in
+        the checkpoint of the subreddit, so the rollup notices them.
+
+    Returns:
+        list of jobs: List of (subreddit, date) tuples which could not be retreived.
+    """
+    checkpoints = {subreddit: get_checkpoint(subreddit, db_filename) for subreddit in set(subreddit for subreddit, _ in jobs)}
+
+    def fetch(subreddit, running_date):
+        return get_reddit_submissions(subreddit=subreddit, date=running_date)
+
+    def store(subreddit, running_date, data):
+        store_in_database(data, db_filename, dupilcate_column='id', table=_submission_table(subreddit))
+        checkpoints[subreddit].touch_day(running_date.strftime("%Y-%m-%d"))
+
+    return _run_jobs_concurrently(jobs, fetch, store, max_workers=max_workers)
+
+def get_all_submissions(dates, subreddit, db_filename, max_workers=8):
+    """ Gets submissions for all dates of the specified subreddit and stores them in table reddit_<subreddit>_submissions.
+
+    Returns:
+        list of dates: List of dates which could not be retreived.
+    """
+    jobs = [(subreddit, running_date) for running_date in dates]
+    return [running_date for _, running_date in get_submissions_concurrently(jobs, db_filename, max_workers=max_workers)]
+
+def _comment_table(subreddit):
+    return 'reddit_' + subreddit + '_comments'
+
+def store_comment_chunks(chunks, db_filename, subreddit):
+    """ Stores all chunks of comments in table reddit_<subreddit>_comments.
+
+    Returns:
+        int: number of stored comments.
+    """
+    stored = 0
+    for chunk in chunks:
+        store_in_database(chunk, db_filename, dupilcate_column='id', table=_comment_table(subreddit))
+        stored += len(chunk)
+    return stored
+
+def get_comment_checkpoint(subreddit, db_filename, mode='day'):
+    """ Returns the checkpoint of the comments of subreddit fetched in mode 'day' or 'top' (see
+        get_comments_concurrently), stored next to the database in checkpoints/.
+    """
+    name = _comment_table(subreddit) + ('' if mode == 'day' else '_' + mode)
+    return Checkpoint(checkpoint_filename(db_filename, name))
+
+def fetch_comments_resumable(subreddit, date, db_filename, checkpoint, key, link_id=None, chunksize=5000):
+    """ Streams the comments of the submission link_id (or with link_id None all comments in subreddit on date)
+        into the database, starting after the last stored comment of key in the checkpoint. Every chunk is
+        checkpointed right after it was stored, so a crash only loses the chunk in flight.
+
+    Returns:
+        int: number of comments stored by this call.
+    """
+    progress = checkpoint.get_day(key)
+    if progress['complete']:
+        return 0
+    after, retrieved = progress['after'], progress['retrieved']
+    # a chunk may end within a second, so its last second is fetched again (comments are stored by id)
+    resume = None if after is None else after - 1
+    if link_id is not None:
+        pages = iter_comment_pages(link_id=link_id, after=resume)
+    else:
+        pages = iter_comment_pages(subreddit=subreddit, date=date, after=resume)
+
+    stored = 0
+    for chunk in iter_comment_chunks(pages, date, chunksize):
+        store_in_database(chunk, db_filename, dupilcate_column='id', table=_comment_table(subreddit))
+        after = max(after or 0, int(chunk['Created'].max()))
+        retrieved += len(chunk)
+        stored += len(chunk)
+        checkpoint.update_day(key, after=after, retrieved=retrieved)
+    checkpoint.update_day(key, after=after, retrieved=retrieved, complete=True)
+    return stored
+
+def fetch_comments_of_submission(subreddit, date, entry_id, db_filename, checkpoint, chunksize=5000):
+    """ Streams all comments of the submission entry_id (posted in subreddit on date) into the database.
+    """
+    key = '{}/{}'.format(date.strftime("%Y-%m-%d"), entry_id)
+    return fetch_comments_resumable(subreddit, date, db_filename, checkpoint, key, link_id=entry_id, chunksize=chunksize)
+
+def fetch_comments_of_day(subreddit, date, db_filename, checkpoint, chunksize=5000):
+    """ Streams all comments made in subreddit on date into the database, resuming a partially fetched day.
+    """
+    day = date.strftime("%Y-%m-%d")
+    if checkpoint.get_day(day)['complete']:
+        return 0
+    print("Retrieving comments for /r/{} on {}...".format(subreddit, day))
+    stored = fetch_comments_resumable(subreddit, date, db_filename, checkpoint, day, chunksize=chunksize)
+    print('...done. Found {} comments for /r/{} on {}.'.format(stored, subreddit, day))
+    return stored
+
+def get_top_submission_ids(subreddit, date, db_filename, top_n=10):
+    """ Returns the ids of the top_n stored submissions of the day by score.
+    """
+    start = pd.Timestamp(date).normalize()
+    data = read_range(db_filename, table=_submission_table(subreddit), start=start, end=start + pd.Timedelta(days=1), columns=['id', 'Score'])
+    if len(data) == 0:
+        return []
+    return data.nlargest(top_n, 'Score')['id'].tolist()
+
+def fetch_comments_of_top_submissions(subreddit, date, db_filename, checkpoint, top_n=10, max_workers=8, chunksize=5000):
+    """ Streams the comment threads of the top_n submissions of the day (see get_top_submission_ids) into the
+        database, max_workers threads at once. The submissions of the day need to be stored already. Threads and
+        days which were completed before are skipped.
+
+    Returns:
+        int: number of stored comments.
+    """
+    day = date.strftime("%Y-%m-%d")
+    if checkpoint.get_day(day)['complete']:
+        return 0
+    entry_ids = get_top_submission_ids(subreddit, date, db_filename, top_n=top_n)
+    print("Retrieving comments of the top {} submissions for /r/{} on {}...".format(len(entry_ids), subreddit, day))
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(entry_ids)))) as executor:
+        stored = sum(executor.map(lambda entry_id: fetch_comments_of_submission(subreddit, date, entry_id, db_filename, checkpoint, chunksize), entry_ids))
+    checkpoint.update_day(day, retrieved=len(entry_ids), complete=True)
+    print('...done. Found {} comments for /r/{} on {}.'.format(stored, subreddit, day))
+    return stored
+
+def get_comments_concurrently(jobs, db_filename, mode='day', top_n=10, max_workers=8):
+    """ Streams the comments for all jobs, i.e. (subreddit, date) tuples, into table reddit_<subreddit>_comments.
+        mode 'day' fetches all comments of the day, mode 'top' the threads of the top_n submissions of the day.
+        Progress is checkpointed like the submissions (see get_comment_checkpoint), so completed days are skipped
+        and interrupted ones resumed.
+
+    Returns:
+        list of jobs: List of (subreddit, date) tuples which could not be retreived.
+    """
+    checkpoints = {subreddit: get_comment_checkpoint(subreddit, db_filename, mode) for subreddit in set(subreddit for subreddit, _ in jobs)}
+
+    def fetch(subreddit, running_date):
+        if mode == 'top':
+            # the jobs already run in parallel, so the threads of a day are fetched one after another
+            return fetch_comments_of_top_submissions(subreddit, running_date, db_filename, checkpoints[subreddit], top_n=top_n, max_workers=1)
+        return fetch_comments_of_day(subreddit, running_date, db_filename, checkpoints[subreddit])
+
+    return _run_jobs_concurrently(jobs, fetch, max_workers=max_workers)
+
+def get_checkpoint(subreddit, db_filename):
+    """ Returns the backfill checkpoint of the subreddit, stored next to the database in checkpoints/.
+    """
+    return Checkpoint(checkpoint_filename(db_filename, _submission_table(subreddit)))
+
+def find_missing_days(subreddit, dates, db_filename, checkpoint):
+    """ Returns the days which still need to be fetched: days not marked complete in the checkpoint and whose number of
+        stored submissions is below get_expected_number_of_entries (or whose expected number could not be retrieved).
+        Days found to be complete are marked in the checkpoint so later runs skip them without asking pushshift again.
+    """
+    stored_counts = open_storage(db_filename, table=_submission_table(subreddit)).count_per_date()
+    missing_days = list()
+    for running_date in dates:
+        day = running_date.strftime("%Y-%m-%d")
+        progress = checkpoint.get_day(day)
+        if progress['complete']:
+            continue
         
+        stored = int(stored_counts.get(pd.Timestamp(running_date), 0))
+        if stored > 0 and progress['after'] is None:
+            try:
+                expected = get_expected_number_of_entries(running_date, running_date + datetime.timedelta(days=1), subreddit, 'submission')
+            except Exception as e:
+                # without the expected number the day cannot be checked, so it is simply fetched again
+                metrics.count('failed_metadata', subreddit=subreddit, error=type(e).__name__)
+                metrics.log_event('metadata_failed', subreddit=subreddit, day=day, error=type(e).__name__, message=str(e))
+                print('ERROR: could not get the number of submissions of /r/{} on {} with {}: {}'.format(subreddit, day, type(e).__name__, e))
+                missing_days.append(running_date)
+                continue
+            if stored >= expected:
+                checkpoint.update_day(day, after=None, retrieved=stored, complete=True)
+                continue
+            print('/r/{} on {} is incomplete: {} of {} submissions stored.'.format(subreddit, day, stored, expected))
+        missing_days.append(running_date)
+    return missing_days
+
+def is_day_complete(subreddit, date, db_filename):
+    """ Whether the number of stored submissions of the day reached get_expected_number_of_entries. False if the
+        expected number could not be retrieved.
+    """
+    day = date.strftime("%Y-%m-%d")
+    start = pd.Timestamp(date).normalize()
+    stored = len(read_range(db_filename, table=_submission_table(subreddit), start=start, end=start + pd.Timedelta(days=1), columns=['id']))
+    try:
+        expected = get_expected_number_of_entries(date, date + datetime.timedelta(days=1), subreddit, 'submission')
+    except Exception as e:
+        metrics.count('failed_metadata', subreddit=subreddit, error=type(e).__name__)
+        metrics.log_event('metadata_failed', subreddit=subreddit, day=day, error=type(e).__name__, message=str(e))
+        print('ERROR: could not get the number of submissions of /r/{} on {} with {}: {}'.format(subreddit, day, type(e).__name__, e))
+        return False
+    if stored < expected:
+        print('/r/{} on {} is incomplete: {} of {} submissions stored.'.format(subreddit, day, stored, expected))
+    return stored >= expected
+
+def fetch_day_resumable(subreddit, date, db_filename, checkpoint):
+    """ Fetches the submissions of one day starting after the last stored entry of the checkpoint. Every page is
+        stored and checkpointed right away, so a crash only loses the page in flight.
+
+    Returns:
+        int: number of submissions stored for this day.
+    """
+    day = date.strftime("%Y-%m-%d")
+    progress = checkpoint.get_day(day)
+    after, retrieved = progress['after'], progress['retrieved']
+    print("Retrieving submissions for /r/{} on {}{}...".format(subreddit, day, '' if after is None else ', resuming after {} entries'.format(retrieved)))
+
+    for entries in iter_submission_pages(subreddit, date, after=after):
+        builder = ResultBuilder(SUBMISSION_COLUMNS, Date=date)
+        builder.add_page(entries)
+        store_in_database(builder.to_df(), db_filename, dupilcate_column='id', table=_submission_table(subreddit))
+
+        after = max(entry['created_utc'] for entry in entries)
+        retrieved += len(entries)
+        checkpoint.update_day(day, after=after, retrieved=retrieved)
+        print('...retrieved {} entries for /r/{} on {}...'.format(retrieved, subreddit, day))
+
+    # pushshift may not have ingested all submissions of recent days yet, so the day is only complete once all of
+    # them are stored, otherwise the next run resumes it
+    complete = is_day_complete(subreddit, date, db_filename)
+    checkpoint.update_day(day, after=after, retrieved=retrieved, complete=complete)
+    print('...done. Found {} submissions for /r/{} on {}{}.'.format(retrieved, subreddit, day, '' if complete else ' (incomplete)'))
+    return retrieved
+
+def get_missing_submissions(jobs, db_filename, max_workers=8):
+    """ Incremental version of get_submissions_concurrently: only days which are not yet complete are fetched and
+        partially fetched days are resumed, see find_missing_days and fetch_day_resumable.
+
+    Returns:
+        list of jobs: List of (subreddit, date) tuples which could not be retreived.
+    """
+    checkpoints = dict()
+    missing_jobs = list()
+    for subreddit in sorted(set(subreddit for subreddit, _ in jobs)):
+        checkpoints[subreddit] = get_checkpoint(subreddit, db_filename)
+        dates = [running_date for s, running_date in jobs if s == subreddit]
+        missing_jobs += [(subreddit, running_date) for running_date in find_missing_days(subreddit, dates, db_filename, checkpoints[subreddit])]
+    print('{} of {} days need to be fetched.'.format(len(missing_jobs), len(jobs)))
+
+    def fetch(subreddit, running_date):
+        return fetch_day_resumable(subreddit, running_date, db_filename, checkpoints[subreddit])
 
-def main():
+    return _run_jobs_concurrently(missing_jobs, fetch, max_workers=max_workers)
+
+def _default_start_date(subreddits, db_filename):
+    """ The earliest day of all subreddits which is not complete in the checkpoint (e.g. left behind by a crash) or
+        else the day of the high water mark, so every subreddit continues where it stopped.
+    """
+    start_dates = list()
+    for subreddit in subreddits:
+        checkpoint = get_checkpoint(subreddit, db_filename)
+        if checkpoint.high_water_mark is None:
+            return datetime.date(2021, 8, 10)
+        last_day = datetime.date.fromtimestamp(checkpoint.high_water_mark)
+        first_incomplete = checkpoint.first_incomplete_day(last_day.isoformat())
+        start_dates.append(last_day if first_incomplete is None else datetime.date.fromisoformat(first_incomplete))
+    return min(start_dates)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Fetches reddit submissions from pushshift.')
+    parser.add_argument('--start', default=None, help='first day to fetch, e.g. 2010-01-01. Defaults to the last fetched day')
+    parser.add_argument('--end', default=None, help='last day to fetch, defaults to yesterday')
+    parser.add_argument('--subreddits', nargs='+', default=['wallstreetbets'], help='e.g. wallstreetbets stocks investing stockmarket pennystocks')
+    parser.add_argument('--workers', type=int, default=8, help='number of concurrent fetch threads')
+    parser.add_argument('--rate', type=float, default=1.0, help='allowed pushshift requests per second (all threads)')
+    parser.add_argument('--burst', type=int, default=1, help='allowed burst of pushshift requests')
+    parser.add_argument('--refetch', action='store_true', help='fetch all days again instead of only missing ones')
+    parser.add_argument('--comments', choices=['day', 'top'], default=None, help='also fetch all comments of each day (day) or the threads of its top submissions (top)')
+    parser.add_argument('--top', type=int, default=10, help='number of submissions per day whose comments are fetched with --comments top')
+    metrics.add_arguments(parser)
+    return parser.parse_args(argv)
+
+def fetch(db_filename, subreddits, start_date=None, end_date=None, workers=8, refetch=False, comments=None, top_n=10, max_number_retries=5):
+    """ Fetches the submissions (and with comments 'day' or 'top' the comments, see get_comments_concurrently) of
+        subreddits from start_date (default: where the last run stopped) to end_date (default: yesterday).
+
+    Returns:
+        list of jobs: List of (subreddit, date) tuples which could not be retreived.
+    """
+    start_date = start_date or _default_start_date(subreddits, db_filename)
+    end_date = end_date or date.today() - timedelta(days=1)
+    list_of_dates = pd.date_range(start=start_date, end=end_date, freq='D').to_pydatetime()
+    jobs = [(subreddit, running_date) for running_date in list_of_dates for subreddit in subreddits]
+    
+    with metrics.stage('reddit_submissions'):
+        retries = 0
+        working_list = jobs
+        while working_list and retries < max_number_retries:
+            if refetch:
+                working_list = get_submissions_concurrently(working_list, db_filename, max_workers=workers)
+            else:
+                working_list = get_missing_submissions(working_list, db_filename, max_workers=workers)
+            retries +=1
+    failed = working_list
+
+    if comments:
+        with metrics.stage('reddit_comments'):
+            retries = 0
+            working_list = jobs
+            while working_list and retries < max_number_retries:
+                working_list = get_comments_concurrently(working_list, db_filename, mode=comments, top_n=top_n, max_workers=workers)
+                retries +=1
+        failed = failed + working_list
+    return failed
+
+def main(argv=None):
     # settings
-    start_date = datetime.date(2021, 8, 10)
-    end_date = date.today() - timedelta(days=1)
-    subreddit = 'wallstreetbets'
-    db_filename = 'data/reddit_' + subreddit + '_submissions_2018-2021.csv'
-    max_number_retries = 5
+    args = parse_args(argv)
+    set_rate_limit(args.rate, args.burst)
+    metrics.apply_arguments(args)
+    http_client.configure(pool_maxsize=max(args.workers, http_client.POOL_MAXSIZE))
 
     # we assume this code is in /src/analysis while data is in /data. Since we do not want to assume a cwd we switch to src and than move one up
     _fix_cwd()
 
     # start to work...
-    list_of_dates = pd.date_range(start=start_date, end=end_date, freq='D').to_pydatetime()
-    
-    retries = 0
-    working_list = list_of_dates
-    while retries < max_number_retries:
-        working_list = get_all_submissions(working_list, subreddit, db_filename)
-        retries +=1
+    start_date = datetime.datetime.strptime(args.start, "%Y-%m-%d").date() if args.start else None
+    end_date = datetime.datetime.strptime(args.end, "%Y-%m-%d").date() if args.end else None
+    fetch('data/findat.sqlite3', args.subreddits, start_date, end_date, workers=args.workers, refetch=args.refetch,
+          comments=args.comments, top_n=args.top)
+
+    http_client.count_connections()
+    metrics.finish(args)
 
 if __name__ == "__main__":
     main()
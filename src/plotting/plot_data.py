@@ -1,49 +1,153 @@
 import os
+import sys
+import shutil
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 import datetime as dt
-import seaborn as sns
-
-def load_data_from_database(filename):
-    return pd.read_csv(filename, sep=';', decimal='.', encoding='utf-8', parse_dates=['Date'])
-
-def plot_indicator(data, indicator):
-    plt.figure(figsize=(20,10))
-    plt.plot(data['Date'], data[indicator], marker='', markersize=2, linestyle=':', linewidth=1, color='r', label=indicator)
-    plt.plot(data['Date'], data[indicator].rolling(7).mean(), label=indicator + '_7D')
-    plt.plot(data['Date'], data[indicator].rolling(21).mean(), label=indicator + '_14D')
-    plt.plot(data['Date'], data[indicator].ewm(alpha=0.001).mean(), label=indicator + '_EMA')
-
-    # try:
-    #     data = data.set_index('Date')
-    #     ts = data[indicator].resample('H')
-    #     ts = ts.interpolate(method='polynomial', order=3)
-    #     ts.plot()
-    # except:
-    #     pass
-
-    plt.title(indicator)
-    plt.legend()
-
-    try:
-        os.mkdir('plots/' + dt.datetime.now().strftime("%Y-%m-%d")+'/')
-    except:
-        pass
-
-    plt.savefig('plots/' + dt.datetime.now().strftime("%Y-%m-%d")+'/' + indicator + '.png', dpi=300)
-    plt.close()
-
-def plot_data(data):
-    for indicator in data.columns:
-        if indicator == 'Date':
-            continue
-        plot_indicator(data, indicator)
-
-def compute_indicators(data):
-    data['VIX3M_VIX'] = data['VIX3M'] / data['VIX']
-    data['VIX3M-VIX'] = data['VIX3M'] - data['VIX']
-    return data
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# hacky hack to get relative import
+sys.path.append( os.path.dirname( os.path.dirname(os.path.realpath(__file__)) ) )
+from helper.query import read_range
+from helper.atomic_file import read_json, write_json
+from kpi.fetch_new_data import load_config
+from kpi.indicators import register_default_indicators, update_indicators, compute_full_indicators, state_columns
+
+# materialized smoothings of an indicator which are drawn into its plot, see kpi.indicators.register_smoothing
+SMOOTHING_SUFFIXES = ['_7D', '_21D', '_EMA']
+
+# bump when the look of the charts changes, so all charts are drawn again
+RENDER_VERSION = 1
+
+def load_data_from_database(filename, table='kpi', indicator_table='kpi_indicators', start=None, end=None):
+    """ Returns the KPIs with start <= Date < end (both optional) joined with their materialized indicators (if
+        indicator_table is given and exists) and the indicators which are computed over the whole loaded range
+        (e.g. the FFT low pass).
+    """
+    data = read_range(filename, table=table, start=start, end=end)
+    if indicator_table:
+        indicators = read_range(filename, table=indicator_table, start=start, end=end)
+        if len(indicators) > 0:
+            indicators = indicators.drop(columns=[c for c in state_columns() if c in indicators.columns])
+            data = data.merge(indicators, on='Date', how='left', suffixes=('', '_indicator'))
+    return compute_full_indicators(data)
+
+def render_indicator(fig, data, indicator):
+    """ Draws indicator and its smoothings into the (cleared) figure fig.
+    """
+    ax = fig.add_subplot(1, 1, 1)
+    _draw_indicator(ax, data, indicator)
+
+def _draw_indicator(ax, data, indicator):
+    ax.plot(data['Date'], data[indicator], marker='', markersize=2, linestyle=':', linewidth=1, color='r', label=indicator)
+    for suffix in SMOOTHING_SUFFIXES:
+        if indicator + suffix in data.columns:
+            ax.plot(data['Date'], data[indicator + suffix], label=indicator + suffix)
+    ax.set_title(indicator)
+    ax.legend()
+
+def plot_indicator(data, indicator, directory=None, dpi=300, fig=None):
+    """ Saves the chart of indicator as <directory>/<indicator>.png. Uses matplotlib's object oriented API only,
+        so it is safe to call from several processes; pass fig to reuse a figure for several charts.
+    """
+    directory = directory or _plot_directory()
+    os.makedirs(directory, exist_ok=True)
+    if fig is None:
+        fig = Figure(figsize=(20,10))
+        FigureCanvasAgg(fig)
+    fig.clear()
+    render_indicator(fig, data, indicator)
+    filename = os.path.join(directory, indicator + '.png')
+    fig.savefig(filename, dpi=dpi)
+    return filename
+
+def plot_grid(data, indicators, filename, columns=2, dpi=150):
+    """ Saves all indicators as one grid of charts in a single figure.
+    """
+    rows = max(1, -(-len(indicators) // columns))
+    fig = Figure(figsize=(10 * columns, 5 * rows))
+    FigureCanvasAgg(fig)
+    for i, indicator in enumerate(indicators):
+        _draw_indicator(fig.add_subplot(rows, columns, i + 1), data, indicator)
+    fig.tight_layout()
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    fig.savefig(filename, dpi=dpi)
+    return filename
+
+def _plot_batch(data, indicators, directory, dpi):
+    """ Worker of plot_data: renders several charts reusing one figure.
+    """
+    fig = Figure(figsize=(20,10))
+    FigureCanvasAgg(fig)
+    return [plot_indicator(data, indicator, directory, dpi=dpi, fig=fig) for indicator in indicators]
+
+def _plot_directory():
+    return 'plots/' + dt.datetime.now().strftime("%Y-%m-%d")
+
+def chart_columns(data, indicator):
+    return ['Date', indicator] + [indicator + suffix for suffix in SMOOTHING_SUFFIXES if indicator + suffix in data.columns]
+
+def chart_hash(data, indicator, dpi):
+    """ Hash of everything a chart depends on, charts with an unchanged hash do not need to be drawn again.
+    """
+    columns = chart_columns(data, indicator)
+    h = hashlib.sha1('{}|{}|{}'.format(RENDER_VERSION, dpi, ','.join(columns)).encode('utf-8'))
+    h.update(pd.util.hash_pandas_object(data[columns], index=False).values.tobytes())
+    return h.hexdigest()
+
+def plot_data(data, directory=None, processes=None, grid=False, dpi=300, manifest_filename='plots/manifest.json', force=False, mp_context=None):
+    """ Saves one chart per indicator into directory (default plots/<today>). Charts whose input data did not
+        change since the last run (see manifest_filename) are copied from the last run instead of being drawn.
+        The remaining charts are drawn in a process pool of processes workers (default: all cores), each worker
+        reusing one figure for its charts. With grid = True all charts are additionally saved as overview.png.
+        Pass a spawn or forkserver mp_context when calling from a thread of a multi-threaded process.
+
+    Returns:
+        list: indicators which were drawn.
+    """
+    directory = directory or _plot_directory()
+    os.makedirs(directory, exist_ok=True)
+    indicators = [c for c in data.columns if c != 'Date' and not any(c.endswith(suffix) for suffix in SMOOTHING_SUFFIXES)]
+
+    manifest = dict() if force else read_json(manifest_filename, dict())
+    hashes = {indicator: chart_hash(data, indicator, dpi) for indicator in indicators}
+    changed = list()
+    for indicator in indicators:
+        entry = manifest.get(indicator)
+        if entry and entry['hash'] == hashes[indicator] and os.path.exists(entry['file']):
+            target = os.path.join(directory, indicator + '.png')
+            if os.path.abspath(entry['file']) != os.path.abspath(target):
+                shutil.copyfile(entry['file'], target)
+        else:
+            changed.append(indicator)
+
+    processes = min(processes or os.cpu_count() or 1, len(changed))
+    batches = [changed[i::processes] for i in range(processes)]
+    if processes <= 1:
+        results = [_plot_batch(data, batch, directory, dpi) for batch in batches]
+    else:
+        with ProcessPoolExecutor(max_workers=processes, mp_context=mp_context) as executor:
+            # workers only get the columns of their charts
+            futures = [executor.submit(_plot_batch, data[list(dict.fromkeys(c for i in batch for c in chart_columns(data, i)))], batch, directory, dpi) for batch in batches]
+            results = [future.result() for future in futures]
+
+    for batch, files in zip(batches, results):
+        for indicator, filename in zip(batch, files):
+            manifest[indicator] = {'hash': hashes[indicator], 'file': filename}
+    write_json(manifest_filename, manifest, indent=1)
+
+    if grid:
+        plot_grid(data, indicators, os.path.join(directory, 'overview.png'))
+    return changed
+
+def plot_database(filename, directory=None, processes=None, grid=False, force=False, mp_context=None):
+    """ Plots the KPIs and materialized indicators stored in filename, see plot_data.
+    """
+    return plot_data(load_data_from_database(filename), directory=directory, processes=processes, grid=grid, force=force, mp_context=mp_context)
 
 if __name__ == "__main__":
     # we assume this code is in /src/plotting while data is in /data. Since we do not want to assume a cwd we switch to src and than move one up
@@ -52,6 +156,14 @@ if __name__ == "__main__":
     os.chdir(os.path.pardir)
     os.chdir(os.path.pardir)
 
-    data = load_data_from_database('data/database.csv')
-    data = compute_indicators(data)
-    plot_data(data)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Plots all KPIs and indicators into plots/<today>.')
+    parser.add_argument('--processes', type=int, default=None, help='number of rendering processes (default: all cores)')
+    parser.add_argument('--grid', action='store_true', help='additionally save all charts in one overview.png')
+    parser.add_argument('--force', action='store_true', help='draw all charts, even unchanged ones')
+    args = parser.parse_args()
+
+    load_config()
+    register_default_indicators()
+    update_indicators('data/findat.sqlite3')
+    changed = plot_database('data/findat.sqlite3', processes=args.processes, grid=args.grid, force=args.force)
+    print('...done. Drew {} charts.'.format(len(changed)))
\ No newline at end of file
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+
+# hacky hack to get relative import
+sys.path.append( os.path.dirname(os.path.realpath(__file__)) )
+from helper.pipeline import Pipeline, table_fingerprint
+from helper import metrics, http_client
+from kpi import fetch_new_data
+from kpi.indicators import register_default_indicators, update_indicators
+from media import fetch_from_reddit
+from analysis import rollup
+from plotting import plot_data
+
+STATE_FILENAME = 'data/checkpoints/pipeline.json'
+
+def split_cores(jobs=None, processes=None):
+    """ Rollup (jobs) and plots (processes) may run at the same time, so the cores which are not given explicitly
+        are split between them instead of both using all cores.
+    """
+    cores = os.cpu_count() or 1
+    if jobs is None and processes is None:
+        jobs = max(1, cores // 2)
+    if jobs is None:
+        jobs = max(1, cores - processes)
+    if processes is None:
+        processes = max(1, cores - jobs)
+    return jobs, processes
+
+def process_context():
+    """ The process pools are started from pipeline threads, where forking may copy locks held by other threads.
+    """
+    return multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+def fetch_reddit(db_filename, subreddits, workers=8, comments=None, top_n=10):
+    """ fetch_from_reddit.fetch as stage: jobs which still failed after all retries fail the stage, so the rollup
+        is not run on incomplete days.
+    """
+    failed = fetch_from_reddit.fetch(db_filename, subreddits, workers=workers, comments=comments, top_n=top_n)
+    if failed:
+        raise RuntimeError('{} reddit jobs failed: {}'.format(len(failed), ', '.join('/r/{} on {}'.format(s, d.strftime('%Y-%m-%d')) for s, d in failed[:10])))
+
+def build_pipeline(db_filename, subreddits, workers=8, jobs=None, processes=None, comments=None, top_n=10):
+    """ The nightly run: the KPI snapshot and the reddit fetch run at the same time, the indicators and plots
+        follow the KPIs, the daily rollups (sentiment scoring) follow the submissions. Rollup and plots share the
+        cores, see split_cores.
+    """
+    jobs, processes = split_cores(jobs, processes)
+    context = process_context()
+    pipeline = Pipeline(STATE_FILENAME)
+    # the KPI tables are small enough to hash completely, the submission tables are fingerprinted by their rows per day
+    pipeline.dataset('kpi', lambda: table_fingerprint(db_filename, 'kpi', content=True))
+    pipeline.dataset('kpi_indicators', lambda: table_fingerprint(db_filename, 'kpi_indicators', content=True))
+    pipeline.dataset('submissions', lambda: [table_fingerprint(db_filename, fetch_from_reddit._submission_table(s)) for s in subreddits])
+    pipeline.dataset('rollups', lambda: [table_fingerprint(db_filename, rollup.rollup_table(s)) for s in subreddits])
+
+    pipeline.stage('kpi_fetch', lambda: fetch_new_data.update_snapshot(db_filename), outputs=['kpi'])
+    pipeline.stage('reddit_fetch', lambda: fetch_reddit(db_filename, subreddits, workers=workers, comments=comments, top_n=top_n),
+                   outputs=['submissions'])
+    pipeline.stage('indicators', lambda: update_indicators(db_filename), inputs=['kpi'], outputs=['kpi_indicators'])
+    pipeline.stage('rollup', lambda: [rollup.update_rollup(db_filename, s, n_jobs=jobs, mp_context=context) for s in subreddits],
+                   inputs=['submissions'], outputs=['rollups'])
+    pipeline.stage('plots', lambda: plot_data.plot_database(db_filename, processes=processes, mp_context=context), inputs=['kpi', 'kpi_indicators'])
+    return pipeline
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Runs the nightly pipeline: KPI snapshot and reddit fetch, indicators, daily rollups and plots.')
+    parser.add_argument('--subreddits', nargs='+', default=['wallstreetbets'], help='e.g. wallstreetbets stocks investing stockmarket pennystocks')
+    parser.add_argument('--workers', type=int, default=8, help='number of concurrent reddit fetch threads')
+    parser.add_argument('--rate', type=float, default=1.0, help='allowed pushshift requests per second (all threads)')
+    parser.add_argument('--comments', choices=['day', 'top'], default=None, help='also fetch comments, see fetch_from_reddit.py')
+    parser.add_argument('--jobs', type=int, default=None, help='number of sentiment scoring processes, defaults to the cores not used by the plots')
+    parser.add_argument('--processes', type=int, default=None, help='number of plot rendering processes, defaults to the cores not used by the rollup')
+    parser.add_argument('--skip', nargs='+', default=[], metavar='STAGE', help='stages not to run, e.g. kpi_fetch reddit_fetch for an offline run')
+    parser.add_argument('--force', action='store_true', help='run all stages, even those whose inputs did not change')
+    metrics.add_arguments(parser)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    metrics.apply_arguments(args)
+    fetch_from_reddit.set_rate_limit(args.rate, 1)
+    http_client.configure(pool_maxsize=max(args.workers, http_client.POOL_MAXSIZE))
+
+    # we assume this code is in /src while data is in /data, all stages work relative to the project root
+    os.chdir(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+    fetch_new_data.load_config()
+    register_default_indicators()
+    pipeline = build_pipeline('data/findat.sqlite3', args.subreddits, workers=args.workers, jobs=args.jobs, processes=args.processes, comments=args.comments)
+
+    start = time.perf_counter()
+    # one stage around the whole run, so a profile covers all stages and their worker threads
+    with metrics.stage('pipeline'):
+        results = pipeline.run(force=args.force, skip=args.skip)
+    pipeline.print_report(results, time.perf_counter() - start)
+    http_client.count_connections()
+    metrics.finish(args)
+    if any(status in ['failed', 'upstream failed'] for status, _ in results.values()):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()